@@ -22,6 +22,14 @@ DHCP_CONFIG_FILE_PREFIX = '/var/lib/dnsmasq/dhcp/'
 DHCP_HOST = 'host'
 DHCP_LEASES_FNAME = 'leases'
 DHCP_PID_FNAME = 'pid'
+# seconds dnsmasq host changes are gathered into one hosts file write and one SIGHUP,
+# 0 writes and reloads on every change. With a delay a short-lived caller must
+# flush() the host database itself, use DhcpHostDB.batch() to gather changes instead
+DHCP_RELOAD_DELAY = 0
+# 'file': all hosts in one --dhcp-hostsfile, every change needs a SIGHUP
+# 'dir': one file per host in a --dhcp-hostsdir, dnsmasq picks new files up by itself
+DHCP_HOSTS_MODE = 'file'
+DHCP_HOSTS_DIR = 'hosts.d'
 # ovs_lib.py
 FAILMODE_SECURE = 'secure'
 # linuxbridge.py
@@ -30,3 +38,42 @@ BRIDGE_NAME_PREFIX = "qbr-"
 # an ipset prefix chain name
 IP_SET_PREFIX_NAME = 'NIPv4'
 
+# iptables_manager.py
+# 'rules': keep the tables in memory and restore only the difference
+# 'chains': like 'rules', but flush and rebuild each changed wrapped chain
+# 'full': save, modify and restore the whole table on every change
+IPTABLES_APPLY_MODE = 'rules'
+# run ipset commands through one long-lived 'ipset -' process per namespace
+IPSET_USE_PROCESS = False
+IPSET_PROCESS_TIMEOUT = 10
+# utils.py
+# commands run at the same time by the executor
+EXECUTOR_CONCURRENCY = 16
+# green threads for spawned library calls
+EXECUTOR_POOL_SIZE = 1000
+# seconds before a command is killed, 0 waits forever
+# callers can pass their own timeout to execute()/exec_cmd()
+EXECUTOR_TIMEOUT = 0
+# ovs_lib.py
+# 'vsctl': run ovs-vsctl for every lookup
+# 'native': talk OVSDB JSON-RPC to ovsdb-server over OVSDB_SOCKET
+OVSDB_INTERFACE = 'vsctl'
+OVSDB_SOCKET = '/var/run/openvswitch/db.sock'
+# cookie carried by flows installed through BaseOVS, marks them as ours
+OVS_FLOW_COOKIE = 0x4e4c
+# seconds BaseOVS.get_all_port_stats() results are shared, 0 disables the cache
+OVS_STATS_CACHE_TTL = 2
+# answer bridge/port lookups from an OVSDB monitor kept in memory
+OVSDB_MONITOR = False
+# ip_lib.py
+# 'command': run the ip command, 'netlink': talk rtnetlink directly
+IP_LIB_BACKEND = 'command'
+# run 'ip netns exec <ns> ...' commands in a worker process pinned to the namespace
+NETNS_USE_WORKERS = False
+# seconds a namespace worker may stay unused before it is stopped
+NETNS_WORKER_IDLE = 60
+# workflow.py
+# print the plan of encapsulation workflows instead of running them
+WORKFLOW_DRY_RUN = False
+# write every workflow's per-step timing report to the log
+WORKFLOW_TIMING_LOG = False
@@ -3,14 +3,267 @@
 import utils
 import shutil
 import socket, struct
+import collections
+import contextlib
+import tempfile
+import eventlet
+from eventlet import hubs, semaphore
 from IPy import IP
 from LogException import *
 from config import *
 
 
+# 一个网络的dnsmasq hosts文件在内存中的索引, MAC -> IP
+# 默认每次修改马上写入文件并reload, batch()中的修改合并成一次文件写入和一次SIGHUP
+# DHCP_RELOAD_DELAY不为0时, 该时间内的修改也合并写入, 调用者退出前需要flush()
+# 文件先写到同目录的临时文件再rename, dnsmasq不会读到写了一半的文件
+class DhcpHostDB(object):
+    def __init__(self, path, reload, delay=None):
+        self.path = path
+        self.reload = reload
+        self.delay = DHCP_RELOAD_DELAY if delay is None else delay
+        self.lock = semaphore.Semaphore()
+        self.hosts = None
+        self.dirty = False
+        self.timer = None
+        self.batching = 0
+
+    def _load(self):
+        if self.hosts is not None:
+            return
+        self.hosts = collections.OrderedDict()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    fields = line.strip().split(',')
+                    if len(fields) == 2:
+                        self.hosts[fields[0]] = fields[1]
+        except IOError:
+            pass
+
+    # return {mac: ip}
+    def get_all(self):
+        with self.lock:
+            self._load()
+            return dict(self.hosts)
+
+    def set(self, mac, ip):
+        with self.lock:
+            self._load()
+            if self.hosts.get(mac) == ip:
+                return
+            self.hosts[mac] = ip
+            self._changed()
+
+    def remove(self, mac):
+        with self.lock:
+            self._load()
+            if self.hosts.pop(mac, None) is None:
+                return
+            self._changed()
+
+    # hosts: [(ip, mac), ...]
+    def replace(self, hosts):
+        with self.lock:
+            self._load()
+            hosts = collections.OrderedDict((mac, ip) for ip, mac in hosts)
+            if hosts == self.hosts:
+                return
+            self.hosts = hosts
+            self._changed()
+
+    # 合并多次修改, 最外层的batch退出时写入一次文件并reload一次
+    # with host_db.batch():
+    #     host_db.set(mac1, ip1)
+    #     host_db.set(mac2, ip2)
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            self.batching += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batching -= 1
+                last = not self.batching
+            if last:
+                self.flush()
+
+    def _changed(self):
+        self.dirty = True
+        if self.batching:
+            return
+        if not self.delay:
+            self._write()
+        elif self.timer is None:
+            # a hub timer can be cancelled before it fires, a greenthread from
+            # spawn_after can't be killed before it starts
+            self.timer = hubs.get_hub().schedule_call_global(
+                self.delay, eventlet.spawn_n, self.flush)
+
+    # 马上写入文件并reload, 不等待合并
+    def flush(self):
+        with self.lock:
+            self._cancel_timer()
+            if self.dirty:
+                self._write()
+
+    def cancel(self):
+        with self.lock:
+            self._cancel_timer()
+            self.dirty = False
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(self.path),
+                                            dir=directory)
+            # mkstemp creates 0600, dnsmasq reads the file after dropping root
+            os.fchmod(fd, 0644)
+            with os.fdopen(fd, 'w') as f:
+                f.writelines("%s,%s\n" % (mac, ip) for mac, ip in self.hosts.items())
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            msg = "Error unable to write file {}. Msg: {}".format(self.path, e)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+            return False
+        self.dirty = False
+        self.reload()
+        return True
+
+
+# --dhcp-hostsdir模式, 每个MAC一个文件, dnsmasq通过inotify读取新的和修改的文件, 不需要SIGHUP
+# dnsmasq只会增加记录: 删除的文件中的记录在下次SIGHUP前仍然有效,
+# 所以只有删除的IP又分配给别的MAC, 或者MAC换了IP时, 才合并发送一次SIGHUP
+class DhcpHostDir(DhcpHostDB):
+    def __init__(self, path, reload, delay=None):
+        super(DhcpHostDir, self).__init__(path, reload, delay)
+        # IPs whose records dnsmasq still holds until the next reload
+        self.released = set()
+
+    def _load(self):
+        if self.hosts is not None:
+            return
+        self.hosts = collections.OrderedDict()
+        try:
+            names = sorted(os.listdir(self.path))
+        except OSError:
+            names = []
+        for name in names:
+            if name.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    fields = f.read().strip().split(',')
+            except IOError:
+                continue
+            if len(fields) == 2:
+                self.hosts[fields[0]] = fields[1]
+
+    def _host_file(self, mac):
+        return os.path.join(self.path, mac.replace(':', '-'))
+
+    def set(self, mac, ip):
+        with self.lock:
+            self._load()
+            old_ip = self.hosts.get(mac)
+            if old_ip == ip:
+                return
+            if not self._write_host(mac, ip):
+                return
+            self.hosts[mac] = ip
+            if old_ip is not None:
+                self.released.add(old_ip)
+            if old_ip is not None or ip in self.released:
+                self._changed()
+
+    def remove(self, mac):
+        with self.lock:
+            self._load()
+            ip = self.hosts.pop(mac, None)
+            if ip is None:
+                return
+            try:
+                os.unlink(self._host_file(mac))
+            except OSError as e:
+                msg = "Error unable to remove file {}. Msg: {}".format(self._host_file(mac), e)
+                print(msg)
+                LogExceptionHelp.logException(msg)
+            self.released.add(ip)
+
+    def replace(self, hosts):
+        hosts = collections.OrderedDict((mac, ip) for ip, mac in hosts)
+        with self.batch():
+            for mac in list(self.get_all()):
+                if mac not in hosts:
+                    self.remove(mac)
+            for mac, ip in hosts.items():
+                self.set(mac, ip)
+
+    # 写入一个MAC的文件, 先写临时文件再rename, dnsmasq忽略以.开头的文件
+    def _write_host(self, mac, ip):
+        try:
+            _make_hosts_dir(self.path)
+            fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.path)
+            # mkstemp creates 0600, dnsmasq reads the file after dropping root
+            os.fchmod(fd, 0644)
+            with os.fdopen(fd, 'w') as f:
+                f.write("%s,%s\n" % (mac, ip))
+            os.rename(tmp_path, self._host_file(mac))
+            return True
+        except (IOError, OSError) as e:
+            msg = "Error unable to write file {}. Msg: {}".format(self._host_file(mac), e)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+            return False
+
+    # the files are already written, only drop the released records
+    def _write(self):
+        self.dirty = False
+        self.released.clear()
+        self.reload()
+        return True
+
+
+# dnsmasq以nobody读取目录, 不受umask影响, 固定为0755
+def _make_hosts_dir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        os.chmod(path, 0755)
+
+
+_host_dbs = {}
+
+
+# 每个网络一个DhcpHostDB, DHCP_HOSTS_MODE为'dir'时为DhcpHostDir
+def get_host_db(net_uid):
+    key = net_uid[:UID_PREFIX_BIT]
+    host_db = _host_dbs.get(key)
+    if host_db is None:
+        dnsmasq = Dnsmasq_base(net_uid=net_uid)
+        if DHCP_HOSTS_MODE == 'dir':
+            host_db = DhcpHostDir(dnsmasq._hosts_dir, dnsmasq.reload_process)
+        else:
+            host_db = DhcpHostDB(dnsmasq._host, dnsmasq.reload_process)
+        _host_dbs[key] = host_db
+    return host_db
+
+
+def forget_host_db(net_uid):
+    host_db = _host_dbs.pop(net_uid[:UID_PREFIX_BIT], None)
+    if host_db:
+        host_db.cancel()
+
+
 # uid :a port's uid
 # net_uid :a network uid
-class Dnsmasq_base(object):
+class Dnsmasq_base(utils.GreenThreadMixin):
     def __init__(self, ip=None, mask=None, mac=None,
                  net_uid=None, namespace=None):
         self.ip = ip
@@ -22,9 +275,9 @@ class Dnsmasq_base(object):
     def Dnsmsq_cmd(self, args):
         if self.namespace:
             full_args = ["ip", "netns", "exec", NS_DHCP_PREFIX + self._network_uid] + args
-            utils.execute(full_args)
+            return utils.execute(full_args)
         else:
-            utils.execute(args)
+            return utils.execute(args)
 
     def spawn_process(self):
         """Spawns a Dnsmasq process for the network."""
@@ -35,7 +288,8 @@ class Dnsmasq_base(object):
             '--strict-order',
             '--bind-interfaces',
             '--interface=%s' % self._interface,
-            '--dhcp-hostsfile=%s' % self._host,
+            (('--dhcp-hostsdir=%s' % self._hosts_dir) if DHCP_HOSTS_MODE == 'dir'
+             else ('--dhcp-hostsfile=%s' % self._host)),
             '--except-interface=lo',
             '--pid-file=%s' % self._pid_file,
             '--dhcp-range=tag0,%s,static,infinite' % self._network,
@@ -43,6 +297,8 @@ class Dnsmasq_base(object):
             '--dhcp-no-override',
             '--dhcp-leasefile=%s' % self._leases_file,
         ]
+        # dnsmasq reads the hosts file when it starts, write pending changes first
+        get_host_db(self.net_uid).flush()
         return self.Dnsmsq_cmd(cmd)
 
     def kill_process(self):
@@ -59,25 +315,27 @@ class Dnsmasq_base(object):
             ]
             return utils.execute(cmd)
 
+    # dnsmasq进程是否在运行
+    def is_running(self):
+        pid = self._pid
+        return bool(pid) and os.path.exists('/proc/%d' % pid)
+
+    # hosts文件中的绑定, return set([(ip, mac), ...])
+    def read_host_info(self):
+        return set((ip, mac) for mac, ip in get_host_db(self.net_uid).get_all().items())
+
+    # 用hosts替换hosts文件中的所有绑定, 然后reload进程
+    # hosts: [(ip, mac), ...]
+    def replace_host_info(self, hosts):
+        get_host_db(self.net_uid).replace(hosts)
+        return True
+
     def remove_vm_host_info(self):
-        Flines = []
-        try:
-            with open(self._host, 'r+') as f:
-                lines = f.readlines()
-                for line in lines:
-                    if line.find(self.mac) == 0:
-                        continue
-                    Flines.append(line)
-                f.seek(0)
-                f.truncate()
-                f.writelines(Flines)
-        except IOError as e:
-            msg = "Error unable open file {}. Msg: {}".format(self._leases_file, e)
-            print(msg)
-            LogExceptionHelp.logException(msg)
-            return False
+        get_host_db(self.net_uid).remove(self.mac)
+        return True
 
     def remove_vm_dhcp_file(self):
+        forget_host_db(self.net_uid)
         try:
             shutil.rmtree(self._vm_dhcp_path)
             return True
@@ -87,16 +345,17 @@ class Dnsmasq_base(object):
             LogExceptionHelp.logException(msg)
             return False
 
+    # changes go through the network's host database, see DhcpHostDB and DhcpHostDir
     def write_host_info(self, ip, mac):
         if ip and mac:
-            try:
-                with open(self._host, 'a+') as f:
-                    f.write("%s,%s\n" % (self.mac, self.ip,))
-                # when added a host info to file. you must reload process
-                self.reload_process()
-            except Exception as e:
-                print(e)
-                LogExceptionHelp.logException(u"Error unable to open file. Msg: {}".format(e))
+            get_host_db(self.net_uid).set(mac, ip)
+        return True
+
+    # 合并多次绑定修改为一次写入和一次reload
+    # with dhcp_obj.host_batch():
+    #     dhcp_obj.write_host_info(ip, mac)
+    def host_batch(self):
+        return get_host_db(self.net_uid).batch()
 
     @property
     def _mkdir_full_path(self):
@@ -125,6 +384,17 @@ class Dnsmasq_base(object):
             LogExceptionHelp.logException(msg)
         return self._mkdir_full_path + DHCP_HOST
 
+    # dnsmasq会读取目录中已有的文件, 启动前目录必须已经存在
+    @property
+    def _hosts_dir(self):
+        hosts_dir = self._mkdir_full_path + DHCP_HOSTS_DIR
+        try:
+            _make_hosts_dir(hosts_dir)
+        except OSError as e:
+            print("Create dir {} Error Msg: {}".format(hosts_dir, e))
+            LogExceptionHelp.logException("Create dir {} Error {}".format(hosts_dir, e))
+        return hosts_dir
+
     @property
     def _vm_dhcp_path(self):
         if not self.net_uid:
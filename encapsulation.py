@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import utils
 from linuxbridge import *
 from ovs_lib import *
 from dhcp import *
@@ -7,11 +8,16 @@ from ip_lib import *
 from iptables_firewall import *
 from config import *
 from ipset_manager import *
+from workflow import Workflow, no_failures
 
 
 # 每个虚拟机的接口需要调用一次
 # port_uid为虚拟机每个接口的UUID
-def create_vm_port_about(port_uid, vm_vlan, use_sg=True, table='filter'):
+# transaction: IptablesFirewallDriver.defer_apply()的返回值, 多个端口的iptables修改一起提交
+# sg_uids: 使用共享安全组链时端口所属的安全组, mac/ips用于防欺骗规则
+# return the Workflow, its report() shows the time of every step
+def create_vm_port_about(port_uid, vm_vlan, use_sg=True, table='filter', transaction=None,
+                         sg_uids=None, mac=None, ips=None):
     vm_port_name = VM_PORT_PREFIX + port_uid[:UID_PREFIX_BIT]
     linux_bridge_name = BRIDGE_NAME_PREFIX + port_uid[:UID_PREFIX_BIT]
     linux_bridge_port_name = VM_BRIDGE_PORT_PREFIX + port_uid[:UID_PREFIX_BIT]
@@ -19,35 +25,156 @@ def create_vm_port_about(port_uid, vm_vlan, use_sg=True, table='filter'):
     ipset_chain_name = get_ipset_chain_name(port_uid)
 
     linux_bridge_obj = LinuxBridgeManager(linux_bridge_name)
-    ip_tool_obj = IPDevice(linux_bridge_name)
+    ip_batch = IpBatch()
+    ip_tool_obj = IPDevice(linux_bridge_name, batch=ip_batch)
     ovs_obj = BaseOVS(VM_bridge_Name)
-    iptables_obj = IptablesFirewallDriver(port_uid, table=table)
+    iptables_obj = IptablesFirewallDriver(port_uid, table=table, transaction=transaction)
     ipset_obj = IpsetManager()
+    wf = Workflow('create_vm_port_about')
 
     # if use Security Group, need create linux bridge and init iptables rule
     if use_sg:
         # create linux bridge
-        linux_bridge_obj.create_br()
-        # create linux path peer
+        wf.add('bridge', linux_bridge_obj.create_br)
+        # create linux path peer and up the ports, all in one ip -batch
         ip_tool_obj.ipwrapper.add_veth(linux_bridge_port_name, ovs_bridge_port_name)
-        # add the vm and linux path peer port to the linux bridge
-        linux_bridge_obj.add_port(linux_bridge_port_name)
-        # add the port to the ovs and set tag
-        ovs_obj.add_port(ovs_bridge_port_name)
-        ovs_obj.set_port_tag(vm_vlan, ovs_bridge_port_name)
-
-        # up the ports
         ip_tool_obj.link.set_port_up(linux_bridge_name)
         ip_tool_obj.link.set_port_up(linux_bridge_port_name)
         ip_tool_obj.link.set_port_up(ovs_bridge_port_name)
+        wf.add('veth', ip_batch.flush, requires=['bridge'], check=no_failures)
+        # add the vm and linux path peer port to the linux bridge
+        wf.add('bridge_port', linux_bridge_obj.add_port, (linux_bridge_port_name,),
+               requires=['veth'])
+        # add the port to the ovs and set tag
+        wf.add('ovs_port', ovs_obj.add_port, (ovs_bridge_port_name, vm_vlan),
+               requires=['veth'], check=bool)
 
-        # init Security Group policy
-        iptables_obj.add_port_chain()
-        ipset_obj.create_ipset_chain(ipset_chain_name)
+        # init Security Group policy, does not depend on the devices
+        wf.add('port_chain', _init_port_chain, (iptables_obj, port_uid, sg_uids, mac, ips,
+                                                table, transaction))
+        wf.add('ipset', ipset_obj.create_ipset_chain, (ipset_chain_name,))
     else:
         # if not use Security Group, we just add vm port to ovs bridge
-        ovs_obj.add_port(vm_port_name)
+        wf.add('ovs_port', ovs_obj.add_port, (vm_port_name,), check=bool)
         ip_tool_obj.link.set_port_up(vm_port_name)
+        wf.add('port_up', ip_batch.flush, check=no_failures)
+    wf.run()
+    return wf
+
+
+def _init_port_chain(iptables_obj, port_uid, sg_uids, mac, ips, table, transaction):
+    iptables_obj.add_port_chain()
+    if sg_uids:
+        bind_port_security_groups(port_uid, sg_uids, mac, ips, table, transaction)
+
+
+# 一个虚拟机接口用到的设备名
+def get_vm_port_names(port_uid):
+    uid = port_uid[:UID_PREFIX_BIT]
+    return {'vm_port': VM_PORT_PREFIX + uid,
+            'bridge': BRIDGE_NAME_PREFIX + uid,
+            'bridge_port': VM_BRIDGE_PORT_PREFIX + uid,
+            'ovs_port': VM_OVS_PORT_PREFIX + uid,
+            'ipset': get_ipset_chain_name(port_uid)}
+
+
+# ip -batch中失败的行记到对应端口上，行号未知时记到所有端口
+def _record_ip_failures(failed, names, errors):
+    for namespace, line, error in failed:
+        words = (line or '').split()
+        for port_uid, port_names in names.items():
+            if line is None or any(n in words for n in port_names.values()):
+                errors[port_uid].append("ip: {}".format(error))
+
+
+# 批量创建虚拟机接口，同类操作合并:
+# 一次ip -batch, 一次ovs-vsctl事务, 一次iptables-restore, 一次ipset restore
+# 网卡和iptables/ipset之间没有依赖，同时执行；ovs端口在网卡创建之后添加
+# ports: [{'port_uid':, 'vm_vlan':, 'use_sg': True, 'sg_uids':, 'mac':, 'ips':}, ...]
+# return {port_uid: [error, ...]}，列表为空表示该端口成功
+def create_vm_ports_bulk(ports, table='filter'):
+    errors = dict((port['port_uid'], []) for port in ports)
+    names = dict((port['port_uid'], get_vm_port_names(port['port_uid'])) for port in ports)
+    sg_ports = [port for port in ports if port.get('use_sg', True)]
+    executor = utils.get_executor()
+
+    # Security Group policy, on the executor while the devices are created
+    iptables_thread = executor.spawn_call(_create_port_chains_bulk, sg_ports, table, errors)
+    ipset_thread = executor.spawn_call(_create_port_ipsets_bulk, sg_ports, errors)
+
+    # linux bridges, veth pairs, bridge ports and links up, in one ip -batch
+    ip_batch = IpBatch()
+    ip_tool_obj = IPDevice(batch=ip_batch)
+    for port in ports:
+        port_names = names[port['port_uid']]
+        if not port.get('use_sg', True):
+            ip_tool_obj.link.set_port_up(port_names['vm_port'])
+            continue
+        if not device_exists(port_names['bridge']):
+            ip_tool_obj.ipwrapper.add_bridge(port_names['bridge'])
+        if not device_exists(port_names['bridge_port']):
+            ip_tool_obj.ipwrapper.add_veth(port_names['bridge_port'], port_names['ovs_port'])
+        ip_tool_obj.link.set_master(port_names['bridge_port'], port_names['bridge'])
+        ip_tool_obj.link.set_port_up(port_names['bridge'])
+        ip_tool_obj.link.set_port_up(port_names['bridge_port'])
+        ip_tool_obj.link.set_port_up(port_names['ovs_port'])
+    _record_ip_failures(ip_batch.flush(), names, errors)
+
+    # all ovs ports in one transaction, without a tag when there is no Security Group
+    ovs_obj = BaseOVS(VM_bridge_Name)
+    ovs_ports = [(port['port_uid'],
+                  names[port['port_uid']]['ovs_port' if port.get('use_sg', True) else 'vm_port'],
+                  port.get('vm_vlan') if port.get('use_sg', True) else None)
+                 for port in ports]
+    ovs_txn = ovs_obj.transaction()
+    for port_uid, port_name, tag in ovs_ports:
+        ovs_txn.add_port(port_name, tag)
+    if ovs_ports and not ovs_txn.commit():
+        # the transaction is all or nothing, add the ports one by one to find the bad ones
+        threads = [(port_uid, ovs_obj.spawn.add_port(port_name, tag))
+                   for port_uid, port_name, tag in ovs_ports]
+        for port_uid, thread in threads:
+            if not thread.wait():
+                errors[port_uid].append("ovs: add port failed")
+
+    iptables_thread.wait()
+    ipset_thread.wait()
+    return errors
+
+
+def _add_port_chain(port, table, transaction):
+    IptablesFirewallDriver(port['port_uid'], table=table,
+                           transaction=transaction).add_port_chain()
+    if port.get('sg_uids'):
+        bind_port_security_groups(port['port_uid'], port['sg_uids'], port.get('mac'),
+                                  port.get('ips'), table, transaction)
+
+
+# 所有端口的iptables链一次提交，失败时逐个端口提交找出失败的端口
+def _create_port_chains_bulk(ports, table, errors):
+    if not ports:
+        return
+    transaction = IptablesFirewallDriver.defer_apply()
+    for port in ports:
+        _add_port_chain(port, table, transaction)
+    if transaction.commit():
+        return
+    for port in ports:
+        transaction = IptablesFirewallDriver.defer_apply()
+        _add_port_chain(port, table, transaction)
+        if not transaction.commit():
+            errors[port['port_uid']].append("iptables: apply port chain failed")
+
+
+# 所有端口的ipset一次ipset restore创建，失败时逐个创建
+def _create_port_ipsets_bulk(ports, errors):
+    ipset_obj = IpsetManager()
+    chains = [(port['port_uid'], get_ipset_chain_name(port['port_uid'])) for port in ports]
+    if not chains or ipset_obj.create_ipset_chains([name for _, name in chains]):
+        return
+    for port_uid, name in chains:
+        if not ipset_obj.create_ipset_chains([name]):
+            errors[port_uid].append("ipset: create {} failed".format(name))
 
 
 # 启动虚拟机DHCP，一个网络启一个DHCP进程
@@ -57,16 +184,18 @@ def create_vm_dhcp(net_uid, ip, mask, mac, vlan=None, namespace=None, first=True
     dhcp_ns_port_name = NS_DHCP_INTERFACE_PREFIX + net_uid[:UID_PREFIX_BIT]
 
     ip_about = ip_expr(ip, mask)
-    ip_tool_obj = IPDevice(name=dhcp_ns_port_name, namespace=dhcp_ns_name)
+    ip_batch = IpBatch()
+    ip_tool_obj = IPDevice(name=dhcp_ns_port_name, namespace=dhcp_ns_name, batch=ip_batch)
     ovs_obj = BaseOVS(VM_bridge_Name)
     dhcp_obj = Dnsmasq_base(ip, mask, mac, net_uid, dhcp_ns_name)
+    wf = Workflow('create_vm_dhcp')
 
     # if the first spawn dhcp process , need spawn dhcp process, and add ip to port
     if first:
+        # add a ovs internal and set vlan tag
+        wf.add('ovs_port', ovs_obj.add_port_internal, (dhcp_ns_port_name, vlan), check=bool)
         # create a namespace
         ip_tool_obj.netns.add(dhcp_ns_name)
-        # add a ovs internal and set vlan tag
-        ovs_obj.add_port_internal(dhcp_ns_port_name, vlan)
 
         if dhcp_ns_name:
             # add the port to namespace
@@ -75,11 +204,32 @@ def create_vm_dhcp(net_uid, ip, mask, mac, vlan=None, namespace=None, first=True
         ip_tool_obj.link.set_port_up(dhcp_ns_port_name)
         # set dhcp listen port ip address and spawn dhcp process
         ip_tool_obj.addr.add_ip(dhcp_ns_port_name, ip_about.dhcp_listen_addr, mask)
-        dhcp_obj.spawn_process()
-    # if not the first spawn dhcp process , add vm's ip and mac to hosts file and reload process
+        # one ip -batch in the root namespace, one in the dhcp namespace
+        wf.add('namespace', ip_batch.flush, requires=['ovs_port'], check=no_failures)
+        wf.add('dnsmasq', dhcp_obj.spawn_process, requires=['namespace'], check=bool)
+    # if not the first spawn dhcp process , add vm's ip and mac to hosts file
+    # and reload the process
     else:
-        dhcp_obj.write_host_info(ip, mac)
-        dhcp_obj.reload_process()
+        wf.add('host', dhcp_obj.write_host_info, (ip, mac))
+    wf.run()
+    return wf
+
+
+# 一次给网络增加多个IP和MAC的绑定, hosts文件只写入一次, dnsmasq只reload一次
+# hosts: [(ip, mac), ...]
+def add_vm_dhcp_hosts(net_uid, hosts, namespace=None):
+    dhcp_ns_name = (namespace if namespace else NS_DHCP_PREFIX + net_uid[:UID_PREFIX_BIT])
+    dhcp_obj = Dnsmasq_base(net_uid=net_uid, namespace=dhcp_ns_name)
+    wf = Workflow('add_vm_dhcp_hosts')
+    wf.add('hosts', _write_dhcp_hosts_batch, (dhcp_obj, hosts))
+    wf.run()
+    return wf
+
+
+def _write_dhcp_hosts_batch(dhcp_obj, hosts):
+    with dhcp_obj.host_batch():
+        for ip, mac in hosts:
+            dhcp_obj.write_host_info(ip, mac)
 
 
 # 添加L3，三层路由.三层路由一个隔离空间一个
@@ -91,14 +241,17 @@ def create_l3(stu_ip, stu_mask, vm_ip, vm_mask, l3_uid, net_uid, vm_vlan, l3_vla
     vm_ip_about = ip_expr(vm_ip, vm_mask)
     user_ip_about = ip_expr(stu_ip, stu_mask)
     ovs_obj = BaseOVS(VM_bridge_Name)
-    ip_tool_obj = IPDevice(namespace=l3_ns_name)
-
+    ip_batch = IpBatch()
+    ip_tool_obj = IPDevice(namespace=l3_ns_name, batch=ip_batch)
+    wf = Workflow('create_l3')
+
+    # ovs add internal ports for vm and for student, in one ovs-vsctl call
+    ovs_txn = ovs_obj.transaction()
+    ovs_txn.add_port_internal(l3_vm_port_name, vm_vlan)
+    ovs_txn.add_port_internal(l3_stu_port_name, l3_vlan)
+    wf.add('ovs_ports', ovs_txn.commit, check=bool)
     # create a l3 namespace
     ip_tool_obj.netns.add(l3_ns_name)
-    # ovs add internal ports for vm
-    ovs_obj.add_port_internal(l3_vm_port_name, vm_vlan)
-    # ovs add internal ports for student
-    ovs_obj.add_port_internal(l3_stu_port_name, l3_vlan)
     # add the port to namespace
     ip_tool_obj.link.set_netns(l3_vm_port_name)
     ip_tool_obj.link.set_netns(l3_stu_port_name)
@@ -108,6 +261,10 @@ def create_l3(stu_ip, stu_mask, vm_ip, vm_mask, l3_uid, net_uid, vm_vlan, l3_vla
     # set port's ip address
     ip_tool_obj.addr.add_ip(l3_vm_port_name, vm_ip_about.gateway, vm_mask)
     ip_tool_obj.addr.add_ip(l3_stu_port_name, user_ip_about.gateway, stu_mask)
+    # one ip -batch in the root namespace, one in the l3 namespace
+    wf.add('namespace', ip_batch.flush, requires=['ovs_ports'], check=no_failures)
+    wf.run()
+    return wf
 
 
 # 添加路由条目
@@ -132,18 +289,30 @@ def delete_route(l3_uid, cidr, out_port, namespace=None):
 
 # 添加流策略，用于学生登录
 def user_login(**kwargs):
-    ovs_obj = BaseOVS(Mirror_bridge)
-    ovs_obj.add_flow(**kwargs)
+    return users_login([kwargs])
 
 
 # 删除流策略，用于学生退出
 def user_logout(**kwargs):
+    return users_logout([kwargs])
+
+
+# 多个学生同时登录, 所有流策略由一个ovs-ofctl进程下发
+# flows: [{key:value,...}, ...] 每个学生一个
+# return [(flow, error), ...], 空列表表示全部成功
+def users_login(flows, bundle=False):
+    ovs_obj = BaseOVS(Mirror_bridge)
+    return ovs_obj.add_flows(flows, bundle)
+
+
+# 多个学生同时退出
+def users_logout(flows, bundle=False):
     ovs_obj = BaseOVS(Mirror_bridge)
-    ovs_obj.delete_flows(**kwargs)
+    return ovs_obj.remove_flows(flows, bundle)
 
 
 # 清除虚拟机相关
-def clean_vm_port_about(port_uid, use_sg=True, table='filter'):
+def clean_vm_port_about(port_uid, use_sg=True, table='filter', transaction=None):
     linux_bridge_name = BRIDGE_NAME_PREFIX + port_uid[:UID_PREFIX_BIT]
     linux_bridge_port_name = VM_BRIDGE_PORT_PREFIX + port_uid[:UID_PREFIX_BIT]
     ovs_bridge_port_name = VM_OVS_PORT_PREFIX + port_uid[:UID_PREFIX_BIT]
@@ -153,26 +322,95 @@ def clean_vm_port_about(port_uid, use_sg=True, table='filter'):
     linux_bridge_obj = LinuxBridgeManager(linux_bridge_name)
     ip_tool_obj = IPDevice(linux_bridge_name)
     ovs_obj = BaseOVS(VM_bridge_Name)
-    iptables_obj = IptablesFirewallDriver(port_uid, table=table)
+    iptables_obj = IptablesFirewallDriver(port_uid, table=table, transaction=transaction)
     ipset_obj = IpsetManager()
+    wf = Workflow('clean_vm_port_about')
 
     # if use Security Group remove them
     if use_sg:
         # link down linux bridge port
-        ip_tool_obj.link.set_port_down()
+        wf.add('bridge_down', ip_tool_obj.link.set_port_down)
         # so remove linux bridge
-        linux_bridge_obj.remove_br()
+        wf.add('bridge', linux_bridge_obj.remove_br, requires=['bridge_down'])
         # delete peer path.
-        ip_tool_obj.ipwrapper.del_veth(linux_bridge_port_name)
-        ovs_obj.delete_port(ovs_bridge_port_name)
+        wf.add('veth', ip_tool_obj.ipwrapper.del_veth, (linux_bridge_port_name,))
+        wf.add('ovs_port', ovs_obj.delete_port, (ovs_bridge_port_name,), check=bool)
         # remove Security Group about
-        iptables_obj.remove_port_chain()
-        # remove ipset chain
-        ipset_obj.destroy_ipset_chain_by_name(ipset_chain_name)
+        wf.add('port_chain', iptables_obj.remove_port_chain)
+        # remove ipset chain, not while the port chain still refers to it
+        wf.add('ipset', ipset_obj.destroy_ipset_chain_by_name, (ipset_chain_name,),
+               requires=['port_chain'])
     else:
         # if not use Security Group just remove ovs bridge's port and peer path port
-        ip_tool_obj.ipwrapper.del_veth(linux_bridge_port_name)
-        ovs_obj.delete_port(ovs_bridge_port_name)
+        wf.add('veth', ip_tool_obj.ipwrapper.del_veth, (linux_bridge_port_name,))
+        wf.add('ovs_port', ovs_obj.delete_port, (ovs_bridge_port_name,), check=bool)
+    wf.run()
+    return wf
+
+
+# 批量清除虚拟机接口，与create_vm_ports_bulk对应
+# 网卡删除和ovs事务、iptables事务同时执行，ipset在iptables规则删除之后再删除
+# ports: [{'port_uid':, 'use_sg': True}, ...] 或 port_uid列表
+# return {port_uid: [error, ...]}，列表为空表示该端口成功
+def clean_vm_ports_bulk(ports, table='filter'):
+    ports = [port if isinstance(port, dict) else {'port_uid': port} for port in ports]
+    errors = dict((port['port_uid'], []) for port in ports)
+    names = dict((port['port_uid'], get_vm_port_names(port['port_uid'])) for port in ports)
+    sg_ports = [port for port in ports if port.get('use_sg', True)]
+    executor = utils.get_executor()
+
+    security_thread = executor.spawn_call(_remove_port_security_bulk, sg_ports, table, errors)
+
+    # deleting one end of a veth pair removes the peer too
+    ip_batch = IpBatch()
+    ip_tool_obj = IPDevice(batch=ip_batch)
+    for port in ports:
+        port_names = names[port['port_uid']]
+        devices = ['bridge_port', 'bridge'] if port.get('use_sg', True) else ['bridge_port']
+        for device in devices:
+            if device_exists(port_names[device]):
+                ip_tool_obj.ipwrapper.del_veth(port_names[device])
+    ip_thread = executor.spawn_call(ip_batch.flush)
+
+    ovs_obj = BaseOVS(VM_bridge_Name)
+    ovs_txn = ovs_obj.transaction()
+    for port in ports:
+        ovs_txn.del_port(names[port['port_uid']]['ovs_port'])
+    if ports and not ovs_txn.commit():
+        threads = [(port['port_uid'],
+                    ovs_obj.spawn.delete_port(names[port['port_uid']]['ovs_port']))
+                   for port in ports]
+        for port_uid, thread in threads:
+            if not thread.wait():
+                errors[port_uid].append("ovs: delete port failed")
+
+    _record_ip_failures(ip_thread.wait(), names, errors)
+    security_thread.wait()
+    return errors
+
+
+# 删除端口的iptables链，之后再删除ipset，被规则引用的ipset不能删除
+def _remove_port_security_bulk(ports, table, errors):
+    if not ports:
+        return
+    transaction = IptablesFirewallDriver.defer_apply()
+    for port in ports:
+        IptablesFirewallDriver(port['port_uid'], table=table,
+                               transaction=transaction).remove_port_chain()
+    if not transaction.commit():
+        for port in ports:
+            transaction = IptablesFirewallDriver.defer_apply()
+            IptablesFirewallDriver(port['port_uid'], table=table,
+                                   transaction=transaction).remove_port_chain()
+            if not transaction.commit():
+                errors[port['port_uid']].append("iptables: remove port chain failed")
+    ipset_obj = IpsetManager()
+    chains = [(port['port_uid'], get_ipset_chain_name(port['port_uid'])) for port in ports]
+    if ipset_obj.destroy_ipset_chains([name for _, name in chains]):
+        return
+    for port_uid, name in chains:
+        if not ipset_obj.destroy_ipset_chains([name]):
+            errors[port_uid].append("ipset: destroy {} failed".format(name))
 
 
 # 清除DHCP相关
@@ -182,14 +420,17 @@ def clean_dhcp_about(net_uid, namespace=None):
     ovs_obj = BaseOVS(VM_bridge_Name)
     ip_tool_obj = IPDevice()
     dhcp_obj = Dnsmasq_base(net_uid=net_uid)
+    wf = Workflow('clean_dhcp_about')
 
     # remove ovs bridge's port
-    ovs_obj.delete_port(dhcp_ns_port_name)
+    wf.add('ovs_port', ovs_obj.delete_port, (dhcp_ns_port_name,), check=bool)
     # remove namespace
-    ip_tool_obj.netns.delete(dhcp_ns_name)
+    wf.add('namespace', ip_tool_obj.netns.delete, (dhcp_ns_name,))
     # remove dhcp process and dhcp file
-    dhcp_obj.kill_process()
-    dhcp_obj.remove_vm_dhcp_file()
+    wf.add('dnsmasq', dhcp_obj.kill_process)
+    wf.add('files', dhcp_obj.remove_vm_dhcp_file, requires=['dnsmasq'])
+    wf.run()
+    return wf
 
 
 # 清除L3相关
@@ -199,12 +440,15 @@ def clean_l3_about(l3_uid, net_uid, namespace=None):
     l3_stu_port_name = L3_STU_PORT_PREFIX + l3_uid[:UID_PREFIX_BIT]
     ovs_obj = BaseOVS(VM_bridge_Name)
     ip_tool_obj = IPDevice()
+    wf = Workflow('clean_l3_about')
 
     # remove ovs bridge's port
-    ovs_obj.delete_port(l3_vm_port_name)
-    ovs_obj.delete_port(l3_stu_port_name)
+    wf.add('vm_port', ovs_obj.delete_port, (l3_vm_port_name,), check=bool)
+    wf.add('stu_port', ovs_obj.delete_port, (l3_stu_port_name,), check=bool)
     # remove namespace
-    ip_tool_obj.netns.delete(l3_ns_name)
+    wf.add('namespace', ip_tool_obj.netns.delete, (l3_ns_name,))
+    wf.run()
+    return wf
 
 
 # 添加数据镜像
@@ -240,6 +484,20 @@ def add_ip_to_ipset(port_uid, ips, table='filter'):
     iptables_obj.add_ipset_rule(ips)
 
 
+# 用ips替换虚拟机接口ipset中的所有IP
+def replace_ipset_ips(port_uid, ips, table='filter'):
+    iptables_obj = IptablesFirewallDriver(port_uid, table=table)
+
+    iptables_obj.replace_ipset_rule(ips)
+
+
+# 同步虚拟机接口ipset中的IP，只修改有差异的IP
+def sync_ipset_ips(port_uid, ips, table='filter'):
+    iptables_obj = IptablesFirewallDriver(port_uid, table=table)
+
+    iptables_obj.sync_ipset_rule(ips)
+
+
 # 为虚拟机接口增加防火墙规则
 def add_rule(port_uid, rule, direction, wrap=True, table='filter'):
     iptables_obj = IptablesFirewallDriver(port_uid, table=table)
@@ -250,3 +508,43 @@ def add_rule(port_uid, rule, direction, wrap=True, table='filter'):
 def remove_rule(port_uid, rule, direction, wrap=True,  table='filter'):
     iptables_obj = IptablesFirewallDriver(port_uid, table=table)
     iptables_obj.delete_rule(rule, direction, wrap=wrap)
+
+
+# 创建共享安全组链，一个安全组只需调用一次
+def create_security_group(sg_uid, table='filter'):
+    iptables_obj = IptablesFirewallDriver(table=table)
+    iptables_obj.add_sg_rule_chain(sg_uid)
+
+
+# 删除共享安全组链
+def delete_security_group(sg_uid, table='filter'):
+    iptables_obj = IptablesFirewallDriver(table=table)
+    iptables_obj.remove_sg_rule_chain(sg_uid)
+
+
+# 为安全组增加防火墙规则，同组的所有虚拟机接口生效
+def add_sg_rule(sg_uid, rule, direction, wrap=True, table='filter'):
+    iptables_obj = IptablesFirewallDriver(table=table)
+    iptables_obj.add_sg_rule(sg_uid, rule, direction, wrap=wrap)
+
+
+# 删除安全组防火墙规则
+def remove_sg_rule(sg_uid, rule, direction, wrap=True, table='filter'):
+    iptables_obj = IptablesFirewallDriver(table=table)
+    iptables_obj.delete_sg_rule(sg_uid, rule, direction, wrap=wrap)
+
+
+# 虚拟机接口加入安全组，端口链只保留防欺骗规则和到安全组链的跳转
+# mac/ips: 虚拟机接口的MAC和IP列表，不传时不加防欺骗规则
+def bind_port_security_groups(port_uid, sg_uids, mac=None, ips=None, table='filter', transaction=None):
+    iptables_obj = IptablesFirewallDriver(port_uid, table=table, transaction=transaction)
+    if mac and ips:
+        iptables_obj.add_port_spoofing_rule(mac, ips)
+    for sg_uid in sg_uids:
+        iptables_obj.add_port_sg(sg_uid)
+
+
+# 虚拟机接口退出安全组
+def unbind_port_security_group(port_uid, sg_uid, table='filter'):
+    iptables_obj = IptablesFirewallDriver(port_uid, table=table)
+    iptables_obj.remove_port_sg(sg_uid)
@@ -1,15 +1,68 @@
 # encoding=utf-8
 
+import collections
+import re
 import utils
+import netlink_lib
+from LogException import *
 from config import *
 
 VLAN_INTERFACE_DETAIL = ['vlan protocol 802.1q',
                          'vlan protocol 802.1Q',
                          'vlan id']
 
+# 'ip -force -batch -' reports a failed line as 'Command failed -:<line>'
+BATCH_FAILED_RE = re.compile(r'^Command failed .*:(\d+)\s*$')
+
+# kernel state of the root namespace, read without running ip
+SYS_CLASS_NET = '/sys/class/net/'
+NETNS_RUN_DIR = netlink_lib.NETNS_RUN_DIR
+
+
+# 命名空间是否存在, 与ip netns list相同的来源
+def namespace_exists(name):
+    return bool(name) and os.path.exists(os.path.join(NETNS_RUN_DIR, name))
+
+
+def list_namespaces():
+    try:
+        return sorted(os.listdir(NETNS_RUN_DIR))
+    except OSError:
+        return []
+
+
+# 接口是否存在, 根命名空间读/sys, 其他命名空间用一次netlink查询
+def device_exists(name, namespace=None):
+    if not namespace:
+        return os.path.exists(os.path.join(SYS_CLASS_NET, name))
+    if not namespace_exists(namespace):
+        return False
+    try:
+        return netlink_lib.get_iproute(namespace).link_lookup(name) is not None
+    except (netlink_lib.NetlinkError, EnvironmentError):
+        return False
+
+
+# 根命名空间的所有接口
+def list_devices():
+    try:
+        return sorted(os.listdir(SYS_CLASS_NET))
+    except OSError:
+        return []
+
+
+# 接口所属的桥(linux bridge或ovs-system), 没有返回None
+def device_master(name):
+    try:
+        return os.path.basename(os.readlink(os.path.join(SYS_CLASS_NET, name, 'master')))
+    except OSError:
+        return None
+
 
 def _execute(options, command, args,
-             namespace=None, ):
+             namespace=None, batch=None):
+    if batch is not None and not options:
+        return batch.add(namespace, command, args)
     opt_list = ['-%s' % o for o in options]
     if namespace:
         ip_cmd = ['ip', 'netns', 'exec', namespace, 'ip']
@@ -18,20 +71,113 @@ def _execute(options, command, args,
     return utils.execute(ip_cmd + opt_list + [command] + list(args), )
 
 
+# IP_LIB_BACKEND为netlink时返回该命名空间的netlink连接
+# 使用batch时返回None, 修改排队在batch中按顺序执行
+def _netlink(namespace=None, batch=None):
+    if IP_LIB_BACKEND != 'netlink' or batch is not None:
+        return None
+    return netlink_lib.get_iproute(namespace)
+
+
+# 执行一个netlink操作, 失败时记录日志并返回None
+def _netlink_call(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except (netlink_lib.NetlinkError, EnvironmentError) as e:
+        msg = "Runing netlink {}{} error. msg: [{}]".format(func.__name__, args, e)
+        print(msg)
+        LogExceptionHelp.logException(msg)
+
+
+class IpBatch(object):
+    """Queues ip commands and runs them with one 'ip -batch -' per namespace.
+
+    Namespaces are flushed in the order they were first used, so commands
+    in the root namespace that create or move devices go first.
+    """
+
+    def __init__(self):
+        # namespace -> ['link set dev up', ...]
+        self.commands = collections.OrderedDict()
+
+    def add(self, namespace, command, args):
+        if isinstance(args, basestring):
+            args = (args,)
+        line = ' '.join([command] + [str(a) for a in args])
+        self.commands.setdefault(namespace, []).append(line)
+
+    # run the queued commands, return [(namespace, command, error), ...] of the failed ones
+    def flush(self):
+        commands, self.commands = self.commands, collections.OrderedDict()
+        failed = []
+        for namespace, lines in commands.items():
+            failed += self._run(namespace, lines)
+        for namespace, line, error in failed:
+            msg = "Runing ip command [{}] in namespace {} error. msg: [{}]".format(
+                line, namespace, error)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+        return failed
+
+    def _run(self, namespace, lines):
+        cmd = ['ip', '-force', '-batch', '-']
+        if namespace:
+            cmd = ['ip', 'netns', 'exec', namespace] + cmd
+        print("Running command: {}".format(cmd))
+        try:
+            result = utils.get_executor().run(cmd, process_input='\n'.join(lines) + '\n')
+        except Exception as e:
+            return [(namespace, line, str(e)) for line in lines]
+        # error messages come before the 'Command failed' line they belong to
+        failed = []
+        messages = []
+        for err_line in result.stderr.splitlines():
+            match = BATCH_FAILED_RE.match(err_line.strip())
+            if not match:
+                messages.append(err_line.strip())
+                continue
+            number = int(match.group(1))
+            line = (lines[number - 1] if 0 < number <= len(lines) else None)
+            failed.append((namespace, line, '; '.join(m for m in messages if m)))
+            messages = []
+        # e.g. ip netns exec found no namespace, or the batch was killed:
+        # nothing says which lines ran, so all of them count as failed
+        if not failed and (result.returncode or result.timed_out):
+            error = ('timed out' if result.timed_out else
+                     '; '.join(m for m in messages if m) or
+                     'exit code {}'.format(result.returncode))
+            failed = [(namespace, line, error) for line in lines]
+        return failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not exc_type:
+            self.flush()
+
+
 # this class is outside API
 # name: a port's name
 # namespace: a namespace name
-class IPDevice(object):
-    def __init__(self, name=None, namespace=None):
+# batch: an IpBatch, link/addr/route/netns changes are queued in it
+#        and run when it is flushed
+class IPDevice(utils.GreenThreadMixin):
+    def __init__(self, name=None, namespace=None, batch=None):
         self.namespace = namespace
         self.name = name
-        self.link = IpLinkCommand(self.name, self.namespace)
-        self.addr = IpAddrCommand(self.name, self.namespace)
-        self.netns = IpNetnsCommand(self.name, self.namespace)
-        self.route = IpRouteCommand(self.name, self.namespace)
-        self.ipwrapper = IPWrapper(self.name, self.namespace)
+        self.batch = batch
+        self.link = IpLinkCommand(self.name, self.namespace, batch)
+        self.addr = IpAddrCommand(self.name, self.namespace, batch)
+        self.netns = IpNetnsCommand(self.name, self.namespace, batch)
+        self.route = IpRouteCommand(self.name, self.namespace, batch)
+        self.ipwrapper = IPWrapper(self.name, self.namespace, batch)
         self.iprule = IpRule()
 
+    # 接口是否存在
+    def exists(self):
+        return device_exists(self.name, self.namespace)
+
     def __eq__(self, other):
         return (other is not None and self.name == other.name
                 and self.namespace == other.namespace)
@@ -40,14 +186,23 @@ class IPDevice(object):
         return self.name
 
 
-class IPWrapper(object):
-    def __init__(self, name=None, namespace=None):
+class IPWrapper(utils.GreenThreadMixin):
+    def __init__(self, name=None, namespace=None, batch=None):
         self.name = name
         self.namespace = namespace
-        self.netns = IpNetnsCommand(self.name, self.namespace)
+        self.batch = batch
+        self.netns = IpNetnsCommand(self.name, self.namespace, batch)
 
     # get a namesapce ports
     def get_devices(self, exclude_loopback=False):
+        if not self.namespace:
+            return [name for name in list_devices()
+                    if not (exclude_loopback and name == LOOPBACK_DEVNAME)]
+        netlink = _netlink(self.namespace)
+        if netlink:
+            links = _netlink_call(netlink.links) or []
+            return [link['name'] for link in links
+                    if not (exclude_loopback and link['name'] == LOOPBACK_DEVNAME)]
         retval = []
         output = _execute(['o', 'd'], 'link', ('list',), self.namespace)
         for line in output.split('\n'):
@@ -67,25 +222,45 @@ class IPWrapper(object):
                 retval.append(name)
         return retval
 
+    # 命名空间中所有接口的详细信息
+    # return [{'index', 'name', 'up', 'state', 'mtu', 'address', 'kind', 'master', 'link'}]
+    def list_links(self):
+        return _netlink_call(netlink_lib.get_iproute(self.namespace).links)
+
+    # add a linux bridge
+    def add_bridge(self, name):
+        netlink = _netlink(batch=self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_add, name, 'bridge')
+        _execute('', 'link', ('add', 'name', name, 'type', 'bridge'), batch=self.batch)
+
     # add tun device
     def add_tuntap(self, name, mode='tap'):
-        _execute('', 'tuntap', ('add', name, 'mode', mode))
+        _execute('', 'tuntap', ('add', name, 'mode', mode), batch=self.batch)
 
     # add veth peer
     def add_veth(self, name1, name2, namespace2=None):
         args = ['add', name1, 'type', 'veth', 'peer', 'name', name2]
+        peer_namespace = namespace2
 
         if namespace2 is None:
             namespace2 = self.namespace
         else:
             args += ['netns', namespace2]
 
-        _execute('', 'link', tuple(args))
+        netlink = _netlink(batch=self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_add, name1, 'veth', peer=name2,
+                                 peer_namespace=peer_namespace)
+        _execute('', 'link', tuple(args), batch=self.batch)
 
     # del veth peer. you can delete any one
     def del_veth(self, name):
         """Delete a virtual interface between two namespaces."""
-        _execute('', 'link', ('del', name))
+        netlink = _netlink(batch=self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_del, name)
+        _execute('', 'link', ('del', name), batch=self.batch)
 
     # not use
     def namespace_is_empty(self):
@@ -102,12 +277,14 @@ class IPWrapper(object):
 
     # get all namespace name
     def get_namespaces(self):
+        if os.path.isdir(NETNS_RUN_DIR):
+            return list_namespaces()
         output = _execute('', 'netns', ('list',), namespace=self.namespace)
         return [l.strip() for l in output.split('\n')]
 
 
 # IP rule. not use
-class IpRule(object):
+class IpRule(utils.GreenThreadMixin):
     def add_rule_from(self, ip, table, rule_pr):
         args = ['add', 'from', ip, 'lookup', table, 'priority', rule_pr]
         ip = _execute('', 'rule', tuple(args))
@@ -119,75 +296,116 @@ class IpRule(object):
         return ip
 
 
-class IpLinkCommand(object):
+class IpLinkCommand(utils.GreenThreadMixin):
     COMMAND = 'link set'
 
     # name : a port name
-    def __init__(self, name, namespace):
+    def __init__(self, name, namespace, batch=None):
         self.name = name
         self.namespace = namespace
+        self.batch = batch
 
     # change a port status to up
     def set_port_up(self, port):
-        _execute('', self.COMMAND, ('%s' % port, 'up'), self.namespace)
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_set, port, up=True)
+        _execute('', self.COMMAND, ('%s' % port, 'up'), self.namespace, batch=self.batch)
 
     # change a port status to down
     def set_port_down(self):
-        _execute('', self.COMMAND, ('%s' % self.name, 'down'), self.namespace)
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_set, self.name, up=False)
+        _execute('', self.COMMAND, ('%s' % self.name, 'down'), self.namespace, batch=self.batch)
+
+    # attach a port to a linux bridge
+    def set_master(self, port, master):
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_set, port, master=master)
+        _execute('', self.COMMAND, ('%s' % port, 'master', '%s' % master),
+                 self.namespace, batch=self.batch)
 
     # add a port to a namespace
     def set_netns(self, name):
+        netlink = _netlink(batch=self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_set, name, namespace=self.namespace)
         _execute('', self.COMMAND, ('%s' % name,
                                     'netns',
                                     '%s' % self.namespace,
-                                    ))
+                                    ), batch=self.batch)
 
     # delete a port
     def delete(self):
-        _execute('', 'delete', self.name, self.namespace)
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.link_del, self.name)
+        _execute('', 'delete', self.name, self.namespace, batch=self.batch)
 
 
-class IpAddrCommand(object):
+class IpAddrCommand(utils.GreenThreadMixin):
     COMMAND = 'addr'
 
-    def __init__(self, name, namespace):
+    def __init__(self, name, namespace, batch=None):
         self.name = name
         self.namespace = namespace
+        self.batch = batch
 
     # 给接口添加IP地址
     def add_ip(self, name, ip, mask):
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.addr_add, name, '%s/%d' % (ip, mask))
         _execute('', self.COMMAND,
                  ('add',
                   '%s/%d' % (ip, mask),
                   'dev',
                   name),
-                 self.namespace
+                 self.namespace, self.batch
                  )
 
     # 删除接口上的IP地址
     def delete_ip(self, ip, mask):
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.addr_del, self.name, '%s/%d' % (ip, mask))
         _execute('', self.COMMAND,
                  ('del',
                   '%s/%d' % (ip, mask),
                   'dev',
                   self.name,),
-                 self.namespace
+                 self.namespace, self.batch
                  )
 
     # flush the port (clean ip)
     def flush(self):
+        netlink = _netlink(self.namespace)
+        if netlink:
+            return _netlink_call(netlink.addr_flush, self.name)
         _execute('', self.COMMAND + 'flush', self.name)
 
+    # 接口上的IP地址
+    # return [{'index', 'name', 'family', 'address', 'prefixlen', 'scope', 'label'}]
+    def list(self):
+        return _netlink_call(netlink_lib.get_iproute(self.namespace).addrs, self.name)
 
-class IpRouteCommand(object):
+
+class IpRouteCommand(utils.GreenThreadMixin):
     COMMAND = 'route'
 
-    def __init__(self, name, namespace):
+    def __init__(self, name, namespace, batch=None):
         self.name = name
         self.namespace = namespace
+        self.batch = batch
 
     # add gateway
     def add_gateway(self, gateway, metric=None, table=None):
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.route_replace, 'default', gateway=gateway,
+                                 dev=self.name, table=table, metric=metric)
         args = ['replace', 'default', 'via', gateway]
         if metric:
             args += ['metric', metric]
@@ -195,10 +413,14 @@ class IpRouteCommand(object):
         if table:
             args += ['table', table]
         _execute('', self.COMMAND,
-                 args, self.namespace)
+                 args, self.namespace, self.batch)
 
     # delete gateway
     def delete_gateway(self, gateway=None, table=None):
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.route_del, 'default', gateway=gateway,
+                                 dev=self.name, table=table)
         args = ['del', 'default']
         if gateway:
             args += ['via', gateway]
@@ -206,28 +428,42 @@ class IpRouteCommand(object):
         if table:
             args += ['table', table]
         _execute('', self.COMMAND,
-                 args, self.namespace)
+                 args, self.namespace, self.batch)
 
     # list all route
+    # return ['5.5.5.0/24', ...] 不含有src的链路路由, 两种后端格式相同
     def list_onlink_routes(self):
+        netlink = _netlink(self.namespace)
+        if netlink:
+            routes = _netlink_call(netlink.routes, dev=self.name, scope='link') or []
+            return [r['dst'] for r in routes if not r['prefsrc']]
+
         def iterate_routes():
-            output = _execute('', self.COMMAND, ('list', 'dev', self.name, 'scope', 'link'), self.namespace)
-            for line in output.split('\n'):
+            ret = _execute('', self.COMMAND, ('list', 'dev', self.name, 'scope', 'link'), self.namespace)
+            if not ret:
+                return
+            for line in ret[1].split('\n'):
                 line = line.strip()
                 if line and not line.count('src'):
-                    yield line
+                    yield line.split()[0]
 
         return [x for x in iterate_routes()]
 
     # add a route
     # cidr like 5.5.5.0/24
     def add_onlink_route(self, cidr, name):
-        _execute('', self.COMMAND, ('replace', cidr, 'dev', name, 'scope', 'link'), self.namespace)
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.route_replace, cidr, dev=name, scope='link')
+        _execute('', self.COMMAND, ('replace', cidr, 'dev', name, 'scope', 'link'), self.namespace, batch=self.batch)
 
     # delete a route
     # cidr like 5.5.5.0/24
     def delete_onlink_route(self, cidr, name):
-        _execute('', self.COMMAND, ('del', cidr, 'dev', name, 'scope', 'link'), self.namespace)
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.route_del, cidr, dev=name)
+        _execute('', self.COMMAND, ('del', cidr, 'dev', name, 'scope', 'link'), self.namespace, batch=self.batch)
 
     # get the gateway ip address
     def get_gateway(self, name, scope=None, filters=None):
@@ -239,6 +475,16 @@ class IpRouteCommand(object):
         if scope:
             filters += ['scope', scope]
 
+        netlink = _netlink(self.namespace)
+        if netlink:
+            routes = _netlink_call(netlink.routes, dev=name) or []
+            default = next((r for r in routes if r['dst'] == 'default'), None)
+            if default and default['gateway']:
+                retval = dict(gateway=default['gateway'])
+                if default['metric'] is not None:
+                    retval.update(metric=default['metric'])
+            return retval
+
         route_list_lines = _execute('', self.COMMAND, ('list', 'dev', name,), self.namespace).split('\n')
         default_route_line = next((x.strip() for x in
                                    route_list_lines if
@@ -258,35 +504,57 @@ class IpRouteCommand(object):
     # ip: next hop ip address like 1.1.1.1
     # table : ip route table
     def add_route(self, cidr, ip, name, table=None):
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.route_replace, cidr, gateway=ip, dev=name,
+                                 table=table)
         args = ['replace', cidr, 'via', ip, 'dev', name]
         if table:
             args += ['table', table]
-        _execute('', self.COMMAND, args, self.namespace)
+        _execute('', self.COMMAND, args, self.namespace, self.batch)
 
     def delete_route(self, cidr, ip, name, table=None):
+        netlink = _netlink(self.namespace, self.batch)
+        if netlink:
+            return _netlink_call(netlink.route_del, cidr, gateway=ip, dev=name,
+                                 table=table)
         args = ['del', cidr, 'via', ip, 'dev', name]
         if table:
             args += ['table', table]
-        _execute('', self.COMMAND, args, self.namespace)
+        _execute('', self.COMMAND, args, self.namespace, self.batch)
+
+    # 路由表中的路由
+    # table: 默认main表
+    # return [{'dst', 'gateway', 'dev', 'metric', 'scope', 'table', 'protocol', 'prefsrc'}]
+    def dump_routes(self, table=None):
+        return _netlink_call(netlink_lib.get_iproute(self.namespace).routes,
+                             dev=self.name, table=table)
 
 
-class IpNetnsCommand(object):
+class IpNetnsCommand(utils.GreenThreadMixin):
     COMMAND = 'netns'
 
-    def __init__(self, name, namespace):
+    def __init__(self, name, namespace, batch=None):
         self.name = name
         self.namespace = namespace
+        self.batch = batch
 
     # 添加一个命名空间
     def add(self, name):
-        _execute('', self.COMMAND, ('add', name))
+        if namespace_exists(name):
+            return
+        _execute('', self.COMMAND, ('add', name), batch=self.batch)
 
     # 删除一个命名空间
     def delete(self, name):
-        _execute('', self.COMMAND, ('delete %s' % name,))
+        netlink_lib.forget_iproute(name)
+        utils.forget_netns_worker(name)
+        _execute('', self.COMMAND, ('delete %s' % name,), batch=self.batch)
 
     # 检查命名空间是否存在
     def exists(self, name):
+        if os.path.isdir(NETNS_RUN_DIR):
+            return namespace_exists(name)
         output = _execute('o', self.COMMAND, ('list',), )
 
         for line in output.split('\n'):
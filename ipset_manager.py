@@ -1,24 +1,204 @@
 # encoding=utf-8
 
+import subprocess
 import utils
+from eventlet import semaphore
+from eventlet.green import select
 from LogException import *
 from config import *
 
+# suffix of the temporary set used to swap in new members
+IPSET_SWAP_SUFFIX = '-n'
+IPSET_TYPE = 'hash:net'
+# commands written to an ipset process before reading its answers
+IPSET_PROCESS_PIPELINE = 256
+# 'ipset version' prints this, we use it to mark the end of each command
+IPSET_VERSION_MARK = 'protocol version'
+IPSET_PROMPT = 'ipset> '
+
 
 def get_ipset_chain_name(uid):
     if uid:
         return IP_SET_PREFIX_NAME + uid[:UID_PREFIX_BIT]
 
 
-class IpsetManager(object):
+# ipset restore lines turning the current members (None: no such set) into desired_ips
+def _sync_lines(name, desired_ips, current):
+    # ipset prints host addresses of a hash:net set without /32
+    desired = set(ip[:-3] if ip.endswith('/32') else ip
+                  for ip in desired_ips or [])
+    lines = []
+    if current is None:
+        current = set()
+        lines.append('create %s %s' % (name, IPSET_TYPE))
+    lines += ['del %s %s' % (name, ip) for ip in sorted(current - desired)]
+    lines += ['add %s %s' % (name, ip) for ip in sorted(desired - current)]
+    return lines
+
+
+# commands that can be sent again when it is not known whether they ran
+IPSET_IDEMPOTENT_COMMANDS = ('create', 'add', 'del', 'flush', '-N', '-A', '-D', '-F')
+
+
+class IpsetProcessError(Exception):
+    pass
+
+
+# the process died in the middle of commands that are not safe to send again
+class IpsetProcessResendError(IpsetProcessError):
+    pass
+
+
+class IpsetProcess(object):
+    """A long-lived 'ipset -' process fed with commands on its stdin.
+
+    Every command is followed by 'version', whose output marks where the
+    command's own output (its error, if any) ends.
+    """
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace
+        self.process = None
+        self.lock = semaphore.Semaphore()
+        self._output = ''
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        # stdout is a pipe, keep ipset from holding back its answers
+        cmd = ['stdbuf', '-oL', 'ipset', '-']
+        if self.namespace:
+            cmd = ['ip', 'netns', 'exec', self.namespace] + cmd
+        self.process = utils.subprocess_popen(cmd, stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT)
+        self._output = ''
+
+    def stop(self):
+        if self.is_alive():
+            try:
+                self.process.kill()
+                self.process.wait()
+            except OSError:
+                pass
+        self.process = None
+
+    # run ipset commands, return [(command, error message), ...] of the failed ones
+    # raise IpsetProcessResendError if the process died before answering a
+    # command that is not idempotent, the caller has to redo the whole job
+    def execute(self, lines):
+        with self.lock:
+            failed = []
+            done = 0
+            restarted = False
+            while done < len(lines):
+                chunk = lines[done:done + IPSET_PROCESS_PIPELINE]
+                answers = []
+                try:
+                    if not self.is_alive():
+                        self.start()
+                    self._run(chunk, answers)
+                except (IOError, OSError, IpsetProcessError) as e:
+                    self.stop()
+                    failed += [(line, error) for line, error in zip(chunk, answers) if error]
+                    done += len(answers)
+                    if restarted:
+                        raise IpsetProcessError("ipset process failed. msg: {}".format(e))
+                    # only the unanswered commands are sent again on a new process
+                    if not all(line.split(' ', 1)[0] in IPSET_IDEMPOTENT_COMMANDS
+                               for line in lines[done:]):
+                        raise IpsetProcessResendError(
+                            "ipset process failed before [{}]. msg: {}".format(lines[done], e))
+                    restarted = True
+                    continue
+                failed += [(line, error) for line, error in zip(chunk, answers) if error]
+                done += len(chunk)
+            return failed
+
+    # answers are appended as they are read, so after an error the
+    # caller knows which commands were answered
+    def _run(self, lines, answers):
+        data = ''.join('%s\nversion\n' % line for line in lines)
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+        for line in lines:
+            answers.append(self._read_answer())
+
+    # read up to the next 'version' output, return what came before it
+    def _read_answer(self):
+        while True:
+            index = self._output.find(IPSET_VERSION_MARK)
+            if index >= 0:
+                end = self._output.find('\n', index)
+                if end >= 0:
+                    break
+            fd = self.process.stdout.fileno()
+            ready = select.select([fd], [], [], IPSET_PROCESS_TIMEOUT)[0]
+            if not ready:
+                raise IpsetProcessError("ipset process timed out")
+            data = os.read(fd, 4096)
+            if not data:
+                raise IpsetProcessError("ipset process exited")
+            self._output += data
+        # everything before the version line belongs to the command
+        answer = self._output[:self._output.rfind('\n', 0, index) + 1]
+        self._output = self._output[end + 1:]
+        return answer.replace(IPSET_PROMPT, '').strip()
+
+
+_ipset_processes = {}
+_ipset_processes_lock = semaphore.Semaphore()
+
+
+# get the ipset process of a namespace, one per namespace
+def get_ipset_process(namespace=None):
+    with _ipset_processes_lock:
+        if namespace not in _ipset_processes:
+            _ipset_processes[namespace] = IpsetProcess(namespace)
+        return _ipset_processes[namespace]
+
+
+class IpsetManager(utils.GreenThreadMixin):
     """Wrapper for ipset."""
 
-    def __init__(self, name=None, namespace=None):
+    # use_process: 通过常驻的ipset进程执行命令，不再每条命令fork一次
+    def __init__(self, name=None, namespace=None, use_process=None):
         self.name = name
         self.namespace = namespace
+        self.use_process = (IPSET_USE_PROCESS if use_process is None
+                            else use_process)
+
+    # send commands to the namespace's ipset process
+    def _process_apply(self, lines):
+        # make create/add/del idempotent like 'ipset restore -exist'
+        lines = [line + ' -exist'
+                 if line.split(' ', 1)[0] in ('create', 'add', 'del', '-A', '-D')
+                 and '-exist' not in line.split() else line
+                 for line in lines]
+        try:
+            failed = get_ipset_process(self.namespace).execute(lines)
+        except IpsetProcessResendError as e:
+            # ipset restore runs the whole job again from the start
+            msg = "ipset process error, running ipset restore. msg: {}".format(e)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+            return self._restore(lines)
+        except IpsetProcessError as e:
+            msg = "ipset process error. msg: {}".format(e)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+            return False
+        for line, error in failed:
+            msg = "Runing ipset command [{}] error. msg: [{}]".format(line, error)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+        return not failed
 
     # 命令执行方法
     def _apply(self, cmd,):
+        if self.use_process:
+            return self._process_apply([' '.join(cmd[1:])])
 
         if self.namespace:
             cmd.insert(0, 'ip netns exec {}'.format(self.namespace))
@@ -31,7 +211,7 @@ class IpsetManager(object):
             'create',
             '-exist',
             name,
-            'hash:net',
+            IPSET_TYPE,
             ]
         self._apply(cmd)
 
@@ -39,6 +219,32 @@ class IpsetManager(object):
     def destroy_ipset_chain_by_name(self, name):
         self._destroy_ipset_chain(name)
 
+    # 一次ipset restore创建多个ipset
+    def create_ipset_chains(self, names):
+        if not names:
+            return True
+        return self._restore_ipset_chains(['create %s %s' % (name, IPSET_TYPE)
+                                           for name in names])
+
+    # 一次ipset restore删除多个ipset，不存在的跳过
+    def destroy_ipset_chains(self, names):
+        existing = self.list_ipset_names()
+        if existing is not None:
+            names = [name for name in names if name in existing]
+        if not names:
+            return True
+        return self._restore_ipset_chains(['destroy %s' % name for name in names])
+
+    # 所有ipset的名字，查询失败返回None
+    def list_ipset_names(self):
+        cmd = ['ipset', 'list', '-n']
+        if self.namespace:
+            cmd = ['ip', 'netns', 'exec', self.namespace] + cmd
+        try:
+            return set(utils.exec_cmd(cmd).split())
+        except Exception:
+            return None
+
     # 添加一个IP到ipset中
     def add_member_to_ipset_chain(self, member_ip, name):
         cmd = [
@@ -64,20 +270,108 @@ class IpsetManager(object):
         self._apply(cmd)
 
     # ips ['1.1.1.1','1.1.1.2','2.2.2.1'....]
+    # 一次ipset restore添加所有IP
     def add_ip_members(self, ips, name):
         if ips:
-            for ip in ips:
-                self.add_member_to_ipset_chain(ip, name)
-            return True
+            lines = ['add %s %s' % (name, ip) for ip in ips]
+            return self._restore_ipset_chains(lines)
         else:
             msg = "ipset: no one or more ip can be add. check the ips"
             LogExceptionHelp.logException(msg)
             print(msg)
 
+    # 一次ipset restore删除多个IP
+    def del_ip_members(self, ips, name):
+        if ips:
+            lines = ['del %s %s' % (name, ip) for ip in ips]
+            return self._restore_ipset_chains(lines)
+
+    # 用ips替换ipset中的所有IP
+    # 先写入临时ipset再swap，一次ipset restore完成，不会只替换一半
+    def replace_ip_members(self, ips, name):
+        swap_name = name + IPSET_SWAP_SUFFIX
+        lines = ['create %s %s' % (swap_name, IPSET_TYPE),
+                 'flush %s' % swap_name]
+        lines += ['add %s %s' % (swap_name, ip) for ip in ips or []]
+        lines += ['create %s %s' % (name, IPSET_TYPE),
+                  'swap %s %s' % (swap_name, name),
+                  'destroy %s' % swap_name]
+        return self._restore_ipset_chains(lines)
+
+    # 读取ipset中的所有IP，ipset不存在时返回None
+    def get_ip_members(self, name):
+        cmd = ['ipset', 'save', name]
+        if self.namespace:
+            cmd = ['ip', 'netns', 'exec', self.namespace] + cmd
+        try:
+            output = utils.exec_cmd(cmd)
+        except Exception:
+            return None
+        members = set()
+        for line in output.split('\n'):
+            tokens = line.split()
+            if len(tokens) >= 3 and tokens[0] == 'add' and tokens[1] == name:
+                members.add(tokens[2])
+        return members
+
+    # 读取所有ipset和其中的IP，一次ipset save
+    # return {name: set(ips)}，查询失败返回None
+    def get_all_members(self):
+        cmd = ['ipset', 'save']
+        if self.namespace:
+            cmd = ['ip', 'netns', 'exec', self.namespace] + cmd
+        try:
+            output = utils.exec_cmd(cmd)
+        except Exception:
+            return None
+        members = {}
+        for line in output.split('\n'):
+            tokens = line.split()
+            if len(tokens) >= 2 and tokens[0] == 'create':
+                members.setdefault(tokens[1], set())
+            elif len(tokens) >= 3 and tokens[0] == 'add':
+                members.setdefault(tokens[1], set()).add(tokens[2])
+        return members
+
+    # 让ipset中的IP与desired_ips一致
+    # 读一次当前IP，只在一次ipset restore中添加和删除有差异的IP
+    def sync_members(self, name, desired_ips):
+        lines = _sync_lines(name, desired_ips, self.get_ip_members(name))
+        if not lines:
+            return True
+        return self._restore_ipset_chains(lines)
+
+    # 多个ipset一起同步，所有差异在一次ipset restore中完成
+    # desired: {name: ips}，current: get_all_members()的结果，不传时读取一次
+    def sync_all_members(self, desired, current=None):
+        if current is None:
+            current = self.get_all_members() or {}
+        lines = []
+        for name, ips in sorted(desired.items()):
+            lines += _sync_lines(name, ips, current.get(name))
+        if not lines:
+            return True
+        return self._restore_ipset_chains(lines)
+
     # 重置IPset
-    def _restore_ipset_chains(self):
+    # lines: ipset restore的输入，每行一条ipset命令
+    def _restore_ipset_chains(self, lines):
+        if self.use_process:
+            return self._process_apply(lines)
+        return self._restore(lines)
+
+    def _restore(self, lines):
         cmd = ['ipset', 'restore', '-exist']
-        self._apply(cmd)
+        if self.namespace:
+            cmd = ['ip', 'netns', 'exec', self.namespace] + cmd
+        try:
+            utils.exec_cmd(cmd, process_input='\n'.join(lines) + '\n')
+            return True
+        except Exception as e:
+            msg = "ipset restore error. msg: {}".format(e)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+            return False
 
     def _swap_ipset_chains(self, src_chain, dest_chain):
         cmd = ['ipset', 'swap', src_chain, dest_chain]
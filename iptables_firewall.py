@@ -13,6 +13,11 @@ DIRECTION_IP_PREFIX = {'ingress': 'source_ip_prefix',
 IPSET_DIRECTION = {INGRESS_DIRECTION: 'src',
                    EGRESS_DIRECTION: 'dst'}
 VM_INTERFACE_PREFIX = 'tap'
+# shared security group chains: si<sg_uid>/so<sg_uid>
+SG_RULE_CHAIN_PREFIX = {INGRESS_DIRECTION: 'si',
+                        EGRESS_DIRECTION: 'so'}
+# per port anti-spoofing chain: s<uid>
+SPOOF_CHAIN_PREFIX = 's'
 
 
 class IptablesFirewallDriver(object):
@@ -20,9 +25,10 @@ class IptablesFirewallDriver(object):
                           EGRESS_DIRECTION: 'physdev-in'}
 
     def __init__(self, chain_uid=None, namespace=None,
-                 table=None, wrap=True):
+                 table=None, wrap=True, transaction=None):
 
         self.namespace = namespace
+        self.transaction = transaction
         self.wrap = wrap
         self.chain_uid = chain_uid
         self.table = table
@@ -33,9 +39,21 @@ class IptablesFirewallDriver(object):
         self.chain_suffix = {INGRESS_DIRECTION: 'i%s' % self.uid_prefix,
                              EGRESS_DIRECTION: 'o%s' % self.uid_prefix,
                              }
+        self.spoof_chain = SPOOF_CHAIN_PREFIX + self.uid_prefix
+
+    # 延迟应用规则，多个端口的修改在一次iptables-restore中提交
+    # with IptablesFirewallDriver.defer_apply() as transaction:
+    #     IptablesFirewallDriver(uid, table='filter', transaction=transaction).add_port_chain()
+    @staticmethod
+    def defer_apply():
+        return IptablesTransaction()
+
+    def _get_iptables(self, chain_uid=None, namespace=None, wrap=True):
+        return IptablesManager(chain_uid, self.table, namespace, wrap=wrap,
+                               transaction=self.transaction)
 
     def wrap_builtin_chains(self):
-        iptables = IptablesManager()
+        iptables = IptablesManager(transaction=self.transaction)
         builtin_chains = {4: {'filter': ['INPUT', 'OUTPUT', 'FORWARD'],
                               'nat': ['PREROUTING', 'OUTPUT', 'POSTROUTING']},
                           }
@@ -54,7 +72,7 @@ class IptablesFirewallDriver(object):
 
     # 只调用一次，调用时table参数必传
     def add_sg_chain(self):
-        iptables = IptablesManager(SG_CHAIN, self.table)
+        iptables = self._get_iptables(SG_CHAIN)
         iptables.add_chain()
 
     # add ingress/egress chains
@@ -62,24 +80,91 @@ class IptablesFirewallDriver(object):
         # add chain about vm port
         for direction in sorted(DIRECTION_IP_PREFIX):
             chain_name_str = self.chain_suffix[direction]
-            iptables = IptablesManager(chain_name_str, self.table)
+            iptables = self._get_iptables(chain_name_str)
             iptables.add_chain()
 
             # add rule to wrap chain
             self._add_chain_rule(direction)
 
+    # iptables中端口链的名字
+    def port_chain_names(self):
+        return [self._get_iptables(self.chain_suffix[direction])._get_chain_name()
+                for direction in sorted(DIRECTION_IP_PREFIX)]
+
     # remove port chain
     def remove_port_chain(self):
         # remove chain about vm port
         for direction in sorted(DIRECTION_IP_PREFIX):
             chain_name = self.chain_suffix[direction]
             self.delete_chain(chain_name)
+        self.delete_chain(self.spoof_chain)
+
+    def _get_sg_chain_name(self, sg_uid, direction):
+        return (SG_RULE_CHAIN_PREFIX[direction] +
+                str(sg_uid).strip()[:MAX_CHAIN_LEN_WRAP - 2])
+
+    # 共享安全组链，每个安全组每个方向一条链，同组的端口共用
+    # 一个安全组只需调用一次
+    def add_sg_rule_chain(self, sg_uid):
+        for direction in sorted(DIRECTION_IP_PREFIX):
+            iptables = self._get_iptables(self._get_sg_chain_name(sg_uid, direction))
+            iptables.add_chain()
+
+    # 删除共享安全组链，端口跳转到该链的规则一起删除
+    def remove_sg_rule_chain(self, sg_uid):
+        for direction in sorted(DIRECTION_IP_PREFIX):
+            iptables = self._get_iptables(self._get_sg_chain_name(sg_uid, direction))
+            iptables.remove_chain()
+
+    # 给共享安全组链添加规则
+    # direction = 'ingress'/'egress'
+    def add_sg_rule(self, sg_uid, rule, direction, wrap=True):
+        iptables = self._get_iptables(self._get_sg_chain_name(sg_uid, direction), wrap=wrap)
+        iptables.add_rule(rule, self.table)
+
+    # direction = 'ingress'/'egress'
+    def delete_sg_rule(self, sg_uid, rule, direction, wrap=True):
+        iptables = self._get_iptables(self._get_sg_chain_name(sg_uid, direction), wrap=wrap)
+        iptables.remove_rule(rule)
+
+    # 端口防欺骗规则，出方向只放行该端口的MAC和IP
+    # 还没有IP的DHCP请求(源地址0.0.0.0)也放行; ips为空时只检查MAC
+    # ips: a list
+    def add_port_spoofing_rule(self, mac, ips):
+        iptables = self._get_iptables(self.spoof_chain)
+        iptables.add_chain()
+        iptables.add_rule('-s 0.0.0.0/32 -p udp --sport 68 --dport 67 '
+                          '-m mac --mac-source %s -j RETURN' % mac,
+                          self.table, defer_apply=True)
+        for ip in ips or []:
+            iptables.add_rule('-s %s -m mac --mac-source %s -j RETURN' % (ip, mac),
+                              self.table, defer_apply=True)
+        if not ips:
+            iptables.add_rule('-m mac --mac-source %s -j RETURN' % mac,
+                              self.table, defer_apply=True)
+        iptables.add_rule('-j DROP', self.table, defer_apply=True, top=False)
+        iptables.iptables_apply(self.table)
+
+        iptables = self._get_iptables(self.chain_suffix[EGRESS_DIRECTION])
+        iptables.add_rule('-j $%s' % self.spoof_chain, self.table)
+
+    # 端口跳转到共享安全组链，端口链中只保留防欺骗规则和跳转规则
+    def add_port_sg(self, sg_uid):
+        for direction in sorted(DIRECTION_IP_PREFIX):
+            iptables = self._get_iptables(self.chain_suffix[direction])
+            iptables.add_rule('-j $%s' % self._get_sg_chain_name(sg_uid, direction),
+                              self.table, top=False)
+
+    def remove_port_sg(self, sg_uid):
+        for direction in sorted(DIRECTION_IP_PREFIX):
+            iptables = self._get_iptables(self.chain_suffix[direction])
+            iptables.remove_rule('-j $%s' % self._get_sg_chain_name(sg_uid, direction))
 
     # direction = str
     # direction: ingress/egress
     # 实例化IptablesFirewallDriver类时时chain_name='FORWARD'/INPUT/OUTPUT
     def _add_chain_rule(self, direction):
-        iptables = IptablesManager(chain_uid='FORWARD', table=self.table)
+        iptables = self._get_iptables('FORWARD')
         device = self.port_name
         jump_rule = '-m physdev --%s %s --physdev-is-bridged ' \
                     '-j $%s' % (self.IPTABLES_DIRECTION[direction],
@@ -87,7 +172,7 @@ class IptablesFirewallDriver(object):
                                 SG_CHAIN)
         iptables.add_rule(jump_rule, self.table)
         # jump to the chain based on the device
-        iptables = IptablesManager(SG_CHAIN, self.table)
+        iptables = self._get_iptables(SG_CHAIN)
         jump_rule = '-m physdev --%s %s --physdev-is-bridged ' \
                     '-j $%s' % (self.IPTABLES_DIRECTION[direction],
                                 device,
@@ -99,8 +184,7 @@ class IptablesFirewallDriver(object):
     # direction: ingress/egress  (str)
     def init_ipset_rule(self, action, direction):
         chain_name = self.chain_suffix[direction]
-        iptables = IptablesManager(chain_uid=chain_name, table=self.table,
-                                   namespace=self.namespace, wrap=True)
+        iptables = self._get_iptables(chain_name, self.namespace)
         direction = IPSET_DIRECTION[direction]
         self.ipset_manager.create_ipset_chain(self.ipset_name)
         args = ['-m set',
@@ -114,30 +198,34 @@ class IptablesFirewallDriver(object):
 
     # ips: a list
     def add_ipset_rule(self, ips):
-        ipset_manager = self.ipset_manager
         if ips:
-            for ip in ips:
-                ipset_manager.add_member_to_ipset_chain(ip, self.ipset_name)
+            self.ipset_manager.add_ip_members(ips, self.ipset_name)
 
     # ips: a list
     def delete_ipset_rule(self, ips):
-        ipset_manager = self.ipset_manager
         if ips:
-            for ip in ips:
-                ipset_manager.del_ipset_chain_member(self.ipset_name, ip)
+            self.ipset_manager.del_ip_members(ips, self.ipset_name)
+
+    # ips: a list, replace all ips of the ipset
+    def replace_ipset_rule(self, ips):
+        self.ipset_manager.replace_ip_members(ips, self.ipset_name)
+
+    # ips: a list, only add and delete the ips that differ from the ipset
+    def sync_ipset_rule(self, ips):
+        self.ipset_manager.sync_members(self.ipset_name, ips)
 
     # direction = 'ingress'/'egress'
     def add_iptables_rule(self, rule, direction, wrap=True):
         chain_name = self.chain_suffix[direction]
-        iptables = IptablesManager(chain_name, self.table, self.namespace, wrap=wrap)
+        iptables = self._get_iptables(chain_name, self.namespace, wrap=wrap)
         iptables.add_rule(rule, self.table, self.chain_uid)
 
     # direction = 'ingress'/'egress'
     def delete_rule(self, rule, direction, wrap=True):
         chain_name = self.chain_suffix[direction]
-        iptables = IptablesManager(chain_name, self.table, self.namespace, wrap=wrap)
+        iptables = self._get_iptables(chain_name, self.namespace, wrap=wrap)
         iptables.remove_rule(rule)
 
     def delete_chain(self, chain_name, wrap=True):
-        iptables = IptablesManager(chain_name, self.table, self.namespace, wrap=wrap)
+        iptables = self._get_iptables(chain_name, self.namespace, wrap=wrap)
         iptables.remove_chain()
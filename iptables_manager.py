@@ -1,8 +1,12 @@
 # encoding=utf-8
 
 import os
+import collections
 import inspect
+import socket
+import struct
 import utils
+from eventlet import semaphore
 from LogException import *
 from config import *
 
@@ -37,11 +41,13 @@ def get_chain_name(chain_name, wrap=True):
         return chain_name[:MAX_CHAIN_LEN_NOWRAP]
 
 
+# top: put the rule in front of the chain's rules, otherwise after them
 class IptablesRule(object):
-    def __init__(self, chain, rule, wrap=True):
+    def __init__(self, chain, rule, wrap=True, top=True):
         self.chain = chain
         self.rule = rule
         self.wrap = wrap
+        self.top = top
 
     def __eq__(self, other):
         return ((self.chain == other.chain) and
@@ -65,19 +71,398 @@ class IptablesTable(object):
         self.remove_chains = set()
 
 
+# iptables-save的写法: 长选项换成短选项, 基本匹配按-s -d -i -o -p的顺序在最前面
+IPTABLES_SAVE_ALIASES = {'--append': '-A', '--source': '-s', '--src': '-s',
+                         '--destination': '-d', '--dst': '-d',
+                         '--in-interface': '-i', '--out-interface': '-o',
+                         '--protocol': '-p', '--match': '-m', '--jump': '-j',
+                         '--goto': '-g', '--source-port': '--sport',
+                         '--destination-port': '--dport'}
+IPTABLES_SAVE_BASE_OPTIONS = ('-s', '-d', '-i', '-o', '-p')
+IPTABLES_SAVE_PROTOCOLS = {'1': 'icmp', '6': 'tcp', '17': 'udp', '132': 'sctp'}
+# 使用时iptables隐式加载'-m <协议>'的选项
+IPTABLES_PROTOCOL_OPTIONS = {
+    'tcp': ('--sport', '--dport', '--tcp-flags', '--syn', '--tcp-option'),
+    'udp': ('--sport', '--dport'),
+    'sctp': ('--sport', '--dport', '--chunk-types'),
+    'icmp': ('--icmp-type',),
+}
+
+
+# 把规则写成iptables-save输出的形式, 模型中的规则和iptables-save读到的规则才能直接比较
+# -A c -p tcp --dport 22 -s 1.2.3.4 -j ACCEPT
+#  -> -A c -s 1.2.3.4/32 -p tcp -m tcp --dport 22 -j ACCEPT
+def _normalize_rule(rule_str):
+    tokens = [IPTABLES_SAVE_ALIASES.get(t, t) for t in str(rule_str).split()]
+    if len(tokens) < 2 or tokens[0] != '-A':
+        return ' '.join(tokens)
+    base = {}
+    rest = []
+    i = 2
+    while i < len(tokens):
+        negate = tokens[i] == '!' and i + 1 < len(tokens)
+        option = tokens[i + 1] if negate else tokens[i]
+        if option in IPTABLES_SAVE_BASE_OPTIONS and i + negate + 1 < len(tokens):
+            value = _save_value(option, tokens[i + negate + 1])
+            base[option] = (['!'] if negate else []) + [option, value]
+            i += negate + 2
+            continue
+        if tokens[i] == '--mac-source' and i + 1 < len(tokens):
+            rest += [tokens[i], tokens[i + 1].upper()]
+            i += 2
+            continue
+        rest.append(tokens[i])
+        i += 1
+    protocol = base.get('-p', [None])[-1]
+    if protocol in IPTABLES_PROTOCOL_OPTIONS and not _has_match(rest, protocol):
+        for j, token in enumerate(rest):
+            if token in IPTABLES_PROTOCOL_OPTIONS[protocol]:
+                if j and rest[j - 1] == '!':
+                    j -= 1
+                rest[j:j] = ['-m', protocol]
+                break
+    rule = tokens[:2]
+    for option in IPTABLES_SAVE_BASE_OPTIONS:
+        rule += base.get(option, [])
+    return ' '.join(rule + rest)
+
+
+def _has_match(tokens, match):
+    return any(tokens[i] == '-m' and tokens[i + 1] == match
+               for i in range(len(tokens) - 1))
+
+
+def _save_value(option, value):
+    if option == '-p':
+        value = value.lower()
+        return IPTABLES_SAVE_PROTOCOLS.get(value, value)
+    if option in ('-s', '-d'):
+        return _save_address(value)
+    return value
+
+
+# 1.2.3.4 -> 1.2.3.4/32, 10.0.0.1/255.255.255.0 -> 10.0.0.0/24, 不是IPv4地址的不变
+def _save_address(value):
+    address, sep, mask = value.partition('/')
+    try:
+        packed = struct.unpack('!I', socket.inet_aton(address))[0]
+        if address.count('.') != 3:
+            return value
+        if not sep:
+            prefixlen = 32
+        elif '.' in mask:
+            bits = struct.unpack('!I', socket.inet_aton(mask))[0]
+            prefixlen = bin(bits).count('1')
+            if bits != (0xffffffff << (32 - prefixlen)) & 0xffffffff:
+                return value
+        else:
+            prefixlen = int(mask)
+    except (socket.error, ValueError):
+        return value
+    if not 0 <= prefixlen <= 32:
+        return value
+    network = packed & ((0xffffffff << (32 - prefixlen)) & 0xffffffff)
+    return '%s/%d' % (socket.inet_ntoa(struct.pack('!I', network)), prefixlen)
+
+
+def _rule_chain(rule_str):
+    return rule_str.split(' ', 2)[1]
+
+
+# return the chain a rule jumps or goes to, or None
+def _rule_target(rule_str):
+    tokens = rule_str.split(' ')
+    for i, token in enumerate(tokens[:-1]):
+        if token in ('-j', '--jump', '-g', '--goto'):
+            return tokens[i + 1]
+
+
+class IptablesTableModel(object):
+    """In-memory copy of one iptables table, kept in step with the kernel.
+
+    The table is read once with iptables-save and then updated in place on
+    every apply, so each change only has to write its own difference.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = semaphore.Semaphore()
+        # chain name -> policy ('-' for user chains)
+        self.headers = collections.OrderedDict()
+        # chain name -> ['-A chain ...', ...] in kernel order
+        self.rules = {}
+        # chain name -> set of the rule texts above
+        self.rule_index = {}
+        # target chain name -> set of (chain, rule text) jumping to it
+        self.referrers = collections.defaultdict(set)
+
+    def load(self, lines):
+        in_table = False
+        for line in lines:
+            line = line.strip()
+            if line == '*%s' % self.name:
+                in_table = True
+            elif not in_table:
+                continue
+            elif line == 'COMMIT':
+                break
+            elif line.startswith(':'):
+                tokens = line[1:].split()
+                self._add_chain(tokens[0], tokens[1] if len(tokens) > 1 else '-')
+            else:
+                # strip the [packets:bytes] counters of a 'save -c' dump
+                if line.startswith('['):
+                    line = line.split(' ', 1)[1]
+                if line.startswith('-A '):
+                    rule_str = _normalize_rule(line)
+                    chain = _rule_chain(rule_str)
+                    if chain not in self.rules:
+                        self._add_chain(chain)
+                    self.rules[chain].append(rule_str)
+                    self._index_rule(chain, rule_str)
+
+    def _add_chain(self, chain, policy='-'):
+        self.headers[chain] = policy
+        self.rules[chain] = []
+        self.rule_index[chain] = set()
+
+    def _index_rule(self, chain, rule_str):
+        self.rule_index[chain].add(rule_str)
+        target = _rule_target(rule_str)
+        if target:
+            self.referrers[target].add((chain, rule_str))
+
+    def _unindex_rule(self, chain, rule_str):
+        self.rule_index[chain].discard(rule_str)
+        target = _rule_target(rule_str)
+        if target and target in self.referrers:
+            self.referrers[target].discard((chain, rule_str))
+
+    def has_chain(self, chain):
+        return chain in self.rules
+
+    def is_builtin(self, chain):
+        return self.headers.get(chain, '-') != '-'
+
+    def update(self, chains, rules, remove_chains, remove_rules):
+        """Apply pending changes to the model.
+
+        Returns a dict mapping every touched chain to its rule list before
+        the change, or to None if the chain did not exist yet.
+        """
+        before = {}
+
+        def touch(chain):
+            if chain not in before:
+                before[chain] = (list(self.rules[chain])
+                                 if chain in self.rules else None)
+
+        for chain in chains:
+            chain = str(chain).strip()
+            if chain in self.rules:
+                LogExceptionHelp.logException("chain {} is already exist".format(chain))
+                continue
+            touch(chain)
+            self._add_chain(chain)
+
+        # top rules go in front of the existing ones and the others after
+        # them, both in the order given
+        added = collections.OrderedDict()
+        for rule in rules:
+            rule_str = _normalize_rule(rule)
+            chain = _rule_chain(rule_str)
+            if chain not in self.rules:
+                LogExceptionHelp.logException("chain {} of rule {} does not exist".format(chain, rule_str))
+                continue
+            top, bottom, seen = added.setdefault(chain, ([], [], set()))
+            if rule_str in self.rule_index[chain] or rule_str in seen:
+                LogExceptionHelp.logException("rule {} is already exist".format(rule_str))
+                continue
+            seen.add(rule_str)
+            (top if rule.top else bottom).append(rule_str)
+        for chain, (top, bottom, seen) in added.items():
+            touch(chain)
+            self.rules[chain][0:0] = top
+            self.rules[chain].extend(bottom)
+            for rule_str in seen:
+                self._index_rule(chain, rule_str)
+
+        dropped = collections.defaultdict(set)
+        for rule in remove_rules:
+            rule_str = _normalize_rule(rule)
+            chain = _rule_chain(rule_str)
+            if rule_str in self.rule_index.get(chain, ()):
+                dropped[chain].add(rule_str)
+
+        removed = []
+        for chain in remove_chains:
+            chain = str(chain).strip()
+            if chain not in self.rules:
+                continue
+            if self.is_builtin(chain):
+                LogExceptionHelp.logException("can not remove built-in chain {}".format(chain))
+                continue
+            removed.append(chain)
+            # rules jumping to a removed chain have to go with it
+            for ref_chain, rule_str in self.referrers.pop(chain, ()):
+                dropped[ref_chain].add(rule_str)
+
+        for chain, rule_strs in dropped.items():
+            if chain not in self.rules:
+                continue
+            touch(chain)
+            self.rules[chain] = [r for r in self.rules[chain]
+                                 if r not in rule_strs]
+            for rule_str in rule_strs:
+                self._unindex_rule(chain, rule_str)
+
+        for chain in removed:
+            touch(chain)
+            for rule_str in self.rules[chain]:
+                self._unindex_rule(chain, rule_str)
+            del self.headers[chain]
+            del self.rules[chain]
+            del self.rule_index[chain]
+
+        return before
+
+    def delta_lines(self, before, rebuild_prefix=None):
+        """Build iptables-restore --noflush input for an update() result.
+
+        Changed chains are patched with -I/-D lines. Changed chains whose
+        name starts with rebuild_prefix are instead declared again, which
+        flushes them under --noflush, and refilled with all their rules.
+        """
+        new_chains, edits, appends, drops = [], [], [], []
+        for chain in sorted(before):
+            old = before[chain]
+            new = self.rules.get(chain)
+            if old == new:
+                continue
+            if old is None:
+                new_chains.append(':%s - [0:0]' % chain)
+                appends.extend(new)
+            elif new is None:
+                drops.extend(['-F %s' % chain, '-X %s' % chain])
+            elif rebuild_prefix and chain.startswith(rebuild_prefix):
+                new_chains.append(':%s - [0:0]' % chain)
+                appends.extend(new)
+            else:
+                new_set = self.rule_index[chain]
+                old_set = set(old)
+                for rule_str in old:
+                    if rule_str not in new_set:
+                        edits.append('-D' + rule_str[2:])
+                # new rules sit in a block above and a block below the kept ones
+                head = 0
+                while head < len(new) and new[head] not in old_set:
+                    head += 1
+                tail = len(new)
+                while tail > head and new[tail - 1] not in old_set:
+                    tail -= 1
+                for position, rule_str in enumerate(new[:head], 1):
+                    edits.append('-I %s %d %s' % (
+                        chain, position, rule_str.split(' ', 2)[2]))
+                edits.extend(new[tail:])
+
+        lines = new_chains + edits + appends + drops
+        if not lines:
+            return []
+        return ['*%s' % self.name] + lines + ['COMMIT']
+
+
+_table_models = {}
+_table_models_lock = semaphore.Semaphore()
+
+
+# get the in-memory model of a table, reading it from the kernel once
+def get_table_model(table, namespace=None):
+    key = (namespace, table)
+    with _table_models_lock:
+        model = _table_models.get(key)
+        if model:
+            return model
+        args = ['iptables-save', '-t', table]
+        if namespace:
+            args = ['ip', 'netns', 'exec', namespace] + args
+        ret = utils.execute(args)
+        if not ret:
+            LogExceptionHelp.logException("Unable to load iptables table {}".format(table))
+            return
+        model = IptablesTableModel(table)
+        model.load(ret[1].split('\n'))
+        _table_models[key] = model
+        return model
+
+
+# forget a table model, the next apply reads it again from the kernel
+def invalidate_table_model(table, namespace=None):
+    with _table_models_lock:
+        _table_models.pop((namespace, table), None)
+
+
+class IptablesTransaction(object):
+    """Collects iptables changes and writes them all at once.
+
+    Managers created with a transaction only record their changes, commit()
+    writes them with one iptables-restore per namespace.
+    """
+
+    def __init__(self):
+        self.namespaces = {}
+
+    # pending tables of a namespace, shared by all managers of the transaction
+    def get_tables(self, namespace=None):
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = {'filter': IptablesTable(),
+                                          'nat': IptablesTable(),
+                                          }
+        return self.namespaces[namespace]
+
+    # return False if any namespace failed to apply, its changes stay in the
+    # transaction and the next commit() writes them again
+    def commit(self):
+        namespaces, self.namespaces = self.namespaces, {}
+        ok = True
+        for namespace, tables in namespaces.items():
+            pending = dict((table, t) for table, t in tables.items()
+                           if t.chains or t.rules or t.remove_chains or t.remove_rules)
+            if pending and not IptablesManager(namespace=namespace).apply_tables(pending):
+                self.namespaces[namespace] = tables
+                ok = False
+        return ok
+
+    def rollback(self):
+        self.namespaces = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type:
+            self.rollback()
+        else:
+            self.commit()
+
+
 class IptablesManager(object):
     def __init__(self, chain_uid=None, table=None, namespace=None,
-                 wrap=True, state_less=False):
+                 wrap=True, state_less=False, transaction=None):
         self.execute = utils.exec_cmd
         self.chain_uid = chain_uid
         self.namespace = namespace
         self.wrap = wrap
         self.state_less = state_less
         self.table = table
+        self.apply_mode = IPTABLES_APPLY_MODE
+        self.transaction = transaction
         self.wrap_name = binary_name[:16]
-        self.ipv4 = {'filter': IptablesTable(),
-                     'nat': IptablesTable(),
-                     }
+        if transaction:
+            self.ipv4 = transaction.get_tables(namespace)
+        else:
+            self.ipv4 = {'filter': IptablesTable(),
+                         'nat': IptablesTable(),
+                         }
         if table:
             self.chains = self.ipv4[table].chains
             self.remove_chains = self.ipv4[table].remove_chains
@@ -104,18 +489,23 @@ class IptablesManager(object):
         self.iptables_apply(self.table)
 
     # defer_apply 是否延迟应用规则
-    def add_rule(self, rule, table=None, chain_str=None, rule_list=None, wrap=True, defer_apply=False):
+    # top 规则加在链的最前面，否则加在最后面
+    def add_rule(self, rule, table=None, chain_str=None, rule_list=None, wrap=True, defer_apply=False,
+                 top=True):
         chain_name = (self._get_chain_name() if self.chain_uid else chain_str)
         if '$' in rule:
             rule = ' '.join(
                 self._wrap_target_chain(e, wrap) for e in rule.split(' '))
 
-        (rule_list if not self.table else self.rules).append(IptablesRule(chain_name, rule, wrap))
+        (rule_list if not self.table else self.rules).append(IptablesRule(chain_name, rule, wrap, top))
         if not defer_apply:
             self.iptables_apply(table)
 
-    def remove_rule(self, rule):
-        self.remove_rules.append(rule)
+    def remove_rule(self, rule, wrap=True):
+        if '$' in rule:
+            rule = ' '.join(
+                self._wrap_target_chain(e, wrap) for e in rule.split(' '))
+        self.remove_rules.append(IptablesRule(self._get_chain_name(), rule, wrap))
         self.iptables_apply(self.table)
 
     def _wrap_target_chain(self, s, wrap):
@@ -127,13 +517,84 @@ class IptablesManager(object):
     # 应用规则
     def iptables_apply(self, table=None, obj=None):
         table = (table if table else self.table)
+        # inside a transaction the changes are written by its commit()
+        if self.transaction:
+            return
+        self.apply_tables({table: (obj if obj else self.ipv4[table])})
+
+    # apply the pending changes of several tables with one iptables-restore
+    # pending_tables: {table name: IptablesTable}
+    # return False if iptables-restore failed, the pending changes are kept and
+    # written again by the next apply
+    def apply_tables(self, pending_tables):
+        if self.apply_mode == 'full':
+            ok = True
+            for table, pending in sorted(pending_tables.items()):
+                invalidate_table_model(table, self.namespace)
+                if self._full_apply(table, pending):
+                    self._clear_pending(pending)
+                else:
+                    ok = False
+            return ok
+
+        models = []
+        for table in sorted(pending_tables):
+            model = get_table_model(table, self.namespace)
+            if model:
+                models.append((model, pending_tables[table]))
+        for model, pending in models:
+            model.lock.acquire()
+        # 'chains' mode flushes and rebuilds the changed chains we own
+        rebuild_prefix = (self.wrap_name + '-'
+                          if self.apply_mode == 'chains' else None)
+        ok = len(models) == len(pending_tables)
+        applied = []
+        try:
+            lines = []
+            for model, pending in models:
+                before = model.update(pending.chains, pending.rules,
+                                      pending.remove_chains, pending.remove_rules)
+                lines += model.delta_lines(before, rebuild_prefix)
+            if lines:
+                args = ['iptables-restore', '--noflush']
+                if self.namespace:
+                    args = ['ip', 'netns', 'exec', self.namespace] + args
+                try:
+                    self.execute(args, process_input='\n'.join(lines) + '\n')
+                    print("IPTablesManager.apply completed with success")
+                except Exception as e:
+                    # the kernel no longer matches the models, reload them next time;
+                    # the changes stay pending, update() skips what is already there
+                    for model, pending in models:
+                        invalidate_table_model(model.name, self.namespace)
+                    print(e)
+                    LogExceptionHelp.logException(u"IPTablesManager.apply error. msg: {}".format(e))
+                    return False
+            applied = [pending for model, pending in models]
+        finally:
+            for model, pending in models:
+                model.lock.release()
+        for pending in applied:
+            self._clear_pending(pending)
+        return ok
+
+    def _clear_pending(self, pending):
+        pending.chains.clear()
+        pending.remove_chains.clear()
+        del pending.rules[:]
+        del pending.remove_rules[:]
+
+    # save the whole table, modify it and restore it
+    def _full_apply(self, table, obj=None):
         s = [('iptables', table)]
         for cmd, table in s:
             args = ['%s-save' % (cmd,), '-c']
             if self.namespace:
                 args = ['ip', 'netns', 'exec', self.namespace] + args
-            all_tables = utils.execute(args)[1]
-            all_lines = all_tables.split('\n')
+            ret = utils.execute(args)
+            if not ret:
+                return False
+            all_lines = ret[1].split('\n')
             start, end = self._find_table(all_lines, table)
             all_lines[start:end] = self._modify_rules(
                 all_lines[start:end], obj)
@@ -148,6 +609,8 @@ class IptablesManager(object):
             except Exception as e:
                 print(e)
                 LogExceptionHelp.logException(u"IPTablesManager.apply error. msg: {}".format(e))
+                return False
+        return True
 
     def _find_table(self, lines, table_name):
         try:
@@ -176,12 +639,6 @@ class IptablesManager(object):
 
         return rules_index
 
-    def _find_last_entry(self, filter_list, match_str):
-        for s in reversed(filter_list):
-            s = s.strip()
-            if match_str in s:
-                return s
-
     def _get_all_rules(self, current_lines, chain_str, ):
         rules_index = self._find_rules_index(current_lines)
         rules = [s for s in current_lines[rules_index:-1] if chain_str in s]
@@ -198,51 +655,75 @@ class IptablesManager(object):
         current_lines = [s for s in current_lines if chain not in s.strip() and s.startswith('[')]
         return current_lines
 
+    # index a saved table in one pass
+    # return ({chain name: policy}, set of rule texts without counters)
+    def _index_lines(self, current_lines):
+        chains = {}
+        rules = set()
+        for line in current_lines:
+            if line.startswith(':'):
+                tokens = line[1:].split()
+                chains[tokens[0]] = (tokens[1] if len(tokens) > 1 else '-')
+            elif line.startswith('['):
+                rules.add(_normalize_rule(line.split(' ', 1)[1]))
+            elif line.startswith('-A '):
+                rules.add(_normalize_rule(line))
+        return chains, rules
+
     def _modify_rules(self, current_lines, obj=None):
-        chains = sorted((self.chains if self.table else obj.chains))
-        remove_chains = (self.remove_chains if self.table else obj.remove_chains)
-        rules = (self.rules if self.table else obj.rules)
-        remove_rules = (self.remove_rules if self.table else obj.remove_chains)
+        pending = (obj if obj else self.ipv4[self.table])
+        chains, rule_index = self._index_lines(current_lines)
         new_filter = current_lines
 
-        if chains:
-            our_chains = []
-            for chain in chains:
-                chain_str = str(chain).strip()
-                dup = self._find_last_entry(new_filter, chain_str)
-
-                if not dup:
-                    # add-on the [packet:bytes]
-                    chain_str = ':' + chain_str + ' - [0:0]'
-                else:
-                    LogExceptionHelp.logException("chain {} is already exist".format(chain))
-                    continue
-
-                our_chains += [chain_str]
+        our_chains = []
+        for chain in sorted(pending.chains):
+            chain_str = str(chain).strip()
+            if chain_str in chains:
+                LogExceptionHelp.logException("chain {} is already exist".format(chain))
+                continue
+            chains[chain_str] = '-'
+            # add-on the [packet:bytes]
+            our_chains.append(':' + chain_str + ' - [0:0]')
+        if our_chains:
             rules_index = self._find_rules_index(new_filter)
             new_filter[rules_index:rules_index] = our_chains
 
-        if rules:
-            our_rules = []
-            for rule in rules:
-                rule_str = str(rule).strip()
-                dup = [s for s in new_filter if rule_str in s.strip()]
-                if not dup:
-                    rule_str = '[0:0] ' + rule_str
-                else:
-                    LogExceptionHelp.logException("rule {} is already exist".format(rule))
-                our_rules += [rule_str]
+        our_rules = []
+        our_bottom_rules = []
+        for rule in pending.rules:
+            rule_str = _normalize_rule(rule)
+            if rule_str in rule_index:
+                LogExceptionHelp.logException("rule {} is already exist".format(rule))
+                continue
+            rule_index.add(rule_str)
+            (our_rules if rule.top else our_bottom_rules).append('[0:0] ' + rule_str)
+        if our_rules:
             rules_index = self._find_rules_index(new_filter)
             new_filter[rules_index:rules_index] = our_rules
-
-        if remove_chains:
-            for remove_chain in remove_chains:
-                remove_chain = str(remove_chain).strip()
-                new_filter = [s for s in new_filter if remove_chain not in s.strip()]
-
-        if remove_rules:
-            for remove_rule in remove_rules:
-                remove_rule = str(remove_rule).strip()
-                new_filter = [s for s in new_filter if remove_rule not in s.strip()]
-
-        return new_filter
+        if our_bottom_rules and 'COMMIT' in new_filter:
+            # after every existing rule, just before COMMIT
+            commit_index = len(new_filter) - 1 - new_filter[::-1].index('COMMIT')
+            new_filter[commit_index:commit_index] = our_bottom_rules
+
+        remove_chains = set(str(c).strip() for c in pending.remove_chains
+                            if chains.get(str(c).strip()) == '-')
+        remove_rules = set(_normalize_rule(r) for r in pending.remove_rules)
+        if not (remove_chains or remove_rules):
+            return new_filter
+
+        # drop the removed chains, their rules, the rules jumping to them
+        # and the removed rules, all matched exactly, in a single pass
+        kept = []
+        for line in new_filter:
+            if line.startswith(':'):
+                if line[1:].split(' ', 1)[0] in remove_chains:
+                    continue
+            elif line.startswith('[') or line.startswith('-A '):
+                rule_str = _normalize_rule(
+                    line.split(' ', 1)[1] if line.startswith('[') else line)
+                if (rule_str in remove_rules or
+                        _rule_chain(rule_str) in remove_chains or
+                        _rule_target(rule_str) in remove_chains):
+                    continue
+            kept.append(line)
+        return kept
@@ -12,11 +12,17 @@ BRIDGE_FS = "/sys/class/net/"
 # brname: a linux bridge name
 
 
-class LinuxBridgeManager(object):
+class LinuxBridgeManager(utils.GreenThreadMixin):
     def __init__(self, brname):
         self.name = brname
 
+    # whether the bridge exists
+    def exists(self):
+        return os.path.exists(os.path.join(BRIDGE_FS, self.name, 'bridge'))
+
     def create_br(self):
+        if self.exists():
+            return
         cmd = [
             'brctl',
             'addbr',
@@ -34,6 +40,8 @@ class LinuxBridgeManager(object):
 
     # note: the port must be exist
     def add_port(self, port):
+        if self.get_interface_bridge(port) == self.name:
+            return
         cmd = [
             'brctl',
             'addif',
@@ -59,6 +67,21 @@ class LinuxBridgeManager(object):
                 return True
         return False
 
+    # the bridge the interface is attached to, None if there is none
+    def get_interface_bridge(self, interface):
+        try:
+            return os.path.basename(os.readlink(
+                os.path.join(BRIDGE_FS, interface, 'brport', 'bridge')))
+        except OSError:
+            return None
+
+    # interfaces attached to the bridge
+    def get_interfaces(self):
+        try:
+            return os.listdir(os.path.join(BRIDGE_FS, self.name, 'brif'))
+        except OSError:
+            return []
+
     def get_all_bridges(self):
         neutron_bridge_list = []
         bridge_list = os.listdir(BRIDGE_FS)
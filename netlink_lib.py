@@ -0,0 +1,485 @@
+# encoding=utf-8
+
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import os
+import socket
+import struct
+from eventlet import semaphore
+from LogException import *
+from config import *
+
+NETLINK_ROUTE = 0
+
+# message types
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_SETLINK = 19
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+# message flags
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+# link attributes
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_LINK = 5
+IFLA_MASTER = 10
+IFLA_OPERSTATE = 16
+IFLA_LINKINFO = 18
+IFLA_NET_NS_FD = 28
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+IFF_UP = 0x1
+OPERSTATES = ['unknown', 'notpresent', 'down', 'lowerlayerdown',
+              'testing', 'dormant', 'up']
+
+# address attributes
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+
+# route attributes
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_PREFSRC = 7
+RTA_TABLE = 15
+RTPROT_BOOT = 3
+RTN_UNICAST = 1
+RT_TABLE_MAIN = 254
+RT_TABLES = {'default': 253, 'main': 254, 'local': 255}
+RT_SCOPES = {'universe': 0, 'site': 200, 'link': 253, 'host': 254, 'nowhere': 255}
+
+NLMSGHDR = struct.Struct('=IHHII')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+RTMSG = struct.Struct('=BBBBBBBBI')
+RTATTR = struct.Struct('=HH')
+NLA_TYPE_MASK = 0x3fff
+
+CLONE_NEWNET = 0x40000000
+NETNS_RUN_DIR = '/var/run/netns'
+RECV_BUFFER = 1 << 18
+
+
+class NetlinkError(Exception):
+    def __init__(self, code, msg=None):
+        self.code = code
+        super(NetlinkError, self).__init__(
+            "[Errno {}] {}".format(code, msg or os.strerror(code)))
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _attr(attr_type, payload):
+    length = RTATTR.size + len(payload)
+    return RTATTR.pack(length, attr_type) + payload + '\0' * (_align(length) - length)
+
+
+def _attr_str(attr_type, value):
+    return _attr(attr_type, value + '\0')
+
+
+def _attr_u32(attr_type, value):
+    return _attr(attr_type, struct.pack('=I', value))
+
+
+def _parse_attrs(data, offset=0):
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type & NLA_TYPE_MASK] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _str(payload):
+    return payload.split('\0', 1)[0]
+
+
+def _u32(payload):
+    return struct.unpack('=I', payload[:4])[0]
+
+
+def _family(ip):
+    return socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+
+# 'a.b.c.d/n' or 'default' -> (family, address bytes, prefix length)
+def _parse_cidr(cidr):
+    if cidr == 'default':
+        return socket.AF_INET, None, 0
+    ip, _, prefix = cidr.partition('/')
+    family = _family(ip)
+    if not prefix:
+        prefix = 128 if family == socket.AF_INET6 else 32
+    return family, socket.inet_pton(family, ip), int(prefix)
+
+
+def _table(table):
+    if table is None:
+        return RT_TABLE_MAIN
+    return RT_TABLES.get(table) or int(table)
+
+
+_libc = None
+
+
+def _setns(fd):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if _libc.setns(fd, CLONE_NEWNET) != 0:
+        code = ctypes.get_errno()
+        raise NetlinkError(code, "setns: {}".format(os.strerror(code)))
+
+
+# 打开一个netlink连接, namespace不为空时连接属于该命名空间
+# 连接创建后就固定在该命名空间, 当前线程马上切回原来的命名空间
+def _open_socket(namespace=None):
+    if not namespace:
+        return _new_socket()
+    own = open('/proc/self/ns/net')
+    try:
+        try:
+            target = open(os.path.join(NETNS_RUN_DIR, namespace))
+        except IOError as e:
+            raise NetlinkError(e.errno or errno.ENOENT,
+                               "namespace {}: {}".format(namespace, e.strerror))
+        try:
+            _setns(target.fileno())
+            try:
+                return _new_socket()
+            finally:
+                _setns(own.fileno())
+        finally:
+            target.close()
+    finally:
+        own.close()
+
+
+def _new_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, 0))
+    return sock
+
+
+# 命名空间文件的fd, 用于把接口移到该命名空间
+class _NetnsFd(object):
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.file = None
+
+    def __enter__(self):
+        if self.namespace:
+            try:
+                self.file = open(os.path.join(NETNS_RUN_DIR, self.namespace))
+            except IOError as e:
+                raise NetlinkError(e.errno or errno.ENOENT,
+                                   "namespace {}: {}".format(self.namespace, e.strerror))
+            return self.file.fileno()
+        return None
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.file:
+            self.file.close()
+
+
+# this class is outside API
+# 用rtnetlink直接操作一个命名空间中的接口、地址和路由
+class IpRoute(object):
+    """rtnetlink link, address and route operations for one namespace.
+
+    Each change is one request on a kept AF_NETLINK socket and raises
+    NetlinkError when the kernel rejects it. Dumps return lists of dicts.
+    """
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace
+        self.sock = None
+        self.lock = semaphore.Semaphore()
+        self._seq = itertools.count(1)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+    # send one request, return [(type, payload), ...] of the replies
+    def request(self, msg_type, body, flags=NLM_F_ACK):
+        with self.lock:
+            if self.sock is None:
+                self.sock = _open_socket(self.namespace)
+            seq = next(self._seq)
+            self.sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(body), msg_type,
+                                         flags | NLM_F_REQUEST, seq, 0) + body)
+            replies = []
+            while True:
+                data = self.sock.recv(RECV_BUFFER)
+                offset = 0
+                while offset + NLMSGHDR.size <= len(data):
+                    length, reply_type, reply_flags, reply_seq, _ = \
+                        NLMSGHDR.unpack_from(data, offset)
+                    payload = data[offset + NLMSGHDR.size:offset + length]
+                    offset += _align(length)
+                    if reply_seq != seq:
+                        continue
+                    if reply_type == NLMSG_DONE:
+                        return replies
+                    if reply_type == NLMSG_ERROR:
+                        code = -struct.unpack_from('=i', payload)[0]
+                        if code:
+                            raise NetlinkError(code)
+                        return replies
+                    replies.append((reply_type, payload))
+                    if not (reply_flags & NLM_F_MULTI) and not (flags & NLM_F_ACK):
+                        return replies
+
+    def _dump(self, msg_type, body):
+        return self.request(msg_type, body, NLM_F_DUMP)
+
+    # ---- links ----
+
+    # return the interface index, None if there is no such interface
+    def link_lookup(self, name):
+        try:
+            replies = self.request(RTM_GETLINK, IFINFOMSG.pack(0, 0, 0, 0, 0) +
+                                   _attr_str(IFLA_IFNAME, name))
+        except NetlinkError as e:
+            if e.code == errno.ENODEV:
+                return None
+            raise
+        for _, payload in replies:
+            return IFINFOMSG.unpack_from(payload)[2]
+        return None
+
+    def _index(self, name):
+        index = self.link_lookup(name)
+        if index is None:
+            raise NetlinkError(errno.ENODEV, "Cannot find device {}".format(name))
+        return index
+
+    # kind: 'veth', 'bridge', 'dummy'...
+    # peer/peer_namespace: the other end of a veth pair
+    def link_add(self, name, kind, peer=None, peer_namespace=None):
+        with _NetnsFd(peer_namespace) as peer_fd:
+            info = _attr_str(IFLA_INFO_KIND, kind)
+            if kind == 'veth' and peer:
+                peer_msg = IFINFOMSG.pack(0, 0, 0, 0, 0) + _attr_str(IFLA_IFNAME, peer)
+                if peer_fd is not None:
+                    peer_msg += _attr_u32(IFLA_NET_NS_FD, peer_fd)
+                info += _attr(IFLA_INFO_DATA, _attr(VETH_INFO_PEER, peer_msg))
+            body = (IFINFOMSG.pack(0, 0, 0, 0, 0) + _attr_str(IFLA_IFNAME, name) +
+                    _attr(IFLA_LINKINFO, info))
+            self.request(RTM_NEWLINK, body, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL)
+
+    def link_del(self, name):
+        self.request(RTM_DELLINK, IFINFOMSG.pack(0, 0, 0, 0, 0) +
+                     _attr_str(IFLA_IFNAME, name))
+
+    # up: True/False sets the link state, namespace moves the link,
+    # master enslaves it to a bridge
+    def link_set(self, name, up=None, namespace=None, mtu=None, master=None):
+        flags = change = 0
+        if up is not None:
+            change = IFF_UP
+            flags = IFF_UP if up else 0
+        with _NetnsFd(namespace) as ns_fd:
+            body = IFINFOMSG.pack(0, 0, 0, flags, change) + _attr_str(IFLA_IFNAME, name)
+            if ns_fd is not None:
+                body += _attr_u32(IFLA_NET_NS_FD, ns_fd)
+            if mtu:
+                body += _attr_u32(IFLA_MTU, mtu)
+            if master:
+                body += _attr_u32(IFLA_MASTER, self._index(master))
+            self.request(RTM_SETLINK, body)
+
+    # return [{'index', 'name', 'up', 'state', 'mtu', 'address', 'kind', 'master', 'link'}]
+    def links(self):
+        links = []
+        for msg_type, payload in self._dump(RTM_GETLINK, IFINFOMSG.pack(0, 0, 0, 0, 0)):
+            if msg_type != RTM_NEWLINK:
+                continue
+            _, _, index, flags, _ = IFINFOMSG.unpack_from(payload)
+            attrs = _parse_attrs(payload, IFINFOMSG.size)
+            info = _parse_attrs(attrs.get(IFLA_LINKINFO, ''))
+            operstate = ord(attrs[IFLA_OPERSTATE][0]) if IFLA_OPERSTATE in attrs else 0
+            links.append({
+                'index': index,
+                'name': _str(attrs.get(IFLA_IFNAME, '')),
+                'up': bool(flags & IFF_UP),
+                'state': (OPERSTATES[operstate] if operstate < len(OPERSTATES)
+                          else 'unknown'),
+                'mtu': _u32(attrs[IFLA_MTU]) if IFLA_MTU in attrs else None,
+                'address': ':'.join('%02x' % ord(c) for c in attrs.get(IFLA_ADDRESS, '')),
+                'kind': _str(info[IFLA_INFO_KIND]) if IFLA_INFO_KIND in info else None,
+                'master': _u32(attrs[IFLA_MASTER]) if IFLA_MASTER in attrs else None,
+                'link': _u32(attrs[IFLA_LINK]) if IFLA_LINK in attrs else None,
+            })
+        return links
+
+    def _names(self):
+        return dict((link['index'], link['name']) for link in self.links())
+
+    # ---- addresses ----
+
+    def _addr_request(self, msg_type, name, cidr, flags):
+        family, address, prefix = _parse_cidr(cidr)
+        body = (IFADDRMSG.pack(family, prefix, 0, 0, self._index(name)) +
+                _attr(IFA_LOCAL, address) + _attr(IFA_ADDRESS, address))
+        self.request(msg_type, body, flags)
+
+    # cidr like 1.1.1.1/24
+    def addr_add(self, name, cidr):
+        self._addr_request(RTM_NEWADDR, name, cidr, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL)
+
+    def addr_del(self, name, cidr):
+        self._addr_request(RTM_DELADDR, name, cidr, NLM_F_ACK)
+
+    # return [{'index', 'name', 'family', 'address', 'prefixlen', 'scope', 'label'}]
+    # name: only the addresses of this interface
+    def addrs(self, name=None):
+        index = self._index(name) if name else None
+        names = self._names()
+        addrs = []
+        for msg_type, payload in self._dump(RTM_GETADDR, IFADDRMSG.pack(0, 0, 0, 0, 0)):
+            if msg_type != RTM_NEWADDR:
+                continue
+            family, prefix, _, scope, addr_index = IFADDRMSG.unpack_from(payload)
+            if index is not None and addr_index != index:
+                continue
+            attrs = _parse_attrs(payload, IFADDRMSG.size)
+            address = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+            addrs.append({
+                'index': addr_index,
+                'name': names.get(addr_index),
+                'family': family,
+                'address': socket.inet_ntop(family, address) if address else None,
+                'prefixlen': prefix,
+                'scope': scope,
+                'label': _str(attrs[IFA_LABEL]) if IFA_LABEL in attrs else None,
+            })
+        return addrs
+
+    # delete every address of the interface
+    def addr_flush(self, name):
+        for addr in self.addrs(name):
+            if addr['address']:
+                self.addr_del(name, '%s/%d' % (addr['address'], addr['prefixlen']))
+
+    # ---- routes ----
+
+    def _route_body(self, cidr, gateway, dev, scope, table, metric, delete=False):
+        family, dst, dst_len = _parse_cidr(cidr)
+        table = _table(table)
+        if delete:
+            scope_id = RT_SCOPES['nowhere']
+        elif scope:
+            scope_id = RT_SCOPES.get(scope, scope)
+        else:
+            scope_id = RT_SCOPES['universe'] if gateway else RT_SCOPES['link']
+        body = RTMSG.pack(family, dst_len, 0, 0, table if table < 256 else 0,
+                          0 if delete else RTPROT_BOOT, scope_id,
+                          0 if delete else RTN_UNICAST, 0)
+        body += _attr_u32(RTA_TABLE, table)
+        if dst:
+            body += _attr(RTA_DST, dst)
+        if gateway:
+            body += _attr(RTA_GATEWAY, socket.inet_pton(family, gateway))
+        if dev:
+            body += _attr_u32(RTA_OIF, self._index(dev))
+        if metric:
+            body += _attr_u32(RTA_PRIORITY, int(metric))
+        return body
+
+    # cidr like 5.5.5.0/24 or 'default'
+    def route_replace(self, cidr, gateway=None, dev=None, scope=None,
+                      table=None, metric=None):
+        self.request(RTM_NEWROUTE,
+                     self._route_body(cidr, gateway, dev, scope, table, metric),
+                     NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE)
+
+    def route_del(self, cidr, gateway=None, dev=None, table=None, metric=None):
+        self.request(RTM_DELROUTE,
+                     self._route_body(cidr, gateway, dev, None, table, metric, True))
+
+    # return [{'dst', 'gateway', 'dev', 'metric', 'scope', 'table', 'protocol', 'prefsrc'}]
+    # dev/scope/table filter the routes, table None is the main table
+    def routes(self, dev=None, scope=None, table=None, family=socket.AF_INET):
+        table = _table(table)
+        scope = RT_SCOPES.get(scope, scope)
+        names = self._names()
+        routes = []
+        for msg_type, payload in self._dump(RTM_GETROUTE,
+                                            RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0)):
+            if msg_type != RTM_NEWROUTE:
+                continue
+            (route_family, dst_len, _, _, route_table, protocol,
+             route_scope, _, _) = RTMSG.unpack_from(payload)
+            attrs = _parse_attrs(payload, RTMSG.size)
+            if RTA_TABLE in attrs:
+                route_table = _u32(attrs[RTA_TABLE])
+            oif = _u32(attrs[RTA_OIF]) if RTA_OIF in attrs else None
+            if route_table != table or (scope is not None and route_scope != scope):
+                continue
+            if dev and names.get(oif) != dev:
+                continue
+            if RTA_DST in attrs:
+                dst = '%s/%d' % (socket.inet_ntop(route_family, attrs[RTA_DST]), dst_len)
+            else:
+                dst = 'default'
+            routes.append({
+                'dst': dst,
+                'gateway': (socket.inet_ntop(route_family, attrs[RTA_GATEWAY])
+                            if RTA_GATEWAY in attrs else None),
+                'dev': names.get(oif),
+                'metric': _u32(attrs[RTA_PRIORITY]) if RTA_PRIORITY in attrs else None,
+                'scope': route_scope,
+                'table': route_table,
+                'protocol': protocol,
+                'prefsrc': (socket.inet_ntop(route_family, attrs[RTA_PREFSRC])
+                            if RTA_PREFSRC in attrs else None),
+            })
+        return routes
+
+
+_iproutes = {}
+
+
+# 每个命名空间一个netlink连接
+def get_iproute(namespace=None):
+    iproute = _iproutes.get(namespace)
+    if iproute is None:
+        iproute = _iproutes[namespace] = IpRoute(namespace)
+    return iproute
+
+
+# 命名空间被删除时关闭它的连接
+def forget_iproute(namespace):
+    iproute = _iproutes.pop(namespace, None)
+    if iproute:
+        iproute.close()
@@ -0,0 +1,108 @@
+# encoding=utf-8
+
+# 固定在一个网络命名空间中的工作进程, 由utils.NetnsWorker启动
+# python netns_worker.py <namespace>
+# 启动后setns进入该命名空间, 之后从stdin逐行读取JSON请求执行命令,
+# 结果逐行写回stdout. 只切换网络命名空间, 不像ip netns exec那样
+# 重新挂载/sys和/etc/netns/<namespace>中的文件.
+#
+# request:  {"cmd": [...] or "...", "input": str, "shell": bool,
+#            "merge_stderr": bool, "env": {...}, "timeout": seconds}
+# response: {"returncode": n, "stdout": str, "stderr": str, "timed_out": bool}
+# the first line written is {"ready": true} or {"error": msg}
+
+import ctypes
+import ctypes.util
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+CLONE_NEWNET = 0x40000000
+NETNS_RUN_DIR = '/var/run/netns'
+# command output is passed through JSON without losing bytes
+ENCODING = 'latin-1'
+
+
+def _setns(namespace):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    with open(os.path.join(NETNS_RUN_DIR, namespace)) as f:
+        if libc.setns(f.fileno(), CLONE_NEWNET) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+
+def _subprocess_setup():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def _run(request):
+    env = None
+    if request.get('env'):
+        env = os.environ.copy()
+        env.update(request['env'])
+    cmd = request['cmd']
+    if not isinstance(cmd, basestring):
+        cmd = [c.encode('utf-8') if isinstance(c, unicode) else c for c in cmd]
+    elif isinstance(cmd, unicode):
+        cmd = cmd.encode('utf-8')
+    try:
+        obj = subprocess.Popen(
+            cmd, shell=request.get('shell', False), stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=(subprocess.STDOUT if request.get('merge_stderr') else subprocess.PIPE),
+            preexec_fn=_subprocess_setup, close_fds=True, env=env)
+    except OSError as e:
+        return {'returncode': 127, 'stdout': '', 'stderr': str(e), 'timed_out': False}
+    timed_out = []
+    timer = None
+    if request.get('timeout'):
+        def kill():
+            timed_out.append(True)
+            obj.kill()
+        timer = threading.Timer(request['timeout'], kill)
+        timer.start()
+    process_input = request.get('input')
+    if isinstance(process_input, unicode):
+        process_input = process_input.encode(ENCODING)
+    try:
+        _stdout, _stderr = obj.communicate(process_input)
+    finally:
+        if timer:
+            timer.cancel()
+    return {'returncode': obj.returncode,
+            'stdout': (_stdout or '').decode(ENCODING),
+            'stderr': (_stderr or '').decode(ENCODING),
+            'timed_out': bool(timed_out)}
+
+
+def _write(msg):
+    sys.stdout.write(json.dumps(msg) + '\n')
+    sys.stdout.flush()
+
+
+def main(argv):
+    if len(argv) != 2:
+        _write({'error': 'usage: netns_worker.py <namespace>'})
+        return 2
+    try:
+        _setns(argv[1])
+    except (IOError, OSError) as e:
+        _write({'error': 'setns {}: {}'.format(argv[1], e)})
+        return 1
+    _write({'ready': True})
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            response = _run(json.loads(line))
+        except Exception as e:
+            response = {'returncode': 1, 'stdout': '', 'stderr': str(e),
+                        'timed_out': False}
+        _write(response)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
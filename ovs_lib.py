@@ -1,8 +1,15 @@
 # encoding=utf-8
 
+import collections
+import json
+import re
+import time
+from eventlet import semaphore
 from config import *
 import utils
 from LogException import *
+import ip_lib
+from ovsdb_client import get_ovsdb_client, get_ovsdb_cache, OVSDBError, from_ovsdb, _as_list
 
 # Default timeout for ovs-vsctl command
 DEFAULT_OVS_VSCTL_TIMEOUT = 10
@@ -10,13 +17,124 @@ DEFAULT_OVS_VSCTL_TIMEOUT = 10
 # Special return value for an invalid OVS ofport
 INVALID_OFPORT = '-1'
 
+# the master of netdevs attached to the kernel datapath in sysfs
+OVS_DATAPATH_MASTER = 'ovs-system'
+
+# ovs-ofctl reports a bad line of a flow file as '-:<line>: <msg>'
+OFCTL_FLOW_ERROR_RE = re.compile(r'-:(\d+):\s*(.*)')
+
+# dump-flows的输出中不属于匹配条件的字段
+FLOW_STAT_FIELDS = ('duration', 'n_packets', 'n_bytes', 'idle_age', 'hard_age',
+                    'idle_timeout', 'hard_timeout', 'importance', 'send_flow_rem',
+                    'reset_counts', 'no_packet_counts', 'no_byte_counts')
+OFPP_DEFAULT_PRIORITY = '32768'
+
+# dump-flows把dl_type/nw_proto显示成协议简写, {(dl_type, nw_proto): 简写}
+FLOW_PROTO_SHORTCUTS = {
+    (0x0800, None): 'ip', (0x0800, 1): 'icmp', (0x0800, 6): 'tcp',
+    (0x0800, 17): 'udp', (0x0800, 132): 'sctp',
+    (0x86dd, None): 'ipv6', (0x86dd, 58): 'icmp6', (0x86dd, 6): 'tcp6',
+    (0x86dd, 17): 'udp6', (0x86dd, 132): 'sctp6',
+    (0x0806, None): 'arp', (0x8035, None): 'rarp',
+}
+FLOW_PROTO_FIELDS = dict((v, k) for k, v in FLOW_PROTO_SHORTCUTS.items())
+
+# dump-flows中一条流策略的精简记录, match是逗号分隔的匹配条件
+# get_all_port_stats读取的Interface列
+PORT_STATS_COLUMNS = ['name', 'statistics', 'ofport', 'admin_state', 'link_state']
+
+# {br_name: (time, stats)}, 同一个桥的并发调用共用一次查询
+_port_stats_cache = {}
+_port_stats_locks = collections.defaultdict(semaphore.Semaphore)
+
+FlowRecord = collections.namedtuple(
+    'FlowRecord', ['cookie', 'table', 'priority', 'match', 'actions',
+                   'n_packets', 'n_bytes', 'idle_age'])
+
+
+# 把多条ovs-vsctl命令用'--'连接成一次调用，一次OVSDB提交
+# with ovs.transaction() as txn:
+#     txn.add_port('qvo-1', tag=10)
+#     txn.del_port('qvo-2')
+class OVSTransaction(object):
+    def __init__(self, ovs):
+        self.ovs = ovs
+        self.commands = []
+
+    def add_command(self, *args):
+        self.commands.append(list(args))
+        return self
+
+    def add_port(self, port_name, tag=None, br_name=None):
+        self.add_command('--may-exist', 'add-port', br_name or self.ovs.br_name, port_name)
+        # --may-exist ignores column settings when the port is already there
+        if tag:
+            self.set_port_tag(port_name, tag)
+        return self
+
+    def add_port_internal(self, port_name, vlan=None, br_name=None):
+        self.add_port(port_name, vlan, br_name)
+        return self.set_interface_type(port_name, 'internal')
+
+    def set_port_tag(self, port_name, tag):
+        return self.add_command('set', 'port', port_name, 'tag=%d' % int(tag))
+
+    def set_interface_type(self, port_name, interface_type):
+        return self.add_command('set', 'interface', port_name,
+                                'type=%s' % interface_type)
+
+    def del_port(self, port_name, br_name=None):
+        return self.add_command('--if-exists', 'del-port',
+                                br_name or self.ovs.br_name, port_name)
+
+    # 添加数据镜像，镜像所有报文到vlan
+    def add_mirror(self, vlan=Mirror_vlan, name='mymirror', br_name=None):
+        self.add_command('--id=@m', 'create', 'mirror', 'name=%s' % name,
+                         'select_all=true', 'output_vlan=%d' % vlan)
+        return self.add_command('add', 'bridge', br_name or self.ovs.br_name,
+                                'mirrors', '@m')
+
+    def clear_mirrors(self, br_name=None):
+        return self.add_command('clear', 'Bridge', br_name or self.ovs.br_name,
+                                'mirrors')
+
+    def commit(self):
+        commands, self.commands = self.commands, []
+        if not commands:
+            return
+        args = []
+        for cmd in commands:
+            args += ['--'] + cmd
+        return self.ovs.run_vsctl(args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not exc_type:
+            self.commit()
+
 
 # this class is outside API
 # br_name: ovs bridge's name
-class BaseOVS(object):
-    def __init__(self, br_name=None):
+# ovsdb_interface: 'vsctl' or 'native', default OVSDB_INTERFACE
+# cookie: 添加的流策略都带上这个cookie, 用于区分哪些流策略是自己的
+class BaseOVS(utils.GreenThreadMixin):
+    def __init__(self, br_name=None, ovsdb_interface=None, cookie=OVS_FLOW_COOKIE):
         self.vsctl_timeout = ovs_vsctl_timeout
         self.br_name = br_name
+        self.ovsdb_interface = ovsdb_interface or OVSDB_INTERFACE
+        self.cookie = cookie
+
+    # 开启OVSDB_MONITOR时返回内存中的OVSDB缓存，否则返回None
+    def _cache(self):
+        return _monitor_cache()
+
+    # native接口返回共享的OVSDB连接，否则返回None
+    def _ovsdb(self):
+        if self.ovsdb_interface == 'native':
+            return get_ovsdb_client()
+        return None
 
     # 执行ovs-vsctl命令的前缀
     def run_vsctl(self, args):
@@ -39,6 +157,15 @@ class BaseOVS(object):
 
     # 检查OVS桥是否存在
     def bridge_exists(self, bridge_name):
+        cache = self._cache()
+        if cache and cache.synced:
+            return cache.bridge_exists(bridge_name)
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                return ovsdb.record_exists('Bridge', bridge_name)
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
         ret = self.run_vsctl(['br-exists', bridge_name])
         if ret[0]:
             print("No search bridge name '{}'".format(bridge_name))
@@ -47,6 +174,9 @@ class BaseOVS(object):
 
     # 查找该接口属于哪个OVS桥
     def get_bridge_name_for_port_name(self, port_name):
+        cache = self._cache()
+        if cache and cache.synced:
+            return cache.port_bridge(port_name)
         ret = self.run_vsctl(['port-to-br', port_name])
         if ret[0]:
             print("No search port's bridge".format(port_name))
@@ -55,12 +185,28 @@ class BaseOVS(object):
 
     # 检查OVS桥中是否存在该端口
     def port_exists(self, port_name):
+        # a kernel datapath port is enslaved to ovs-system
+        if ip_lib.device_master(port_name) == OVS_DATAPATH_MASTER:
+            return True
+        cache = self._cache()
+        if cache and cache.synced:
+            return cache.port_exists(port_name)
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                return ovsdb.record_exists('Port', port_name)
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
         return bool(self.get_bridge_name_for_port_name(port_name))
 
+    # 开始一个ovs-vsctl事务，多条命令一次提交
+    def transaction(self):
+        return OVSTransaction(self)
+
     # 添加一个端口
-    def add_port(self, port_name):
-        self.run_vsctl(["--", "--may-exist", "add-port", self.br_name,
-                        port_name])
+    # tag: 端口的vlan tag，与添加端口在同一次提交中设置
+    def add_port(self, port_name, tag=None):
+        return self.transaction().add_port(port_name, tag).commit()
 
     # 添加一个内部接口
     def add_port_internal(self, port, vlan=None):
@@ -77,11 +223,11 @@ class BaseOVS(object):
         if vlan:
             cmd.insert(3, "tag={}".format(vlan))
 
-        self.run_vsctl(cmd)
+        return self.run_vsctl(cmd)
 
     # 删除一个端口
     def delete_port(self, port_name):
-        self.run_vsctl(["--", "--if-exists", "del-port", self.br_name,
+        return self.run_vsctl(["--", "--if-exists", "del-port", self.br_name,
                         port_name])
 
     # 执行ofctl的前缀命令
@@ -93,19 +239,119 @@ class BaseOVS(object):
         return ret
 
     # 统计有多少条流策略
-    def count_flows(self):
-        ret = self.run_ofctl("dump-flows", [])
-        state_code, result = ret
-        if state_code:
-            LogExceptionHelp.logException("exec command Error msg: {}".format(result))
+    # filters: 与iter_flows的参数相同
+    def count_flows(self, **filters):
+        try:
+            return sum(1 for _ in self.iter_flows(**filters))
+        except RuntimeError:
             return False
-        result = result.split("\n")[1:]
-        return len(result) - 1
+
+    # dump-flows命令, 过滤条件交给ovs-ofctl
+    def _dump_flows_cmd(self, table=None, cookie=None, mask=-1, match=None):
+        filters = []
+        if table is not None:
+            filters.append('table=%s' % table)
+        if cookie is not None and cookie is not False:
+            filters.append(_cookie_match(cookie, mask))
+        if match:
+            filters.append(match)
+        cmd = ["ovs-ofctl", "dump-flows", self.br_name]
+        if filters:
+            cmd.append(','.join(filters))
+        return cmd
+
+    # 逐行读取流表, 整个输出不会读进内存
+    # table/cookie/mask/match交给ovs-ofctl过滤, match like 'ip,in_port=1'
+    # match_prefix: 只返回匹配条件以它开头的流策略
+    # yield FlowRecord, ovs-ofctl失败时抛出RuntimeError
+    def iter_flows(self, table=None, cookie=None, mask=-1, match=None,
+                   match_prefix=None):
+        cmd = self._dump_flows_cmd(table, cookie, mask, match)
+        for line in utils.get_executor().iter_lines(cmd):
+            record = parse_flow_record(line)
+            if record is None:
+                continue
+            if match_prefix and not record.match.startswith(match_prefix):
+                continue
+            yield record
 
     # 删除桥上的所有流策略
     def remove_all_flows(self):
         self.run_ofctl("del-flows", [])
 
+    # 只删除带有自己cookie的流策略
+    def remove_owned_flows(self):
+        self.run_ofctl("del-flows", [_cookie_match(self.cookie)])
+
+    # 读取流表, 按cookie/mask过滤
+    # cookie: 默认只读取自己的流策略, 传入False读取全部
+    # return [{key:value,...}, ...] 与add_flow的参数格式相同
+    def dump_flows(self, cookie=None, mask=-1):
+        if cookie is None:
+            cookie = self.cookie
+        flows = []
+        try:
+            for line in utils.get_executor().iter_lines(
+                    self._dump_flows_cmd(cookie=cookie, mask=mask)):
+                flow = parse_flow(line)
+                if flow:
+                    flows.append(flow)
+        except RuntimeError:
+            LogExceptionHelp.logException("dump flows of {} failed".format(self.br_name))
+            return None
+        return flows
+
+    # 让流表与desired一致, 只下发差异
+    # desired: [{key:value,...}, ...] 与add_flow的参数相同
+    # 只处理带有自己cookie的流策略, 先删除多余的, 再添加缺少的, 最后修改actions不同的
+    # return {'add': n, 'mod': n, 'del': n, 'failed': [(flow, error), ...]}
+    # 没有cookie时无法区分自己的流策略, 不执行
+    def sync_flows(self, desired, bundle=False):
+        if self.cookie is None:
+            msg = "sync flows of {} refused: no cookie to tell owned flows".format(self.br_name)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+            return False
+        current = self.dump_flows()
+        if current is None:
+            return False
+        # dump-flows中in_port是ofport, 把desired中的端口名换成ofport再比较
+        names = set(str(flow['in_port']) for flow in desired
+                    if 'in_port' in flow and not str(flow['in_port']).isdigit())
+        ofports = self.get_port_ofports(sorted(names)) if names else {}
+        current = dict((_flow_key(flow), flow) for flow in current)
+        wanted = dict((_flow_key(flow, ofports), flow) for flow in desired)
+
+        to_del = [_flow_strict_match(flow, self.cookie)
+                  for key, flow in current.items() if key not in wanted]
+        to_add = [flow for key, flow in wanted.items() if key not in current]
+        to_mod = []
+        for key, flow in wanted.items():
+            if key in current and (_normalize_actions(flow.get('actions')) !=
+                                   _normalize_actions(current[key].get('actions'))):
+                flow = dict(flow)
+                if self.cookie is not None:
+                    flow['cookie'] = '%#x/-1' % self.cookie
+                to_mod.append(flow)
+
+        failed = []
+        if to_del:
+            failed += self.do_action_flows_bulk('del', to_del, bundle)
+        if to_add:
+            failed += self.do_action_flows_bulk('add', to_add, bundle)
+        if to_mod:
+            failed += self.do_action_flows_bulk('mod', to_mod, bundle, strict=True)
+        return {'add': len(to_add), 'mod': len(to_mod), 'del': len(to_del),
+                'failed': failed}
+
+    # 添加的流策略带上自己的cookie
+    def _with_cookie(self, flow):
+        if self.cookie is None or 'cookie' in flow:
+            return flow
+        flow = dict(flow)
+        flow['cookie'] = '%#x' % self.cookie
+        return flow
+
     # get port's openflow port id
     def get_port_ofport(self, port_name):
         ofport = self.db_get_val("Interface", port_name, "ofport")
@@ -117,6 +363,19 @@ class BaseOVS(object):
         except (ValueError, TypeError):
             return INVALID_OFPORT
 
+    # 一次查询多个接口的ofport
+    # return {port_name: ofport}
+    def get_port_ofports(self, port_names):
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                values = ovsdb.get_columns('Interface', port_names, 'ofport')
+                return dict((name, _ofport_str(values.get(name)))
+                            for name in port_names)
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
+        return dict((name, self.get_port_ofport(name)) for name in port_names)
+
     # get bridge's datapath id  note: datapath id == bridge id
     def get_datapath_id(self):
         return self.db_get_val('Bridge',
@@ -126,6 +385,8 @@ class BaseOVS(object):
     # action  ：add/mod/del
     # kwargs_list  ： {key:value,key:value.....}
     def do_action_flows(self, action, kwargs_list):
+        if action == 'add':
+            kwargs_list = [self._with_cookie(kw) for kw in kwargs_list]
         flow_strs = [_build_flow_expr_str(kw, action) for kw in kwargs_list]
 
         if action == 'add' or action == 'mod':
@@ -135,6 +396,62 @@ class BaseOVS(object):
             option = '--strict {}-flows'.format(action)
         self.run_ofctl(option, flow_strs)
 
+    # 通过stdin批量下发流策略，整批只启动一个ovs-ofctl进程
+    # action  ：add/mod/del
+    # kwargs_list  ： [{key:value,key:value.....}, ...], 也可以是已经拼好的流策略字符串
+    # bundle: 使用--bundle原子提交，任何一条失败整批都不生效
+    #         不使用时失败那一条之前的流策略已经生效
+    # strict: 默认只有del使用--strict
+    # return [(kwargs, error), ...], kwargs是传入的那一项, 空列表表示全部成功
+    def do_action_flows_bulk(self, action, kwargs_list, bundle=False, strict=None):
+        failed = []
+        flows = []
+        flow_kwargs = []
+        for kw in kwargs_list:
+            if isinstance(kw, basestring):
+                flow_str = kw
+            else:
+                flow = self._with_cookie(kw) if action == 'add' else kw
+                flow_str = _build_flow_expr_str(dict(flow), action)
+            if flow_str is False:
+                failed.append((kw, "no actions"))
+                continue
+            flows.append(flow_str)
+            flow_kwargs.append(kw)
+        if not flows:
+            return failed
+
+        cmd = ["ovs-ofctl"]
+        if bundle:
+            cmd.append("--bundle")
+        if strict or (strict is None and action == 'del'):
+            cmd.append("--strict")
+        cmd += ["{}-flows".format(action), self.br_name, "-"]
+        result = utils.get_executor().run(cmd, process_input='\n'.join(flows) + '\n')
+        if result.succeeded:
+            return failed
+
+        output = (result.stderr or result.stdout or '').strip()
+        LogExceptionHelp.logException("exec command {} Error msg: {}".format(cmd, output))
+        matched = False
+        for line in output.splitlines():
+            m = OFCTL_FLOW_ERROR_RE.search(line)
+            if m and 0 < int(m.group(1)) <= len(flows):
+                failed.append((flow_kwargs[int(m.group(1)) - 1], m.group(2)))
+                matched = True
+        if not matched:
+            # the switch rejected the batch, the failed flow is unknown
+            failed += [(kw, output) for kw in flow_kwargs]
+        return failed
+
+    # 批量添加流策略
+    def add_flows(self, kwargs_list, bundle=False):
+        return self.do_action_flows_bulk('add', kwargs_list, bundle)
+
+    # 批量删除流策略
+    def remove_flows(self, kwargs_list, bundle=False):
+        return self.do_action_flows_bulk('del', kwargs_list, bundle)
+
     # 添加流策略
     # kwargs  ：{key:value,key:value.....}
     def add_flow(self, **kwargs):
@@ -158,6 +475,15 @@ class BaseOVS(object):
         return self.get_port_ofport(local_name)
 
     def db_get_map(self, table, record, column):
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                value = ovsdb.get_column(table, record, column)
+                if not isinstance(value, dict):
+                    return {}
+                return dict((k, _vsctl_str(v)) for k, v in value.items())
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
         state_code, output = self.run_vsctl(["get", table, record, column])
         if state_code:
             return {}
@@ -165,6 +491,15 @@ class BaseOVS(object):
         return self.db_str_to_map(output_str)
 
     def db_get_val(self, table, record, column):
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                value = ovsdb.get_column(table, record, column)
+                if value is None:
+                    return
+                return _vsctl_str(value)
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
         sate_code, output = self.run_vsctl(["get", table, record, column])
         if sate_code:
             return
@@ -182,6 +517,9 @@ class BaseOVS(object):
 
     # 返回桥上的所有接口
     def get_port_name_list(self):
+        cache = self._cache()
+        if cache and cache.synced:
+            return cache.bridge_ports(self.br_name)
         state_code, res = self.run_vsctl(["list-ports", self.br_name])
         if state_code:
             return []
@@ -191,6 +529,95 @@ class BaseOVS(object):
     def get_port_stats(self, port_name):
         return self.db_get_map("Interface", port_name, "statistics")
 
+    # 一次查询桥上所有接口的状态
+    # ttl: 缓存秒数, 默认OVS_STATS_CACHE_TTL, 0不使用缓存
+    # all_bridges: 返回所有桥上的接口
+    # return {port_name: {'statistics': {...}, 'ofport': n, 'admin_state': 'up', 'link_state': 'up'}}
+    #        查询失败返回None
+    def get_all_port_stats(self, ttl=None, all_bridges=False):
+        ttl = OVS_STATS_CACHE_TTL if ttl is None else ttl
+        key = None if all_bridges else self.br_name
+        if not ttl:
+            return self._fetch_port_stats(key)
+        with _port_stats_locks[key]:
+            cached = _port_stats_cache.get(key)
+            if cached and time.time() - cached[0] < ttl:
+                return cached[1]
+            stats = self._fetch_port_stats(key)
+            if stats is not None:
+                _port_stats_cache[key] = (time.time(), stats)
+            return stats
+
+    def _fetch_port_stats(self, br_name):
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                return self._fetch_port_stats_ovsdb(ovsdb, br_name)
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
+        # list Interface and the bridge's ports in one ovs-vsctl call
+        args = ['--format=json', '--columns={}'.format(','.join(PORT_STATS_COLUMNS)),
+                'list', 'Interface']
+        if br_name:
+            args += ['--', 'list-ports', br_name]
+        ret = self.run_vsctl(args)
+        if not ret or ret[0]:
+            return None
+        try:
+            table, end = json.JSONDecoder().raw_decode(ret[1].lstrip())
+        except ValueError as e:
+            LogExceptionHelp.logException("bad ovs-vsctl json output: {}".format(e))
+            return None
+        ports = None
+        if br_name:
+            ports = set(ret[1].lstrip()[end:].split())
+        rows = [dict(zip(table['headings'], [from_ovsdb(v) for v in row]))
+                for row in table['data']]
+        return _port_stats_from_rows(rows, ports)
+
+    def _fetch_port_stats_ovsdb(self, ovsdb, br_name):
+        rows = ovsdb.select('Interface', [], PORT_STATS_COLUMNS)
+        ports = None
+        if br_name:
+            ports = set()
+            for bridge in ovsdb.select('Bridge', [['name', '==', br_name]], ['ports']):
+                port_uuids = set(_as_list(bridge['ports']))
+                ports.update(port['name'] for port in
+                             ovsdb.select('Port', [], ['_uuid', 'name'])
+                             if port['_uuid'] in port_uuids)
+        return _port_stats_from_rows(rows, ports)
+
+    # 一次查询桥上所有端口的vlan tag
+    # return {port_name: tag}, 没有tag的为None, 查询失败返回None
+    def get_port_tags(self):
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                bridges = ovsdb.select('Bridge', [['name', '==', self.br_name]], ['ports'])
+                port_uuids = set(u for bridge in bridges for u in _as_list(bridge['ports']))
+                rows = [port for port in ovsdb.select('Port', [], ['_uuid', 'name', 'tag'])
+                        if port['_uuid'] in port_uuids and port['name'] != self.br_name]
+                return dict((port['name'], _port_tag(port['tag'])) for port in rows)
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
+        # list Port and the bridge's ports in one ovs-vsctl call
+        ret = self.run_vsctl(['--format=json', '--columns=name,tag', 'list', 'Port',
+                              '--', 'list-ports', self.br_name])
+        if not ret or ret[0]:
+            return None
+        try:
+            table, end = json.JSONDecoder().raw_decode(ret[1].lstrip())
+        except ValueError as e:
+            LogExceptionHelp.logException("bad ovs-vsctl json output: {}".format(e))
+            return None
+        ports = set(ret[1].lstrip()[end:].split())
+        tags = {}
+        for row in table['data']:
+            row = dict(zip(table['headings'], [from_ovsdb(v) for v in row]))
+            if row['name'] in ports:
+                tags[row['name']] = _port_tag(row['tag'])
+        return tags
+
     def get_xapi_iface_id(self, xs_vif_uuid):
         args = ["xe", "vif-param-get", "param-name=other-config",
                 "param-key=nicira-iface-id", "uuid=%s" % xs_vif_uuid]
@@ -203,18 +630,20 @@ class BaseOVS(object):
 
     # 设置ovs接口的vlan_tag
     def set_port_tag(self, vlan_tag, port):
+        ovsdb = self._ovsdb()
+        if ovsdb:
+            try:
+                ovsdb.update('Port', port, {'tag': vlan_tag})
+                return
+            except OVSDBError as e:
+                LogExceptionHelp.logException("ovsdb Error msg: {}".format(e))
         args = ['set', 'port', '%s' % port, 'tag=%d' % vlan_tag]
         self.run_vsctl(args)
 
 
     # 添加数据镜像
     def data_mirror(self, vlan=Mirror_vlan):
-        args = ['-- add bridge %s mirrors @m -- --id=@m create mirror name=mymirror' % self.br_name,
-                'set mirror mymirror select_all=1',
-                'set mirror mymirror output_vlan=%d' % vlan
-                ]
-        for arg in args:
-            self.run_vsctl([arg], )
+        self.transaction().add_mirror(vlan).commit()
 
     # 移除数据镜像
     def remove_data_mirror(self):
@@ -233,6 +662,56 @@ class BaseOVS(object):
         return True
 
 
+def _monitor_cache():
+    if OVSDB_MONITOR:
+        return get_ovsdb_cache()
+    return None
+
+
+# ports: 只保留这些接口, None全部保留
+def _port_stats_from_rows(rows, ports=None):
+    stats = {}
+    for row in rows:
+        name = row.get('name')
+        if ports is not None and name not in ports:
+            continue
+        ofport = row.get('ofport')
+        stats[name] = {
+            'statistics': row.get('statistics') or {},
+            'ofport': ofport if isinstance(ofport, int) else int(INVALID_OFPORT),
+            'admin_state': row.get('admin_state') or None,
+            'link_state': row.get('link_state') or None,
+        }
+    return stats
+
+
+# an empty set means the port has no tag
+def _port_tag(value):
+    value = _as_list(value)
+    return int(value[0]) if value else None
+
+
+# 把OVSDB的值格式化成ovs-vsctl get的输出
+def _vsctl_str(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        if len(value) == 1:
+            return _vsctl_str(value[0])
+        return '[{}]'.format(', '.join(_vsctl_str(v) for v in value))
+    if isinstance(value, dict):
+        return '{{{}}}'.format(', '.join(
+            '{}={}'.format(k, _vsctl_str(v)) for k, v in sorted(value.items())))
+    return str(value)
+
+
+def _ofport_str(value):
+    try:
+        return str(int(_vsctl_str(value)))
+    except (ValueError, TypeError):
+        return INVALID_OFPORT
+
+
 # 接口属于哪个桥
 def get_bridge_for_iface(iface):
     args = ["ovs-vsctl", "--timeout=%d" % ovs_vsctl_timeout,
@@ -246,6 +725,9 @@ def get_bridge_for_iface(iface):
 
 # 获取所有的桥
 def get_bridges():
+    cache = _monitor_cache()
+    if cache and cache.synced:
+        return cache.bridges()
     args = ["ovs-vsctl", "--timeout=%d" % ovs_vsctl_timeout,
             "list-br"]
     state_code, ret = utils.execute(args, )
@@ -255,6 +737,126 @@ def get_bridges():
     return ret.strip().split("\n")
 
 
+def _cookie_match(cookie, mask=-1):
+    return 'cookie=%#x/%s' % (cookie, mask if mask == -1 else '%#x' % mask)
+
+
+# 解析dump-flows的一行, 返回与add_flow参数格式相同的dict
+# cookie=0x4e4c, duration=1.2s, table=0, n_packets=0, n_bytes=0, priority=10,ip,in_port=1 actions=drop
+# 匹配条件中不带'='的协议字段(ip/arp/tcp...)放在'proto'中
+def parse_flow(line):
+    parts = _split_flow_line(line)
+    if parts is None:
+        return None
+    meta, match, actions = parts
+    flow = {'actions': actions}
+    for key in ('cookie', 'table', 'priority'):
+        if key in meta:
+            flow[key] = meta[key]
+    for field in match:
+        key, sep, value = field.partition('=')
+        if sep:
+            flow[key] = value
+        else:
+            flow['proto'] = field
+    return flow
+
+
+# 解析dump-flows的一行, 返回FlowRecord, 不是流策略的行返回None
+def parse_flow_record(line):
+    parts = _split_flow_line(line)
+    if parts is None:
+        return None
+    meta, match, actions = parts
+    idle_age = meta.get('idle_age')
+    return FlowRecord(int(meta.get('cookie', '0'), 16),
+                      int(meta.get('table', 0)),
+                      int(meta.get('priority', OFPP_DEFAULT_PRIORITY)),
+                      ','.join(match), actions,
+                      int(meta.get('n_packets', 0)),
+                      int(meta.get('n_bytes', 0)),
+                      int(idle_age) if idle_age is not None else None)
+
+
+# 把dump-flows的一行拆成(元数据字段, 匹配条件字段, actions)
+def _split_flow_line(line):
+    line = line.strip()
+    idx = line.find('actions=')
+    if idx < 0 or (idx and line[idx - 1] not in ' ,'):
+        return None
+    meta = {}
+    match = []
+    for field in line[:idx].replace(' ', '').split(','):
+        if not field:
+            continue
+        key, sep, value = field.partition('=')
+        if sep and (key in FLOW_STAT_FIELDS or key in ('cookie', 'table', 'priority')):
+            meta[key] = value
+        else:
+            match.append(field)
+    return meta, match, line[idx + len('actions='):].strip()
+
+
+# 流策略的标识: table, priority和匹配条件
+# 匹配条件按dump-flows的写法归一: dl_type/nw_proto换成协议简写, in_port端口名换成ofport
+# ofports: {port_name: ofport}
+def _flow_key(flow, ofports=None):
+    match = {}
+    for key, value in flow.items():
+        if key in ('actions', 'cookie', 'table', 'priority') or key in FLOW_STAT_FIELDS:
+            continue
+        match[key] = str(value)
+    _normalize_proto(match)
+    in_port = match.get('in_port')
+    if ofports and in_port in ofports and ofports[in_port] != INVALID_OFPORT:
+        match['in_port'] = ofports[in_port]
+    return (str(flow.get('table', 0)), str(flow.get('priority', OFPP_DEFAULT_PRIORITY)),
+            frozenset(match.items()))
+
+
+# 把match中的proto/dl_type/nw_proto合并成dump-flows显示的协议简写
+def _normalize_proto(match):
+    proto = match.get('proto')
+    dl_type, nw_proto = FLOW_PROTO_FIELDS.get(proto, (None, None))
+    if proto and dl_type is None:
+        return
+    try:
+        if 'dl_type' in match:
+            dl_type = int(match['dl_type'], 0)
+        # arp的nw_proto是操作码, dump-flows显示为arp_op
+        if 'nw_proto' in match and dl_type in (0x0800, 0x86dd):
+            nw_proto = int(match['nw_proto'], 0)
+    except ValueError:
+        return
+    shortcut = FLOW_PROTO_SHORTCUTS.get((dl_type, nw_proto))
+    if shortcut is not None and nw_proto is not None:
+        match.pop('nw_proto', None)
+    else:
+        # 没有简写的ip协议(如gre)显示为ip,nw_proto=47
+        shortcut = FLOW_PROTO_SHORTCUTS.get((dl_type, None))
+        if shortcut is None:
+            return
+        if nw_proto is not None:
+            match['nw_proto'] = str(nw_proto)
+    match.pop('dl_type', None)
+    match['proto'] = shortcut
+
+
+def _normalize_actions(actions):
+    return str(actions or '').replace(' ', '').lower()
+
+
+# 精确匹配一条已存在的流策略, 用于--strict del-flows
+def _flow_strict_match(flow, cookie):
+    table, priority, match = _flow_key(flow)
+    fields = ['table=%s' % table, 'priority=%s' % priority]
+    if cookie is not None:
+        fields.append(_cookie_match(cookie))
+    for key, value in sorted(match):
+        fields.append(value if key == 'proto' else '%s=%s' % (key, value))
+    return ','.join(fields)
+
+
 # 根据key,value生成流表
 # flow_dict ：{key:value,key:value}
 # cmd       ：'add'/'mod'/'del'
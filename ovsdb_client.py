@@ -0,0 +1,359 @@
+# encoding=utf-8
+
+import itertools
+import json
+import eventlet
+from eventlet import semaphore
+from eventlet.green import socket
+from LogException import *
+from config import *
+
+OVSDB_DATABASE = 'Open_vSwitch'
+
+
+class OVSDBError(Exception):
+    pass
+
+
+# OVSDB JSON value -> python value
+# ["set", [...]] -> list, ["map", [[k, v], ...]] -> dict, ["uuid", u] -> u
+def from_ovsdb(value):
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind == 'set':
+            return [from_ovsdb(v) for v in data]
+        if kind == 'map':
+            return dict((from_ovsdb(k), from_ovsdb(v)) for k, v in data)
+        if kind in ('uuid', 'named-uuid'):
+            return data
+    return value
+
+
+# python value -> OVSDB JSON value
+def to_ovsdb(value):
+    if value is None:
+        return ['set', []]
+    if isinstance(value, dict):
+        return ['map', [[to_ovsdb(k), to_ovsdb(v)] for k, v in value.items()]]
+    if isinstance(value, (list, tuple, set)):
+        return ['set', [to_ovsdb(v) for v in value]]
+    return value
+
+
+# a where clause matching a record by name, '.' matches every row
+def _name_where(record):
+    if record == '.':
+        return []
+    return [['name', '==', record]]
+
+
+# this class is outside API
+# 通过db.sock直接和ovsdb-server通信，连接一直保持
+class OVSDBClient(object):
+    """A persistent OVSDB JSON-RPC connection over a unix socket.
+
+    Several requests can be written before the replies are read, replies
+    are matched back by id. Server notifications (e.g. monitor updates)
+    are passed to notify(method, params) when it is set.
+    """
+
+    def __init__(self, path=OVSDB_SOCKET, database=OVSDB_DATABASE,
+                 timeout=ovs_vsctl_timeout):
+        self.path = path
+        self.database = database
+        self.timeout = timeout
+        self.sock = None
+        self.notify = None
+        self.lock = semaphore.Semaphore()
+        self._buffer = ''
+        self._ids = itertools.count(1)
+        self._replies = {}
+        self._decoder = json.JSONDecoder()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+        self._buffer = ''
+        self._replies = {}
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+    def _read_message(self):
+        while True:
+            self._buffer = self._buffer.lstrip()
+            if self._buffer:
+                try:
+                    msg, end = self._decoder.raw_decode(self._buffer)
+                    self._buffer = self._buffer[end:]
+                    return msg
+                except ValueError:
+                    # not a whole message yet
+                    pass
+            data = self.sock.recv(65536)
+            if not data:
+                raise OVSDBError("ovsdb connection closed")
+            self._buffer += data
+
+    def _dispatch(self, msg):
+        method = msg.get('method')
+        if method == 'echo' and msg.get('id') is not None:
+            self.sock.sendall(json.dumps({'id': msg['id'],
+                                          'result': msg.get('params'),
+                                          'error': None}))
+        elif method:
+            if self.notify:
+                self.notify(method, msg.get('params'))
+        else:
+            self._replies[msg.get('id')] = msg
+
+    # read one message and handle it, used by monitors waiting for updates
+    def poll(self):
+        with self.lock:
+            if not self.sock:
+                self.connect()
+            self._dispatch(self._read_message())
+
+    # send several requests at once and wait for all replies
+    # calls: [(method, params), ...], return the results in order
+    def requests(self, calls):
+        with self.lock:
+            sent = False
+            try:
+                if not self.sock:
+                    self.connect()
+                ids = []
+                data = []
+                for method, params in calls:
+                    request_id = next(self._ids)
+                    ids.append(request_id)
+                    data.append(json.dumps({'method': method,
+                                            'params': params,
+                                            'id': request_id}))
+                try:
+                    self.sock.sendall(''.join(data))
+                except socket.error:
+                    # the kept connection may have gone stale, retry once
+                    self.connect()
+                    self.sock.sendall(''.join(data))
+                sent = True
+                while any(i not in self._replies for i in ids):
+                    self._dispatch(self._read_message())
+                replies = [self._replies.pop(i) for i in ids]
+            except (socket.error, OVSDBError) as e:
+                self.close()
+                raise OVSDBError("ovsdb request {} failed{}. msg: {}".format(
+                    [c[0] for c in calls], ' after sending' if sent else '', e))
+        results = []
+        for reply in replies:
+            if reply.get('error'):
+                raise OVSDBError(reply['error'])
+            results.append(reply.get('result'))
+        return results
+
+    def request(self, method, params):
+        return self.requests([(method, params)])[0]
+
+    # run operations in one OVSDB transaction, return their results
+    def transact(self, *operations):
+        result = self.request('transact', [self.database] + list(operations))
+        for op in result:
+            if op and op.get('error'):
+                raise OVSDBError("{}: {}".format(op['error'], op.get('details')))
+        return result
+
+    # return the matching rows, values decoded to python
+    def select(self, table, where, columns=None):
+        op = {'op': 'select', 'table': table, 'where': where}
+        if columns:
+            op['columns'] = columns
+        rows = self.transact(op)[0]['rows']
+        return [dict((k, from_ovsdb(v)) for k, v in row.items()) for row in rows]
+
+    # 读取多条记录的同一列，一次往返
+    # return {record: value}, records that do not exist are left out
+    def get_columns(self, table, records, column):
+        ops = [{'op': 'select', 'table': table, 'where': _name_where(record),
+                'columns': [column]} for record in records]
+        if not ops:
+            return {}
+        result = self.transact(*ops)
+        values = {}
+        for record, op in zip(records, result):
+            if op['rows']:
+                values[record] = from_ovsdb(op['rows'][0][column])
+        return values
+
+    # return the column's value, None if the record does not exist
+    def get_column(self, table, record, column):
+        return self.get_columns(table, [record], column).get(record)
+
+    def record_exists(self, table, record):
+        return bool(self.transact({'op': 'select', 'table': table,
+                                   'where': _name_where(record),
+                                   'columns': ['_uuid']})[0]['rows'])
+
+    # set columns of a record, return the number of rows changed
+    def update(self, table, record, columns):
+        row = dict((k, to_ovsdb(v)) for k, v in columns.items())
+        return self.transact({'op': 'update', 'table': table,
+                              'where': _name_where(record),
+                              'row': row})[0]['count']
+
+
+# 被监视的表和列
+MONITOR_TABLES = {
+    'Bridge': ['name', 'ports'],
+    'Port': ['name', 'interfaces'],
+    'Interface': ['name', 'ofport'],
+}
+
+
+# 通过OVSDB monitor在内存中保存Bridge/Port/Interface表，收到更新通知时同步
+# 监视连接断开时synced为False，调用方应直接查询
+class OVSDBCache(object):
+    """An in-memory copy of the Bridge, Port and Interface tables.
+
+    A green thread keeps a monitor open on its own connection and applies
+    every update notification. Lookups return None while the monitor is
+    not in sync, so callers can fall back to a direct query.
+    """
+
+    def __init__(self, path=OVSDB_SOCKET, database=OVSDB_DATABASE,
+                 tables=MONITOR_TABLES, retry_interval=1):
+        self.path = path
+        self.database = database
+        self.tables = tables
+        self.retry_interval = retry_interval
+        # {table: {uuid: row}}
+        self.rows = {}
+        self.synced = False
+        self.thread = None
+        self.client = None
+
+    def start(self):
+        if not self.thread:
+            self.thread = eventlet.spawn(self._run)
+        return self
+
+    def stop(self):
+        if self.thread:
+            self.thread.kill()
+        if self.client:
+            self.client.close()
+        self.thread = self.client = None
+        self.synced = False
+
+    def _run(self):
+        while True:
+            client = OVSDBClient(self.path, self.database, timeout=None)
+            client.notify = self._notify
+            self.client = client
+            try:
+                requests = dict((t, {'columns': c}) for t, c in self.tables.items())
+                self.rows = {}
+                self._apply(client.request('monitor', [self.database, None, requests]))
+                self.synced = True
+                while True:
+                    client.poll()
+            except (socket.error, OVSDBError) as e:
+                LogExceptionHelp.logException("ovsdb monitor lost. msg: {}".format(e))
+            self.synced = False
+            client.close()
+            eventlet.sleep(self.retry_interval)
+
+    def _notify(self, method, params):
+        if method == 'update' and params and len(params) == 2:
+            self._apply(params[1])
+
+    # table-updates: {table: {uuid: {'old': row, 'new': row}}}
+    def _apply(self, updates):
+        for table, changes in (updates or {}).items():
+            rows = self.rows.setdefault(table, {})
+            for row_uuid, change in changes.items():
+                new = change.get('new')
+                if new is None:
+                    rows.pop(row_uuid, None)
+                else:
+                    rows[row_uuid] = dict((k, from_ovsdb(v)) for k, v in new.items())
+
+    def _find(self, table, name):
+        for row_uuid, row in self.rows.get(table, {}).items():
+            if row.get('name') == name:
+                return row_uuid, row
+        return None, None
+
+    def _bridge_ports(self, bridge):
+        ports = self.rows.get('Port', {})
+        return [ports[u]['name'] for u in _as_list(bridge.get('ports'))
+                if u in ports]
+
+    # 以下查询在未同步时返回None
+    def bridges(self):
+        if not self.synced:
+            return None
+        return sorted(row['name'] for row in self.rows.get('Bridge', {}).values())
+
+    def bridge_exists(self, name):
+        if not self.synced:
+            return None
+        return self._find('Bridge', name)[0] is not None
+
+    def port_exists(self, name):
+        if not self.synced:
+            return None
+        return self._find('Port', name)[0] is not None
+
+    # 端口所在的桥, 不存在返回False
+    def port_bridge(self, port_name):
+        if not self.synced:
+            return None
+        port_uuid = self._find('Port', port_name)[0]
+        if port_uuid is None:
+            return False
+        for bridge in self.rows.get('Bridge', {}).values():
+            if port_uuid in _as_list(bridge.get('ports')):
+                return bridge['name']
+        return False
+
+    # 桥上的端口, 不包含桥自己的内部端口, 与ovs-vsctl list-ports相同
+    def bridge_ports(self, br_name):
+        if not self.synced:
+            return None
+        bridge = self._find('Bridge', br_name)[1]
+        if bridge is None:
+            return []
+        return sorted(name for name in self._bridge_ports(bridge) if name != br_name)
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+_ovsdb_client = None
+_ovsdb_cache = None
+
+
+# the shared connection to the local ovsdb-server
+def get_ovsdb_client():
+    global _ovsdb_client
+    if _ovsdb_client is None:
+        _ovsdb_client = OVSDBClient()
+    return _ovsdb_client
+
+
+# the shared monitor cache, started on first use
+def get_ovsdb_cache():
+    global _ovsdb_cache
+    if _ovsdb_cache is None:
+        _ovsdb_cache = OVSDBCache().start()
+    return _ovsdb_cache
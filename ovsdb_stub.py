@@ -0,0 +1,186 @@
+# encoding=utf-8
+
+import json
+import os
+import socket
+import uuid
+import eventlet
+from ovsdb_client import from_ovsdb, to_ovsdb, OVSDB_DATABASE
+
+
+# 用于测试的OVSDB服务端，数据只保存在内存中
+# server = OVSDBStubServer('/tmp/db.sock')
+# server.add_row('Interface', name='qvo-1', ofport=5)
+# server.start()
+# BaseOVS('br0', ovsdb_interface='native') with OVSDB_SOCKET pointed at it
+class OVSDBStubServer(object):
+    """An in-memory stand-in for ovsdb-server on a unix socket.
+
+    Understands echo, list_dbs, monitor and transact with select, insert,
+    update and delete, which is what OVSDBClient and OVSDBCache send.
+    Changes made by transact or add_row/update_row/delete_row are sent
+    to open monitors as update notifications.
+    """
+
+    def __init__(self, path, database=OVSDB_DATABASE):
+        self.path = path
+        self.database = database
+        # {table: {uuid: {column: python value}}}
+        self.tables = {}
+        self.server = None
+        self.thread = None
+        # [(conn, monitor id, {table: columns})]
+        self.monitors = []
+        self.handlers = set()
+
+    def add_row(self, table, **columns):
+        row_uuid = str(uuid.uuid4())
+        columns['_uuid'] = row_uuid
+        self.tables.setdefault(table, {})[row_uuid] = columns
+        self._notify(table, row_uuid, None, columns)
+        return row_uuid
+
+    def update_row(self, table, row_uuid, **columns):
+        row = self.tables[table][row_uuid]
+        old = dict(row)
+        row.update(columns)
+        self._notify(table, row_uuid, old, row)
+
+    def delete_row(self, table, row_uuid):
+        old = self.tables[table].pop(row_uuid)
+        self._notify(table, row_uuid, old, None)
+
+    # 把一行的变化发给监视该表的连接
+    def _notify(self, table, row_uuid, old, new):
+        for conn, monitor_id, tables in list(self.monitors):
+            if table not in tables:
+                continue
+            change = {}
+            if old is not None:
+                change['old'] = _row_json(old, tables[table])
+            if new is not None:
+                change['new'] = _row_json(new, tables[table])
+            try:
+                conn.sendall(json.dumps({'id': None, 'method': 'update',
+                                         'params': [monitor_id,
+                                                    {table: {row_uuid: change}}]}))
+            except socket.error:
+                self.monitors.remove((conn, monitor_id, tables))
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = eventlet.listen(self.path, family=socket.AF_UNIX)
+        self.thread = eventlet.spawn(self._serve)
+
+    def stop(self):
+        if self.thread:
+            self.thread.kill()
+        for handler in list(self.handlers):
+            handler.kill()
+        if self.server:
+            self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.thread = self.server = None
+
+    def _serve(self):
+        while True:
+            conn, _ = self.server.accept()
+            handler = eventlet.spawn(self._handle, conn)
+            self.handlers.add(handler)
+            handler.link(self.handlers.discard)
+
+    def _handle(self, conn):
+        decoder = json.JSONDecoder()
+        buf = ''
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                buf += data
+                while True:
+                    buf = buf.lstrip()
+                    try:
+                        msg, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+                    conn.sendall(json.dumps(self._reply(msg, conn)))
+        finally:
+            self.monitors = [m for m in self.monitors if m[0] is not conn]
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+    def _reply(self, msg, conn=None):
+        method = msg.get('method')
+        params = msg.get('params') or []
+        reply = {'id': msg.get('id'), 'result': None, 'error': None}
+        if method == 'echo':
+            reply['result'] = params
+        elif method == 'list_dbs':
+            reply['result'] = [self.database]
+        elif method == 'monitor' and len(params) == 3 and params[0] == self.database:
+            tables = dict((t, (req or {}).get('columns'))
+                          for t, req in params[2].items())
+            reply['result'] = dict(
+                (t, dict((u, {'new': _row_json(row, tables[t])})
+                         for u, row in self.tables.get(t, {}).items()))
+                for t in tables)
+            if conn is not None:
+                self.monitors.append((conn, params[1], tables))
+        elif method == 'transact' and params and params[0] == self.database:
+            reply['result'] = [self._operation(op) for op in params[1:]]
+        else:
+            reply['error'] = 'unknown method'
+        return reply
+
+    def _operation(self, op):
+        table = self.tables.setdefault(op.get('table'), {})
+        kind = op.get('op')
+        if kind == 'insert':
+            row = dict((k, from_ovsdb(v)) for k, v in op.get('row', {}).items())
+            return {'uuid': ['uuid', self.add_row(op['table'], **row)]}
+        rows = [row for row in table.values()
+                if all(_match(row, cond) for cond in op.get('where', []))]
+        if kind == 'select':
+            columns = op.get('columns')
+            return {'rows': [dict((k, to_ovsdb(v)) for k, v in row.items()
+                                  if not columns or k in columns)
+                             for row in rows]}
+        if kind == 'update':
+            columns = dict((k, from_ovsdb(v)) for k, v in op.get('row', {}).items())
+            for row in rows:
+                self.update_row(op['table'], row['_uuid'], **columns)
+            return {'count': len(rows)}
+        if kind == 'delete':
+            for row in rows:
+                self.delete_row(op['table'], row['_uuid'])
+            return {'count': len(rows)}
+        return {'error': 'not supported', 'details': kind}
+
+
+def _row_json(row, columns=None):
+    return dict((k, to_ovsdb(v)) for k, v in row.items()
+                if k != '_uuid' and (not columns or k in columns))
+
+
+def _match(row, condition):
+    column, function, value = condition
+    actual = row.get(column)
+    value = from_ovsdb(value)
+    if function == '==':
+        return actual == value
+    if function == '!=':
+        return actual != value
+    members = actual if isinstance(actual, list) else [actual]
+    wanted = value if isinstance(value, list) else [value]
+    if function == 'includes':
+        return all(v in members for v in wanted)
+    if function == 'excludes':
+        return not any(v in members for v in wanted)
+    return False
@@ -0,0 +1,285 @@
+# encoding=utf-8
+
+import encapsulation
+import netlink_lib
+import utils
+from dhcp import Dnsmasq_base
+from encapsulation import get_vm_port_names
+from ip_lib import IPDevice, IpBatch, list_devices, list_namespaces, device_master
+from iptables_firewall import IptablesFirewallDriver
+from iptables_manager import get_table_model
+from ipset_manager import IpsetManager, get_ipset_chain_name
+from ovs_lib import BaseOVS
+from workflow import Workflow, no_failures
+from LogException import *
+from config import *
+
+
+# 期望状态:
+# {
+#     'ports': {port_uid: {'vm_vlan': 10, 'use_sg': True, 'sg_uids': [...], 'mac': .., 'ips': [...]}},
+#     'ipsets': {port_uid: [ip, ...]},
+#     'dhcp': {net_uid: {'ip': .., 'mask': .., 'mac': .., 'vlan': .., 'hosts': [(ip, mac), ...]}},
+#     'l3': {l3_uid: {'net_uid': .., 'stu_ip': .., 'stu_mask': .., 'vm_ip': .., 'vm_mask': ..,
+#                     'vm_vlan': .., 'l3_vlan': .., 'routes': [(cidr, out_port), ...]}},
+#     'flows': [{key: value, ...}, ...],    # Mirror_bridge上带自己cookie的流策略
+# }
+# 不需要管理的部分可以不传
+#
+# reconcile(desired)先用每个子系统一次批量读取得到实际状态, 算出最小差异,
+# 再按批量接口执行. 主机状态正确时只有读取, 不做任何修改.
+
+
+# 每个子系统一次读取得到的实际状态, 同时读取
+def snapshot(table='filter'):
+    executor = utils.get_executor()
+    ovs_thread = executor.spawn_call(BaseOVS(VM_bridge_Name).get_port_tags)
+    ipset_thread = executor.spawn_call(IpsetManager().get_all_members)
+    iptables_thread = executor.spawn_call(get_table_model, table)
+    devices = set(list_devices())
+    state = {
+        'devices': devices,
+        # /sys/class/net/<port>/master, only for the linux bridge ports
+        'masters': dict((name, device_master(name)) for name in devices
+                        if name.startswith(VM_BRIDGE_PORT_PREFIX)),
+        'namespaces': set(list_namespaces()),
+        # {port_name: tag}, None when ovs could not be read
+        'ovs_ports': ovs_thread.wait(),
+        # {ipset name: set(ips)}, None when ipset could not be read
+        'ipsets': ipset_thread.wait(),
+    }
+    model = iptables_thread.wait()
+    state['chains'] = set(model.rules) if model else None
+    return state
+
+
+# routes of every l3 namespace, one netlink dump each
+def _snapshot_routes(namespaces):
+    routes = {}
+    for namespace in namespaces:
+        try:
+            dumped = IPDevice(namespace=namespace).route.dump_routes() or []
+        except Exception as e:
+            LogExceptionHelp.logException("dump routes in {} error. msg: {}".format(namespace, e))
+            dumped = []
+        routes[namespace] = set((r['dst'], r['dev']) for r in dumped
+                                if r['scope'] == netlink_lib.RT_SCOPES['link'] and not r['prefsrc'])
+    return routes
+
+
+def _port_ok(port_uid, port, state):
+    names = get_vm_port_names(port_uid)
+    ovs_ports = state['ovs_ports']
+    if not port.get('use_sg', True):
+        return names['vm_port'] in ovs_ports
+    if not (names['bridge'] in state['devices'] and
+            names['bridge_port'] in state['devices'] and
+            names['ovs_port'] in state['devices'] and
+            names['ovs_port'] in ovs_ports):
+        return False
+    if state['masters'].get(names['bridge_port']) != names['bridge']:
+        return False
+    # creating the port again sets its tag
+    vm_vlan = port.get('vm_vlan')
+    if vm_vlan and ovs_ports.get(names['ovs_port']) != int(vm_vlan):
+        return False
+    if state['chains'] is not None and not all(
+            chain in state['chains']
+            for chain in IptablesFirewallDriver(port_uid).port_chain_names()):
+        return False
+    if state['ipsets'] is not None and names['ipset'] not in state['ipsets']:
+        return False
+    return True
+
+
+def _snapshot_failed(subsystem, skipped):
+    msg = "reconcile: {} could not be read, {} left unchanged".format(subsystem, skipped)
+    print(msg)
+    LogExceptionHelp.logException(msg)
+
+
+# 对比期望状态和实际状态, 返回需要执行的修改
+# prune: 删除不在期望状态中的虚拟机接口、DHCP和多余的路由
+# 某个子系统读取失败(None)时, 依赖它的部分不做修改, 不会把读取失败当成缺失
+def diff(desired, state, prune=False):
+    plan = {'ports_create': [], 'ports_remove': [],
+            'ipsets': {}, 'dhcp_create': [], 'dhcp_spawn': [], 'dhcp_hosts': [],
+            'dhcp_remove': [], 'l3_create': [], 'routes_add': {}, 'routes_del': {},
+            'flows': desired.get('flows')}
+    ovs_ports = state['ovs_ports']
+
+    # ports
+    ports = desired.get('ports') or {}
+    if ports and ovs_ports is None:
+        _snapshot_failed('ovs ports', 'vm ports')
+        ports = {}
+    for port_uid, port in sorted(ports.items()):
+        if not _port_ok(port_uid, port, state):
+            entry = dict(port)
+            entry['port_uid'] = port_uid
+            plan['ports_create'].append(entry)
+    if prune and ovs_ports is not None:
+        wanted = set(uid[:UID_PREFIX_BIT] for uid in ports)
+        stale = set(name[len(VM_OVS_PORT_PREFIX):] for name in ovs_ports
+                    if name.startswith(VM_OVS_PORT_PREFIX))
+        stale.update(name[len(BRIDGE_NAME_PREFIX):] for name in state['devices']
+                     if name.startswith(BRIDGE_NAME_PREFIX))
+        plan['ports_remove'] = sorted(stale - wanted)
+
+    # ipset members, only the sets that differ
+    current_sets = state['ipsets']
+    ipsets = desired.get('ipsets') or {}
+    if ipsets and current_sets is None:
+        _snapshot_failed('ipset', 'ipset members')
+        ipsets = {}
+    for port_uid, ips in sorted(ipsets.items()):
+        name = get_ipset_chain_name(port_uid)
+        wanted = set(ip[:-3] if ip.endswith('/32') else ip for ip in ips or [])
+        if current_sets.get(name) != wanted:
+            plan['ipsets'][name] = sorted(wanted)
+
+    # dhcp
+    networks = desired.get('dhcp') or {}
+    for net_uid, net in sorted(networks.items()):
+        namespace = NS_DHCP_PREFIX + net_uid[:UID_PREFIX_BIT]
+        dhcp_obj = Dnsmasq_base(net.get('ip'), net.get('mask'), net.get('mac'), net_uid, namespace)
+        port_name = NS_DHCP_INTERFACE_PREFIX + net_uid[:UID_PREFIX_BIT]
+        # without the ovs ports only a missing namespace tells the network is missing
+        if namespace not in state['namespaces'] or (ovs_ports is not None and
+                                                    port_name not in ovs_ports):
+            plan['dhcp_create'].append((net_uid, net))
+        elif not dhcp_obj.is_running():
+            plan['dhcp_spawn'].append((net_uid, net))
+        hosts = set(tuple(host) for host in net.get('hosts') or [])
+        if hosts != dhcp_obj.read_host_info():
+            plan['dhcp_hosts'].append((net_uid, net, sorted(hosts)))
+    if prune:
+        wanted = set(uid[:UID_PREFIX_BIT] for uid in networks)
+        plan['dhcp_remove'] = sorted(
+            name[len(NS_DHCP_PREFIX):] for name in state['namespaces']
+            if name.startswith(NS_DHCP_PREFIX) and name[len(NS_DHCP_PREFIX):] not in wanted)
+
+    # l3 routers and their routes
+    routers = desired.get('l3') or {}
+    existing = [L3_NAMESPACE_PREFIX + uid[:UID_PREFIX_BIT] for uid in sorted(routers)
+                if L3_NAMESPACE_PREFIX + uid[:UID_PREFIX_BIT] in state['namespaces']]
+    current_routes = _snapshot_routes(existing)
+    for l3_uid, router in sorted(routers.items()):
+        namespace = L3_NAMESPACE_PREFIX + l3_uid[:UID_PREFIX_BIT]
+        if namespace not in state['namespaces'] or (ovs_ports is not None and (
+                L3_VM_PORT_PREFIX + router['net_uid'][:UID_PREFIX_BIT] not in ovs_ports or
+                L3_STU_PORT_PREFIX + l3_uid[:UID_PREFIX_BIT] not in ovs_ports)):
+            plan['l3_create'].append((l3_uid, router))
+        wanted = set(tuple(route) for route in router.get('routes') or [])
+        current = current_routes.get(namespace, set())
+        if wanted - current:
+            plan['routes_add'][namespace] = sorted(wanted - current)
+        if prune and current - wanted:
+            plan['routes_del'][namespace] = sorted(current - wanted)
+    return plan
+
+
+# 计划是否为空
+def plan_is_empty(plan):
+    return not any(value for key, value in plan.items() if key != 'flows')
+
+
+# 以下函数返回失败的网络/路由器uid列表
+def _create_dhcp(networks):
+    return [net_uid for net_uid, net in networks
+            if not encapsulation.create_vm_dhcp(net_uid, net['ip'], net['mask'],
+                                                net.get('mac'), net.get('vlan')).done]
+
+
+def _spawn_dhcp(networks):
+    return [net_uid for net_uid, net in networks
+            if not Dnsmasq_base(net['ip'], net['mask'], net.get('mac'), net_uid,
+                                NS_DHCP_PREFIX + net_uid[:UID_PREFIX_BIT]).spawn_process()]
+
+
+def _write_dhcp_hosts(networks):
+    for net_uid, net, hosts in networks:
+        Dnsmasq_base(net['ip'], net['mask'], net.get('mac'), net_uid,
+                     NS_DHCP_PREFIX + net_uid[:UID_PREFIX_BIT]).replace_host_info(hosts)
+
+
+def _remove_dhcp(net_uids):
+    return [net_uid for net_uid in net_uids
+            if not encapsulation.clean_dhcp_about(net_uid).done]
+
+
+def _create_l3(routers):
+    return [l3_uid for l3_uid, router in routers
+            if not encapsulation.create_l3(router['stu_ip'], router['stu_mask'],
+                                           router['vm_ip'], router['vm_mask'], l3_uid,
+                                           router['net_uid'], router['vm_vlan'],
+                                           router['l3_vlan']).done]
+
+
+# create_vm_ports_bulk/clean_vm_ports_bulk return {port_uid: [error, ...]}
+def _no_port_errors(errors):
+    return not any(errors.values())
+
+
+def _flows_synced(result):
+    return bool(result) and not result['failed']
+
+
+# 所有命名空间的路由修改, 每个命名空间一次ip -batch
+def _apply_routes(routes_add, routes_del):
+    ip_batch = IpBatch()
+    for namespace, routes in sorted(routes_del.items()):
+        route_obj = IPDevice(namespace=namespace, batch=ip_batch).route
+        for cidr, out_port in routes:
+            route_obj.delete_onlink_route(cidr, out_port)
+    for namespace, routes in sorted(routes_add.items()):
+        route_obj = IPDevice(namespace=namespace, batch=ip_batch).route
+        for cidr, out_port in routes:
+            route_obj.add_onlink_route(cidr, out_port)
+    return ip_batch.flush()
+
+
+# 执行diff()返回的计划, 互不依赖的子系统同时执行
+# return the Workflow, dry_run只打印执行计划
+def apply(plan, table='filter', dry_run=None):
+    wf = Workflow('reconcile', dry_run=dry_run)
+    if plan['ports_remove']:
+        wf.add('ports_remove', encapsulation.clean_vm_ports_bulk, (plan['ports_remove'],),
+               {'table': table}, check=_no_port_errors)
+    if plan['ports_create']:
+        wf.add('ports_create', encapsulation.create_vm_ports_bulk, (plan['ports_create'],),
+               {'table': table},
+               requires=['ports_remove'] if plan['ports_remove'] else (),
+               check=_no_port_errors)
+    if plan['ipsets']:
+        # the port's own set is created together with the port
+        wf.add('ipsets', IpsetManager().sync_all_members, (plan['ipsets'],),
+               requires=['ports_create'] if plan['ports_create'] else (), check=bool)
+    if plan['dhcp_remove']:
+        wf.add('dhcp_remove', _remove_dhcp, (plan['dhcp_remove'],), check=no_failures)
+    if plan['dhcp_create']:
+        wf.add('dhcp_create', _create_dhcp, (plan['dhcp_create'],), check=no_failures)
+    if plan['dhcp_spawn']:
+        wf.add('dhcp_spawn', _spawn_dhcp, (plan['dhcp_spawn'],), check=no_failures)
+    if plan['dhcp_hosts']:
+        wf.add('dhcp_hosts', _write_dhcp_hosts, (plan['dhcp_hosts'],),
+               requires=[name for name in ('dhcp_create', 'dhcp_spawn') if plan[name]])
+    if plan['l3_create']:
+        wf.add('l3_create', _create_l3, (plan['l3_create'],), check=no_failures)
+    if plan['routes_add'] or plan['routes_del']:
+        wf.add('routes', _apply_routes, (plan['routes_add'], plan['routes_del']),
+               requires=['l3_create'] if plan['l3_create'] else (),
+               check=no_failures)
+    if plan['flows'] is not None:
+        # sync_flows reads the flow table once and only sends the difference
+        wf.add('flows', BaseOVS(Mirror_bridge).sync_flows, (plan['flows'],),
+               check=_flows_synced)
+    wf.run()
+    return wf
+
+
+# 让主机与期望状态一致
+# return (plan, workflow)
+def reconcile(desired, table='filter', prune=False, dry_run=None):
+    plan = diff(desired, snapshot(table), prune)
+    return plan, apply(plan, table, dry_run)
@@ -0,0 +1 @@
+# python -m unittest discover -s tests -t .    (from the package directory)
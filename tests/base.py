@@ -0,0 +1,96 @@
+# encoding=utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import eventlet
+
+import iptables_manager
+import utils
+from ovsdb_stub import OVSDBStubServer
+
+
+class TestCase(unittest.TestCase):
+    # 测试结束时恢复obj.name
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    # 让utils.get_executor()返回按顺序给出results的FakeExecutor
+    def fake_executor(self, *results):
+        executor = FakeExecutor(results)
+        self.patch(utils, 'get_executor', lambda: executor)
+        return executor
+
+
+def command_result(returncode=0, stdout='', stderr='', timed_out=False):
+    return utils.CommandResult([], returncode, stdout, stderr, 0.0, timed_out)
+
+
+# CommandExecutor的替身: 记录命令和输入, 依次返回预设的CommandResult或抛出异常
+class FakeExecutor(object):
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+
+    def run(self, cmd, process_input=None, **kwargs):
+        self.calls.append((cmd, process_input))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # 与CommandExecutor相同, 在green thread中调用func
+    def spawn_call(self, func, *args, **kwargs):
+        return eventlet.spawn(func, *args, **kwargs)
+
+    def iter_lines(self, cmd, **kwargs):
+        result = self.run(cmd)
+        if not result.succeeded:
+            raise RuntimeError(result.stderr)
+        return iter(result.stdout.splitlines(True))
+
+
+# iptables-save/iptables-restore的替身: iptables-save返回self.saved,
+# iptables-restore的输入记录在self.restored中, restore_fails为True时失败
+class IptablesTestCase(TestCase):
+    saved = ''
+
+    def setUp(self):
+        super(IptablesTestCase, self).setUp()
+        self.restored = []
+        self.restore_fails = False
+        iptables_manager._table_models.clear()
+        self.addCleanup(iptables_manager._table_models.clear)
+        self.patch(utils, 'execute', self._execute)
+        self.patch(utils, 'exec_cmd', self._exec_cmd)
+
+    def _execute(self, cmd, return_stdout=True, timeout=None):
+        if cmd[0].endswith('-save'):
+            return 0, self.saved
+        raise AssertionError('unexpected command {}'.format(cmd))
+
+    def _exec_cmd(self, cmd, process_input=None, **kwargs):
+        self.restored.append(process_input)
+        if self.restore_fails:
+            raise RuntimeError('iptables-restore: line 2 failed')
+
+
+# 每个测试一个OVSDBStubServer, self.ovsdb_path是它的unix socket
+class OVSDBTestCase(TestCase):
+    def setUp(self):
+        super(OVSDBTestCase, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.ovsdb_path = os.path.join(tmpdir, 'db.sock')
+        self.server = OVSDBStubServer(self.ovsdb_path)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    # 等到check()为真, 让出给服务端和monitor的green thread
+    def wait_for(self, check, timeout=5):
+        with eventlet.Timeout(timeout):
+            while not check():
+                eventlet.sleep(0.01)
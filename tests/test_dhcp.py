@@ -0,0 +1,160 @@
+# encoding=utf-8
+
+import os
+import shutil
+import stat
+import tempfile
+
+import eventlet
+
+import dhcp
+import encapsulation
+from tests import base
+
+NET_UID = 'abcdef0123456789abcd'
+
+
+class HostDBTestCase(base.TestCase):
+    def setUp(self):
+        super(HostDBTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.reloads = 0
+
+    def _reload(self):
+        self.reloads += 1
+
+    def _lines(self, path):
+        with open(path) as f:
+            return f.read().splitlines()
+
+
+class DhcpHostDBTest(HostDBTestCase):
+    def setUp(self):
+        super(DhcpHostDBTest, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'host')
+
+    def test_write_per_change_without_delay(self):
+        host_db = dhcp.DhcpHostDB(self.path, self._reload, delay=0)
+        host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        host_db.set('fa:16:3e:00:00:02', '10.0.0.2')
+        self.assertEqual(2, self.reloads)
+        self.assertEqual(['fa:16:3e:00:00:01,10.0.0.1', 'fa:16:3e:00:00:02,10.0.0.2'],
+                         self._lines(self.path))
+        # dnsmasq reads the file after dropping root
+        self.assertEqual(0644, stat.S_IMODE(os.stat(self.path).st_mode))
+        host_db.remove('fa:16:3e:00:00:01')
+        host_db.remove('fa:16:3e:00:00:03')
+        self.assertEqual(3, self.reloads)
+        self.assertEqual({'fa:16:3e:00:00:02': '10.0.0.2'},
+                         dhcp.DhcpHostDB(self.path, self._reload).get_all())
+
+    def test_batch_writes_once(self):
+        host_db = dhcp.DhcpHostDB(self.path, self._reload, delay=0)
+        with host_db.batch():
+            for i in range(1, 4):
+                host_db.set('fa:16:3e:00:00:0%d' % i, '10.0.0.%d' % i)
+                # nested batches flush only when the outermost one exits
+                with host_db.batch():
+                    host_db.remove('fa:16:3e:00:00:01')
+            self.assertEqual(0, self.reloads)
+            self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(1, self.reloads)
+        self.assertEqual(['fa:16:3e:00:00:02,10.0.0.2', 'fa:16:3e:00:00:03,10.0.0.3'],
+                         self._lines(self.path))
+        with host_db.batch():
+            host_db.set('fa:16:3e:00:00:02', '10.0.0.2')
+        self.assertEqual(1, self.reloads)
+
+    def test_delay_coalesces(self):
+        host_db = dhcp.DhcpHostDB(self.path, self._reload, delay=0.05)
+        host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        host_db.set('fa:16:3e:00:00:02', '10.0.0.2')
+        self.assertEqual(0, self.reloads)
+        eventlet.sleep(0.1)
+        self.assertEqual(1, self.reloads)
+        host_db.set('fa:16:3e:00:00:03', '10.0.0.3')
+        host_db.cancel()
+        eventlet.sleep(0.1)
+        self.assertEqual(1, self.reloads)
+
+    def test_replace(self):
+        host_db = dhcp.DhcpHostDB(self.path, self._reload, delay=0)
+        host_db.replace([('10.0.0.1', 'fa:16:3e:00:00:01')])
+        host_db.replace([('10.0.0.1', 'fa:16:3e:00:00:01')])
+        self.assertEqual(1, self.reloads)
+
+
+class AddVmDhcpHostsTest(HostDBTestCase):
+    def test_one_write_and_one_reload(self):
+        path = os.path.join(self.tmpdir, 'host')
+        host_db = dhcp.DhcpHostDB(path, self._reload, delay=0)
+        key = NET_UID[:dhcp.UID_PREFIX_BIT]
+        self.patch(dhcp, '_host_dbs', {key: host_db})
+        writes = []
+        write = host_db._write
+        self.patch(host_db, '_write', lambda: writes.append(1) or write())
+
+        wf = encapsulation.add_vm_dhcp_hosts(NET_UID, [('10.0.0.%d' % i, 'fa:16:3e:00:00:0%d' % i)
+                                                       for i in range(1, 6)])
+        self.assertTrue(wf.done)
+        self.assertEqual(1, len(writes))
+        self.assertEqual(1, self.reloads)
+        self.assertEqual(5, len(self._lines(path)))
+
+
+class DhcpHostDirTest(HostDBTestCase):
+    def setUp(self):
+        super(DhcpHostDirTest, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'hosts.d')
+        self.host_db = dhcp.DhcpHostDir(self.path, self._reload, delay=0)
+
+    def _files(self):
+        return dict((name, self._lines(os.path.join(self.path, name))[0])
+                    for name in os.listdir(self.path))
+
+    def test_new_bindings_need_no_reload(self):
+        self.host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        self.host_db.set('fa:16:3e:00:00:02', '10.0.0.2')
+        self.assertEqual(0, self.reloads)
+        self.assertEqual({'fa-16-3e-00-00-01': 'fa:16:3e:00:00:01,10.0.0.1',
+                          'fa-16-3e-00-00-02': 'fa:16:3e:00:00:02,10.0.0.2'}, self._files())
+        self.assertEqual(0755, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.assertEqual(0644, stat.S_IMODE(
+            os.stat(os.path.join(self.path, 'fa-16-3e-00-00-01')).st_mode))
+        self.assertEqual({'fa:16:3e:00:00:01': '10.0.0.1', 'fa:16:3e:00:00:02': '10.0.0.2'},
+                         dhcp.DhcpHostDir(self.path, self._reload).get_all())
+
+    def test_reload_only_when_a_released_ip_is_reused(self):
+        self.host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        self.host_db.remove('fa:16:3e:00:00:01')
+        self.assertEqual(0, self.reloads)
+        self.assertEqual({}, self._files())
+        # dnsmasq still holds 10.0.0.1 for the removed MAC
+        self.host_db.set('fa:16:3e:00:00:02', '10.0.0.1')
+        self.assertEqual(1, self.reloads)
+        self.host_db.set('fa:16:3e:00:00:03', '10.0.0.3')
+        self.assertEqual(1, self.reloads)
+
+    def test_changed_ip_reloads(self):
+        self.host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        self.host_db.set('fa:16:3e:00:00:01', '10.0.0.9')
+        self.assertEqual(1, self.reloads)
+        self.assertEqual({'fa-16-3e-00-00-01': 'fa:16:3e:00:00:01,10.0.0.9'}, self._files())
+
+    def test_replace_reloads_once(self):
+        self.host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        self.host_db.set('fa:16:3e:00:00:02', '10.0.0.2')
+        self.host_db.replace([('10.0.0.1', 'fa:16:3e:00:00:03'),
+                              ('10.0.0.5', 'fa:16:3e:00:00:02')])
+        self.assertEqual(1, self.reloads)
+        self.assertEqual({'fa-16-3e-00-00-02': 'fa:16:3e:00:00:02,10.0.0.5',
+                          'fa-16-3e-00-00-03': 'fa:16:3e:00:00:03,10.0.0.1'}, self._files())
+
+    def test_temporary_files_are_ignored(self):
+        self.host_db.set('fa:16:3e:00:00:01', '10.0.0.1')
+        with open(os.path.join(self.path, '.tmpabc'), 'w') as f:
+            f.write('fa:16:3e:00:00:09,10.0.0.9\n')
+        self.assertEqual(['fa:16:3e:00:00:01'],
+                         list(dhcp.DhcpHostDir(self.path, self._reload).get_all()))
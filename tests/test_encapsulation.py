@@ -0,0 +1,106 @@
+# encoding=utf-8
+
+import encapsulation
+import ovs_lib
+from encapsulation import get_vm_port_names
+from config import VM_bridge_Name
+from tests import base
+
+SG_PORT = '11111111aaaaaaaaaaaa'
+PLAIN_PORT = '22222222bbbbbbbbbbbb'
+
+
+# 批量接口的替身: ip -batch走FakeExecutor, ovs-vsctl记录在vsctl_calls,
+# iptables/ipset的批量步骤只记录收到的端口
+class BulkPortsTestCase(base.TestCase):
+    def setUp(self):
+        super(BulkPortsTestCase, self).setUp()
+        self.devices = set()
+        self.vsctl_calls = []
+        self.vsctl_fails = set()
+        self.security_calls = []
+        self.patch(encapsulation.LogExceptionHelp, 'logException',
+                   staticmethod(lambda msg: None))
+        self.patch(encapsulation, 'device_exists',
+                   lambda name, namespace=None: name in self.devices)
+        self.patch(ovs_lib.BaseOVS, 'run_vsctl', self._run_vsctl)
+        for name in ('_create_port_chains_bulk', '_create_port_ipsets_bulk',
+                     '_remove_port_security_bulk'):
+            self.patch(encapsulation, name, self._security_step(name))
+
+    def _run_vsctl(self, args):
+        self.vsctl_calls.append(args)
+        if any(arg in self.vsctl_fails for arg in args):
+            return None
+        return 0, ''
+
+    def _security_step(self, name):
+        def step(ports, *args):
+            self.security_calls.append((name, [port['port_uid'] for port in ports]))
+        return step
+
+
+class CreateVmPortsBulkTest(BulkPortsTestCase):
+    ports = [{'port_uid': SG_PORT, 'vm_vlan': 10},
+             {'port_uid': PLAIN_PORT, 'vm_vlan': 20, 'use_sg': False}]
+
+    def test_one_batch_per_kind(self):
+        executor = self.fake_executor(base.command_result())
+        sg, plain = get_vm_port_names(SG_PORT), get_vm_port_names(PLAIN_PORT)
+        self.devices.add(sg['bridge'])
+
+        errors = encapsulation.create_vm_ports_bulk(self.ports)
+        self.assertEqual({SG_PORT: [], PLAIN_PORT: []}, errors)
+        self.assertEqual([
+            'link add {} type veth peer name {}'.format(sg['bridge_port'], sg['ovs_port']),
+            'link set {} master {}'.format(sg['bridge_port'], sg['bridge']),
+            'link set {} up'.format(sg['bridge']),
+            'link set {} up'.format(sg['bridge_port']),
+            'link set {} up'.format(sg['ovs_port']),
+            'link set {} up'.format(plain['vm_port']),
+        ], executor.calls[0][1].splitlines())
+        self.assertEqual(1, len(executor.calls))
+        # the port without a Security Group gets no tag
+        self.assertEqual([[
+            '--', '--may-exist', 'add-port', VM_bridge_Name, sg['ovs_port'],
+            '--', 'set', 'port', sg['ovs_port'], 'tag=10',
+            '--', '--may-exist', 'add-port', VM_bridge_Name, plain['vm_port'],
+        ]], self.vsctl_calls)
+        self.assertEqual([('_create_port_chains_bulk', [SG_PORT]),
+                          ('_create_port_ipsets_bulk', [SG_PORT])],
+                         sorted(self.security_calls))
+
+    def test_failures_are_recorded_per_port(self):
+        sg, plain = get_vm_port_names(SG_PORT), get_vm_port_names(PLAIN_PORT)
+        self.devices.update([sg['bridge'], sg['bridge_port']])
+        # the last line, bringing up the plain port, fails
+        self.fake_executor(base.command_result(
+            1, stderr='Cannot find device "{0}"\nCommand failed -:5\n'.format(plain['vm_port'])))
+        self.vsctl_fails.add(sg['ovs_port'])
+
+        errors = encapsulation.create_vm_ports_bulk(self.ports)
+        self.assertEqual(['ovs: add port failed'], errors[SG_PORT])
+        self.assertEqual(['ip: Cannot find device "{}"'.format(plain['vm_port'])],
+                         errors[PLAIN_PORT])
+        # the failed transaction is retried port by port
+        self.assertEqual(3, len(self.vsctl_calls))
+
+
+class CleanVmPortsBulkTest(BulkPortsTestCase):
+    def test_one_batch_per_kind(self):
+        executor = self.fake_executor(base.command_result())
+        sg, plain = get_vm_port_names(SG_PORT), get_vm_port_names(PLAIN_PORT)
+        self.devices.update([sg['bridge_port'], sg['bridge'], plain['bridge_port']])
+
+        errors = encapsulation.clean_vm_ports_bulk([SG_PORT, {'port_uid': PLAIN_PORT,
+                                                              'use_sg': False}])
+        self.assertEqual({SG_PORT: [], PLAIN_PORT: []}, errors)
+        self.assertEqual(['link del {}'.format(sg['bridge_port']),
+                          'link del {}'.format(sg['bridge']),
+                          'link del {}'.format(plain['bridge_port'])],
+                         executor.calls[0][1].splitlines())
+        self.assertEqual([[
+            '--', '--if-exists', 'del-port', VM_bridge_Name, sg['ovs_port'],
+            '--', '--if-exists', 'del-port', VM_bridge_Name, plain['ovs_port'],
+        ]], self.vsctl_calls)
+        self.assertEqual([('_remove_port_security_bulk', [SG_PORT])], self.security_calls)
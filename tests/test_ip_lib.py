@@ -0,0 +1,146 @@
+# encoding=utf-8
+
+import os
+import shutil
+import tempfile
+from distutils import spawn
+
+import ip_lib
+import linuxbridge
+import ovs_lib
+import utils
+from tests import base
+
+
+class IpBatchTest(base.TestCase):
+    def setUp(self):
+        super(IpBatchTest, self).setUp()
+        self.patch(ip_lib.LogExceptionHelp, 'logException',
+                   staticmethod(lambda msg: None))
+
+    def _flush(self, batch, *results):
+        executor = self.fake_executor(*results)
+        return batch.flush(), executor.calls
+
+    def _result(self, returncode, stderr='', timed_out=False):
+        return base.command_result(returncode, stderr=stderr, timed_out=timed_out)
+
+    def test_one_batch_per_namespace_in_first_use_order(self):
+        batch = ip_lib.IpBatch()
+        ip_lib._execute([], 'link', ('set', 'tap1', 'netns', 'ns1'), batch=batch)
+        ip_lib._execute([], 'link', ('set', 'tap1', 'up'), namespace='ns1', batch=batch)
+        ip_lib._execute([], 'link', ('set', 'tap2', 'up'), batch=batch)
+        failed, calls = self._flush(batch, self._result(0), self._result(0))
+        self.assertEqual([], failed)
+        self.assertEqual([
+            (['ip', '-force', '-batch', '-'],
+             'link set tap1 netns ns1\nlink set tap2 up\n'),
+            (['ip', 'netns', 'exec', 'ns1', 'ip', '-force', '-batch', '-'],
+             'link set tap1 up\n'),
+        ], calls)
+        self.assertEqual({}, batch.commands)
+
+    def test_errors_are_attributed_to_their_lines(self):
+        batch = ip_lib.IpBatch()
+        batch.add(None, 'link', ('set', 'nosuchdev0', 'up'))
+        batch.add(None, 'link', ('show', 'lo'))
+        batch.add(None, 'link', ('set', 'nosuchdev1', 'down'))
+        stderr = ('Cannot find device "nosuchdev0"\n'
+                  'Command failed -:1\n'
+                  'Cannot find device "nosuchdev1"\n'
+                  'Command failed -:3\n')
+        failed, _ = self._flush(batch, self._result(1, stderr))
+        self.assertEqual([
+            (None, 'link set nosuchdev0 up', 'Cannot find device "nosuchdev0"'),
+            (None, 'link set nosuchdev1 down', 'Cannot find device "nosuchdev1"'),
+        ], failed)
+
+    def test_unattributed_failure_fails_every_line(self):
+        batch = ip_lib.IpBatch()
+        batch.add('ns1', 'link', 'show')
+        batch.add('ns1', 'addr', 'show')
+        stderr = 'Cannot open network namespace "ns1": No such file or directory\n'
+        failed, _ = self._flush(batch, self._result(1, stderr))
+        error = 'Cannot open network namespace "ns1": No such file or directory'
+        self.assertEqual([('ns1', 'link show', error),
+                          ('ns1', 'addr show', error)], failed)
+
+    def test_timeout_and_exception_fail_every_line(self):
+        batch = ip_lib.IpBatch()
+        batch.add(None, 'link', 'show')
+        batch.add('ns1', 'link', 'show')
+        failed, _ = self._flush(batch, self._result(-9, timed_out=True),
+                                OSError('no ip binary'))
+        self.assertEqual([(None, 'link show', 'timed out'),
+                          ('ns1', 'link show', 'no ip binary')], failed)
+
+    def test_real_ip_batch(self):
+        if os.geteuid() != 0 or not spawn.find_executable('ip'):
+            self.skipTest('needs root and ip')
+        batch = ip_lib.IpBatch()
+        batch.add(None, 'link', ('set', 'nosuchdev0', 'up'))
+        batch.add(None, 'link', ('show', 'lo'))
+        failed = batch.flush()
+        self.assertEqual(1, len(failed))
+        self.assertEqual('link set nosuchdev0 up', failed[0][1])
+        self.assertIn('nosuchdev0', failed[0][2])
+
+
+# 在临时目录中模拟/sys/class/net和/var/run/netns, 查询不应执行任何命令
+class SysfsTest(base.TestCase):
+    def setUp(self):
+        super(SysfsTest, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sys_net = os.path.join(tmpdir, 'net')
+        netns = os.path.join(tmpdir, 'netns')
+        for name in ('lo', 'tap1', 'qvb1', 'brq1', 'qvo1', 'ovs-system'):
+            os.makedirs(os.path.join(sys_net, name))
+        os.makedirs(os.path.join(sys_net, 'brq1', 'bridge'))
+        os.makedirs(os.path.join(sys_net, 'qvb1', 'brport'))
+        os.symlink('../brq1', os.path.join(sys_net, 'qvb1', 'master'))
+        os.symlink('../../brq1', os.path.join(sys_net, 'qvb1', 'brport', 'bridge'))
+        os.symlink('../ovs-system', os.path.join(sys_net, 'qvo1', 'master'))
+        os.makedirs(netns)
+        open(os.path.join(netns, 'ns2'), 'w').close()
+        open(os.path.join(netns, 'ns1'), 'w').close()
+        self.patch(ip_lib, 'SYS_CLASS_NET', sys_net)
+        self.patch(ip_lib, 'NETNS_RUN_DIR', netns)
+        self.patch(linuxbridge, 'BRIDGE_FS', sys_net)
+        self.patch(utils, 'execute', self._execute)
+
+    def _execute(self, cmd, *args, **kwargs):
+        raise AssertionError('unexpected command {}'.format(cmd))
+
+    def test_namespaces(self):
+        self.assertEqual(['ns1', 'ns2'], ip_lib.list_namespaces())
+        self.assertEqual(['ns1', 'ns2'], ip_lib.IPWrapper().get_namespaces())
+        self.assertTrue(ip_lib.namespace_exists('ns1'))
+        self.assertFalse(ip_lib.namespace_exists('ns3'))
+        self.assertFalse(ip_lib.namespace_exists(None))
+        netns = ip_lib.IPDevice().netns
+        self.assertTrue(netns.exists('ns2'))
+        netns.add('ns1')
+
+    def test_devices(self):
+        self.assertEqual(['brq1', 'lo', 'ovs-system', 'qvb1', 'qvo1', 'tap1'],
+                         ip_lib.list_devices())
+        self.assertNotIn('lo', ip_lib.IPWrapper().get_devices(exclude_loopback=True))
+        self.assertTrue(ip_lib.IPDevice('tap1').exists())
+        self.assertFalse(ip_lib.device_exists('tap2'))
+        # no such namespace, no netlink query
+        self.assertFalse(ip_lib.device_exists('tap1', namespace='ns3'))
+        self.assertEqual('brq1', ip_lib.device_master('qvb1'))
+        self.assertIsNone(ip_lib.device_master('tap1'))
+
+    def test_linux_bridge(self):
+        bridge = linuxbridge.LinuxBridgeManager('brq1')
+        self.assertTrue(bridge.exists())
+        self.assertFalse(linuxbridge.LinuxBridgeManager('tap1').exists())
+        self.assertEqual('brq1', bridge.get_interface_bridge('qvb1'))
+        bridge.create_br()
+        bridge.add_port('qvb1')
+
+    def test_ovs_datapath_port(self):
+        ovs = ovs_lib.BaseOVS('br-int', ovsdb_interface='vsctl')
+        self.assertTrue(ovs.port_exists('qvo1'))
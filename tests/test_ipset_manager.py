@@ -0,0 +1,174 @@
+# encoding=utf-8
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import ipset_manager
+import utils
+from ipset_manager import (IpsetManager, IpsetProcess, IpsetProcessResendError,
+                           _sync_lines)
+from tests.base import TestCase
+
+SAVED = """create ipv4-aaa hash:net family inet hashsize 1024 maxelem 65536
+add ipv4-aaa 10.0.0.1
+add ipv4-aaa 10.0.0.2
+add ipv4-aaa 10.1.0.0/16
+create ipv4-bbb hash:net family inet hashsize 1024 maxelem 65536
+"""
+
+
+# ipset save返回self.saved, ipset restore的输入记录在self.restored中
+class IpsetTestCase(TestCase):
+    def setUp(self):
+        super(IpsetTestCase, self).setUp()
+        self.saved = SAVED
+        self.restored = []
+        self.patch(utils, 'exec_cmd', self._exec_cmd)
+        self.ipset = IpsetManager(use_process=False)
+
+    def _exec_cmd(self, cmd, process_input=None, **kwargs):
+        if cmd[:2] == ['ipset', 'save']:
+            if len(cmd) == 3:
+                if 'create %s ' % cmd[2] not in self.saved:
+                    raise RuntimeError('The set with the given name does not exist')
+                return '\n'.join(line for line in self.saved.split('\n')
+                                 if line.split()[1:2] == [cmd[2]])
+            return self.saved
+        if cmd[:2] == ['ipset', 'restore']:
+            self.restored.append(process_input.split('\n')[:-1])
+            return ''
+        raise AssertionError('unexpected command {}'.format(cmd))
+
+
+class BulkLoadTest(IpsetTestCase):
+    def test_add_members_in_one_restore(self):
+        self.assertTrue(self.ipset.add_ip_members(['1.1.1.1', '1.1.1.2'], 'ipv4-aaa'))
+        self.assertEqual(self.restored, [['add ipv4-aaa 1.1.1.1', 'add ipv4-aaa 1.1.1.2']])
+
+    def test_create_chains_in_one_restore(self):
+        self.assertTrue(self.ipset.create_ipset_chains(['ipv4-x', 'ipv4-y']))
+        self.assertEqual(self.restored, [['create ipv4-x hash:net', 'create ipv4-y hash:net']])
+
+    def test_replace_swaps_a_filled_set(self):
+        self.assertTrue(self.ipset.replace_ip_members(['1.1.1.1'], 'ipv4-aaa'))
+        self.assertEqual(self.restored, [['create ipv4-aaa-n hash:net',
+                                          'flush ipv4-aaa-n',
+                                          'add ipv4-aaa-n 1.1.1.1',
+                                          'create ipv4-aaa hash:net',
+                                          'swap ipv4-aaa-n ipv4-aaa',
+                                          'destroy ipv4-aaa-n']])
+
+
+class SyncMembersTest(IpsetTestCase):
+    def test_sync_lines(self):
+        self.assertEqual(_sync_lines('s', ['1.1.1.1/32', '2.0.0.0/8'], set(['1.1.1.1', '3.3.3.3'])),
+                         ['del s 3.3.3.3', 'add s 2.0.0.0/8'])
+        self.assertEqual(_sync_lines('s', ['1.1.1.1'], None),
+                         ['create s hash:net', 'add s 1.1.1.1'])
+        self.assertEqual(_sync_lines('s', [], set()), [])
+
+    def test_get_members(self):
+        self.assertEqual(self.ipset.get_ip_members('ipv4-aaa'),
+                         set(['10.0.0.1', '10.0.0.2', '10.1.0.0/16']))
+        self.assertIsNone(self.ipset.get_ip_members('ipv4-ccc'))
+        self.assertEqual(self.ipset.get_all_members(),
+                         {'ipv4-aaa': set(['10.0.0.1', '10.0.0.2', '10.1.0.0/16']),
+                          'ipv4-bbb': set()})
+
+    def test_sync_only_the_difference(self):
+        self.assertTrue(self.ipset.sync_members('ipv4-aaa', ['10.0.0.1/32', '10.0.0.3',
+                                                             '10.1.0.0/16']))
+        self.assertEqual(self.restored, [['del ipv4-aaa 10.0.0.2', 'add ipv4-aaa 10.0.0.3']])
+
+    def test_sync_in_step_does_nothing(self):
+        self.assertTrue(self.ipset.sync_members('ipv4-aaa', ['10.0.0.1', '10.0.0.2',
+                                                             '10.1.0.0/16']))
+        self.assertEqual(self.restored, [])
+
+    def test_sync_all_in_one_restore(self):
+        self.assertTrue(self.ipset.sync_all_members({'ipv4-aaa': ['10.0.0.1', '10.0.0.2'],
+                                                     'ipv4-bbb': ['5.5.5.5'],
+                                                     'ipv4-ccc': []}))
+        self.assertEqual(self.restored, [['del ipv4-aaa 10.1.0.0/16',
+                                          'add ipv4-bbb 5.5.5.5',
+                                          'create ipv4-ccc hash:net']])
+
+
+# 'ipset -'的替身: 每条命令记录到log, 'version'输出版本行, 含'bad'的命令报错,
+# 第一次读到含'die'的命令时退出
+FAKE_IPSET = """
+import os, sys
+log, died = sys.argv[1], sys.argv[1] + '.died'
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    line = line.strip()
+    if line == 'version':
+        sys.stdout.write('ipset v7.1, protocol version: 7\\n')
+        continue
+    if 'die' in line and not os.path.exists(died):
+        open(died, 'w').close()
+        sys.exit(1)
+    with open(log, 'a') as f:
+        f.write(line + '\\n')
+    if 'bad' in line:
+        sys.stdout.write('ipset v7.1: Syntax error: bad\\n')
+"""
+
+
+class IpsetProcessTest(TestCase):
+    def setUp(self):
+        super(IpsetProcessTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.script = os.path.join(self.dir, 'ipset.py')
+        self.log = os.path.join(self.dir, 'log')
+        with open(self.script, 'w') as f:
+            f.write(FAKE_IPSET)
+        self.patch(utils, 'subprocess_popen', self._popen)
+        self.process = IpsetProcess()
+        self.addCleanup(self.process.stop)
+
+    def _popen(self, cmd, stdin=None, stdout=None, stderr=None, **kwargs):
+        return subprocess.Popen([sys.executable, '-u', self.script, self.log],
+                                stdin=stdin, stdout=stdout, stderr=stderr)
+
+    def _ran(self):
+        with open(self.log) as f:
+            return f.read().split('\n')[:-1]
+
+    def test_errors_belong_to_their_command(self):
+        failed = self.process.execute(['add s 1.1.1.1', 'add s bad', 'add s 1.1.1.2'])
+        self.assertEqual(failed, [('add s bad', 'ipset v7.1: Syntax error: bad')])
+        self.assertEqual(self._ran(), ['add s 1.1.1.1', 'add s bad', 'add s 1.1.1.2'])
+
+    def test_restart_resends_only_unanswered_commands(self):
+        self.patch(ipset_manager, 'IPSET_PROCESS_PIPELINE', 2)
+        failed = self.process.execute(['add s 1.1.1.1', 'add s 1.1.1.2',
+                                       'add s 1.1.1.3', 'add s die', 'add s 1.1.1.4'])
+        self.assertEqual(failed, [])
+        self.assertEqual(self._ran(), ['add s 1.1.1.1', 'add s 1.1.1.2', 'add s 1.1.1.3',
+                                       'add s die', 'add s 1.1.1.4'])
+
+    def test_no_resend_of_other_commands(self):
+        with self.assertRaises(IpsetProcessResendError):
+            self.process.execute(['add s 1.1.1.1', 'add s die', 'swap s s-n'])
+        self.assertEqual(self._ran(), ['add s 1.1.1.1'])
+
+    def test_manager_falls_back_to_restore(self):
+        self.patch(ipset_manager, '_ipset_processes', {None: self.process})
+        restored = []
+        self.patch(utils, 'exec_cmd',
+                   lambda cmd, process_input=None, **kwargs: restored.append(process_input))
+        manager = IpsetManager(use_process=True)
+        self.assertTrue(manager._restore_ipset_chains(['add s die', 'swap s s-n']))
+        self.assertEqual(restored, ['add s die -exist\nswap s s-n\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
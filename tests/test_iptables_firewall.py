@@ -0,0 +1,81 @@
+# encoding=utf-8
+
+import unittest
+
+import iptables_manager
+from iptables_firewall import EGRESS_DIRECTION, IptablesFirewallDriver
+from tests.base import IptablesTestCase
+
+SAVED = """*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:iptables_firewal-sg-chain - [0:0]
+COMMIT
+"""
+
+UIDS = ['11111111aaaa', '22222222bbbb', '33333333cccc']
+
+
+class DeferApplyTest(IptablesTestCase):
+    saved = SAVED
+
+    def test_one_restore_for_many_ports(self):
+        with IptablesFirewallDriver.defer_apply() as transaction:
+            for uid in UIDS:
+                IptablesFirewallDriver(uid, table='filter',
+                                       transaction=transaction).add_port_chain()
+            self.assertEqual(self.restored, [])
+        self.assertEqual(len(self.restored), 1)
+        lines = self.restored[0].split('\n')
+        for uid in UIDS:
+            for chain in IptablesFirewallDriver(uid).port_chain_names():
+                self.assertIn(':%s - [0:0]' % chain, lines)
+
+    def test_rollback_on_error(self):
+        try:
+            with IptablesFirewallDriver.defer_apply() as transaction:
+                IptablesFirewallDriver(UIDS[0], table='filter',
+                                       transaction=transaction).add_port_chain()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.restored, [])
+        self.assertEqual(transaction.namespaces, {})
+
+
+class PortSpoofingTest(IptablesTestCase):
+    saved = SAVED
+    MAC = 'fa:16:3e:00:00:01'
+
+    def _spoof_rules(self, ips):
+        driver = IptablesFirewallDriver(UIDS[0], table='filter')
+        with IptablesFirewallDriver.defer_apply() as transaction:
+            driver.transaction = transaction
+            driver.add_port_chain()
+            driver.add_port_spoofing_rule(self.MAC, ips)
+        self.assertEqual(len(self.restored), 1)
+        rules = iptables_manager.get_table_model('filter').rules
+        egress = 'iptables_firewal-' + driver.chain_suffix[EGRESS_DIRECTION]
+        spoof_chain = 'iptables_firewal-' + driver.spoof_chain
+        self.assertIn('-A %s -j %s' % (egress, spoof_chain), rules[egress])
+        return rules[spoof_chain]
+
+    def test_chain_contents(self):
+        chain = 'iptables_firewal-s11111111aa'
+        self.assertEqual(self._spoof_rules(['10.0.0.5', '10.0.0.6']), [
+            '-A %s -s 0.0.0.0/32 -p udp -m udp --sport 68 --dport 67 '
+            '-m mac --mac-source FA:16:3E:00:00:01 -j RETURN' % chain,
+            '-A %s -s 10.0.0.5/32 -m mac --mac-source FA:16:3E:00:00:01 -j RETURN' % chain,
+            '-A %s -s 10.0.0.6/32 -m mac --mac-source FA:16:3E:00:00:01 -j RETURN' % chain,
+            '-A %s -j DROP' % chain])
+
+    def test_no_ips_checks_only_the_mac(self):
+        rules = self._spoof_rules([])
+        self.assertEqual([rule.split(' ', 2)[2] for rule in rules[1:]], [
+            '-m mac --mac-source FA:16:3E:00:00:01 -j RETURN',
+            '-j DROP'])
+
+
+if __name__ == '__main__':
+    unittest.main()
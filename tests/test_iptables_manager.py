@@ -0,0 +1,212 @@
+# encoding=utf-8
+
+import unittest
+
+import iptables_manager
+from iptables_manager import (IptablesManager, IptablesRule, IptablesTable,
+                              IptablesTableModel, IptablesTransaction,
+                              _normalize_rule)
+from tests.base import IptablesTestCase
+
+SAVED = """# Generated by iptables-save
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:iptables_firewal-a - [0:0]
+:iptables_firewal-b - [0:0]
+[5:300] -A FORWARD -j iptables_firewal-a
+-A iptables_firewal-a -s 1.2.3.4/32 -p tcp -m tcp --dport 22 -j ACCEPT
+-A iptables_firewal-a -j iptables_firewal-b
+-A iptables_firewal-b -m mac --mac-source FA:16:3E:00:00:01 -j RETURN
+COMMIT
+"""
+
+
+def _model():
+    model = IptablesTableModel('filter')
+    model.load(SAVED.split('\n'))
+    return model
+
+
+class NormalizeRuleTest(unittest.TestCase):
+    def test_save_form(self):
+        self.assertEqual(
+            _normalize_rule('-A c  -p tcp --dport 22 -s 1.2.3.4 -j ACCEPT'),
+            '-A c -s 1.2.3.4/32 -p tcp -m tcp --dport 22 -j ACCEPT')
+
+    def test_long_options_and_masks(self):
+        self.assertEqual(
+            _normalize_rule('--append c --destination 10.0.0.9/255.255.255.0 '
+                            '--protocol 17 --destination-port 53 --jump DROP'),
+            '-A c -d 10.0.0.0/24 -p udp -m udp --dport 53 -j DROP')
+
+    def test_negation_and_mac(self):
+        self.assertEqual(
+            _normalize_rule('-A c -m mac --mac-source fa:16:3e:00:00:01 ! -s 1.2.3.4 -j RETURN'),
+            '-A c ! -s 1.2.3.4/32 -m mac --mac-source FA:16:3E:00:00:01 -j RETURN')
+        self.assertEqual(_normalize_rule('-A c -p tcp ! --syn -j DROP'),
+                         '-A c -p tcp -m tcp ! --syn -j DROP')
+
+    def test_saved_rules_unchanged(self):
+        for line in SAVED.split('\n'):
+            if line.startswith('-A '):
+                self.assertEqual(_normalize_rule(line), line)
+
+
+class TableModelTest(unittest.TestCase):
+    def test_load(self):
+        model = _model()
+        self.assertEqual(model.rules['FORWARD'], ['-A FORWARD -j iptables_firewal-a'])
+        self.assertFalse(model.is_builtin('iptables_firewal-a'))
+        self.assertTrue(model.is_builtin('INPUT'))
+        self.assertEqual(model.referrers['iptables_firewal-b'],
+                         set([('iptables_firewal-a', '-A iptables_firewal-a -j iptables_firewal-b')]))
+
+    def test_duplicate_written_differently(self):
+        model = _model()
+        before = model.update([], [IptablesRule('iptables_firewal-a',
+                                                '-p tcp --dport 22 -s 1.2.3.4 -j ACCEPT')],
+                              [], [])
+        self.assertEqual(model.delta_lines(before), [])
+
+    def test_remove_rule_written_differently(self):
+        model = _model()
+        before = model.update([], [], [], [IptablesRule('iptables_firewal-b',
+                                                        '-m mac --mac-source fa:16:3e:00:00:01 -j RETURN')])
+        self.assertEqual(model.delta_lines(before), [
+            '*filter',
+            '-D iptables_firewal-b -m mac --mac-source FA:16:3E:00:00:01 -j RETURN',
+            'COMMIT'])
+
+    def test_delta_top_and_bottom(self):
+        model = _model()
+        before = model.update([], [IptablesRule('iptables_firewal-a', '-j DROP', top=False),
+                                   IptablesRule('iptables_firewal-a', '-s 5.5.5.5 -j ACCEPT')],
+                              [], [])
+        self.assertEqual(model.delta_lines(before), [
+            '*filter',
+            '-I iptables_firewal-a 1 -s 5.5.5.5/32 -j ACCEPT',
+            '-A iptables_firewal-a -j DROP',
+            'COMMIT'])
+        self.assertEqual(model.rules['iptables_firewal-a'][0], '-A iptables_firewal-a -s 5.5.5.5/32 -j ACCEPT')
+        self.assertEqual(model.rules['iptables_firewal-a'][-1], '-A iptables_firewal-a -j DROP')
+
+    def test_delta_new_and_removed_chains(self):
+        model = _model()
+        before = model.update(['iptables_firewal-c'],
+                              [IptablesRule('iptables_firewal-c', '-j RETURN')],
+                              ['iptables_firewal-b'], [])
+        self.assertEqual(model.delta_lines(before), [
+            '*filter',
+            ':iptables_firewal-c - [0:0]',
+            '-D iptables_firewal-a -j iptables_firewal-b',
+            '-A iptables_firewal-c -j RETURN',
+            '-F iptables_firewal-b',
+            '-X iptables_firewal-b',
+            'COMMIT'])
+        self.assertFalse(model.has_chain('iptables_firewal-b'))
+
+    def test_rebuild_prefix(self):
+        model = _model()
+        before = model.update([], [IptablesRule('iptables_firewal-b', '-j DROP', top=False)], [], [])
+        self.assertEqual(model.delta_lines(before, 'iptables_firewal-'), [
+            '*filter',
+            ':iptables_firewal-b - [0:0]',
+            '-A iptables_firewal-b -m mac --mac-source FA:16:3E:00:00:01 -j RETURN',
+            '-A iptables_firewal-b -j DROP',
+            'COMMIT'])
+
+
+class ModifyRulesTest(unittest.TestCase):
+    LINES = ['*filter',
+             ':FORWARD ACCEPT [0:0]',
+             ':i12345 - [0:0]',
+             ':i123456 - [0:0]',
+             '[3:180] -A FORWARD -j i12345',
+             '[0:0] -A FORWARD -j i123456',
+             '[0:0] -A i12345 -s 1.2.3.4/32 -j ACCEPT',
+             '[0:0] -A i123456 -j DROP',
+             'COMMIT']
+
+    def _modify(self, chains=(), rules=(), remove_chains=(), remove_rules=()):
+        pending = IptablesTable()
+        pending.chains.update(chains)
+        pending.rules.extend(rules)
+        pending.remove_chains.update(remove_chains)
+        pending.remove_rules.extend(remove_rules)
+        return IptablesManager(table='filter')._modify_rules(list(self.LINES), pending)
+
+    def test_remove_chain_is_exact(self):
+        self.assertEqual(self._modify(remove_chains=['i12345']),
+                         ['*filter',
+                          ':FORWARD ACCEPT [0:0]',
+                          ':i123456 - [0:0]',
+                          '[0:0] -A FORWARD -j i123456',
+                          '[0:0] -A i123456 -j DROP',
+                          'COMMIT'])
+
+    def test_duplicates_are_skipped(self):
+        lines = self._modify(chains=['i12345'],
+                             rules=[IptablesRule('i12345', '-s 1.2.3.4 -j ACCEPT'),
+                                    IptablesRule('i12345', '-j DROP', top=False)])
+        self.assertEqual(lines, self.LINES[:-1] + ['[0:0] -A i12345 -j DROP', 'COMMIT'])
+
+    def test_remove_rule(self):
+        lines = self._modify(remove_rules=[IptablesRule('FORWARD', '-j i123456')])
+        self.assertNotIn('[0:0] -A FORWARD -j i123456', lines)
+        self.assertEqual(len(lines), len(self.LINES) - 1)
+
+
+class ApplyTablesTest(IptablesTestCase):
+    saved = SAVED
+
+    def test_failed_restore_keeps_pending(self):
+        manager = IptablesManager('a', table='filter')
+        self.restore_fails = True
+        manager.add_rule('-j DROP')
+        self.assertEqual(len(manager.rules), 1)
+        self.assertNotIn((None, 'filter'), iptables_manager._table_models)
+
+        self.restore_fails = False
+        manager.iptables_apply()
+        self.assertEqual(manager.rules, [])
+        self.assertEqual(self.restored[-1],
+                         '*filter\n-I iptables_firewal-a 1 -j DROP\nCOMMIT\n')
+
+    def test_successful_restore_clears_pending(self):
+        manager = IptablesManager('a', table='filter')
+        manager.add_rule('-j ACCEPT')
+        self.assertEqual(manager.rules, [])
+        self.assertEqual(len(self.restored), 1)
+
+    def test_chains_mode_rebuilds_only_owned_chains(self):
+        self.patch(iptables_manager, 'IPTABLES_APPLY_MODE', 'chains')
+        with IptablesTransaction() as transaction:
+            IptablesManager('a', table='filter', transaction=transaction).add_rule(
+                '-j DROP', top=False)
+            IptablesManager(table='filter', transaction=transaction).add_rule(
+                '-i eth0 -j ACCEPT', chain_str='FORWARD')
+        self.assertEqual(self.restored[-1].split('\n'), [
+            '*filter',
+            ':iptables_firewal-a - [0:0]',
+            '-I FORWARD 1 -i eth0 -j ACCEPT',
+            '-A iptables_firewal-a -s 1.2.3.4/32 -p tcp -m tcp --dport 22 -j ACCEPT',
+            '-A iptables_firewal-a -j iptables_firewal-b',
+            '-A iptables_firewal-a -j DROP',
+            'COMMIT',
+            ''])
+
+    def test_failed_transaction_is_committed_again(self):
+        transaction = IptablesTransaction()
+        IptablesManager('a', table='filter', transaction=transaction).add_rule('-j DROP')
+        self.restore_fails = True
+        self.assertFalse(transaction.commit())
+        self.restore_fails = False
+        self.assertTrue(transaction.commit())
+        self.assertIn('-j DROP', self.restored[-1])
+        self.assertEqual(transaction.namespaces, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# encoding=utf-8
+
+import os
+import socket
+import subprocess
+
+import ip_lib
+import netlink_lib
+from tests import base
+
+
+class NetlinkHelpersTest(base.TestCase):
+    def test_parse_cidr(self):
+        self.assertEqual((socket.AF_INET, '\x05\x05\x05\x00', 24),
+                         netlink_lib._parse_cidr('5.5.5.0/24'))
+        self.assertEqual((socket.AF_INET, '\x01\x01\x01\x01', 32),
+                         netlink_lib._parse_cidr('1.1.1.1'))
+        self.assertEqual(128, netlink_lib._parse_cidr('fe80::1')[2])
+        self.assertEqual((socket.AF_INET, None, 0), netlink_lib._parse_cidr('default'))
+
+    def test_table(self):
+        self.assertEqual(254, netlink_lib._table(None))
+        self.assertEqual(255, netlink_lib._table('local'))
+        self.assertEqual(100, netlink_lib._table('100'))
+
+    def test_attrs(self):
+        data = (netlink_lib._attr_str(netlink_lib.IFLA_IFNAME, 'tap1') +
+                netlink_lib._attr_u32(netlink_lib.IFLA_MTU, 1450))
+        attrs = netlink_lib._parse_attrs(data)
+        self.assertEqual('tap1', netlink_lib._str(attrs[netlink_lib.IFLA_IFNAME]))
+        self.assertEqual(1450, netlink_lib._u32(attrs[netlink_lib.IFLA_MTU]))
+
+
+# 在两个临时命名空间中测试真实的netlink操作, 需要root
+class NetlinkNamespaceTest(base.TestCase):
+    def setUp(self):
+        super(NetlinkNamespaceTest, self).setUp()
+        if os.geteuid() != 0:
+            self.skipTest('needs root')
+        self.ns1 = 'nltest-%d-1' % os.getpid()
+        self.ns2 = 'nltest-%d-2' % os.getpid()
+        for ns in (self.ns1, self.ns2):
+            if self._ip('netns', 'add', ns):
+                self.skipTest('cannot create network namespaces')
+            self.addCleanup(self._ip, 'netns', 'del', ns)
+            self.addCleanup(netlink_lib.forget_iproute, ns)
+        self.iproute = netlink_lib.get_iproute(self.ns1)
+
+    def _ip(self, *args):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(('ip',) + args, stdout=devnull, stderr=devnull)
+
+    def test_links(self):
+        self.iproute.link_add('br-t', 'bridge')
+        self.iproute.link_add('veth-a', 'veth', peer='veth-b', peer_namespace=self.ns2)
+        self.iproute.link_set('veth-a', up=True, mtu=1400, master='br-t')
+        links = dict((link['name'], link) for link in self.iproute.links())
+        self.assertEqual('bridge', links['br-t']['kind'])
+        self.assertTrue(links['veth-a']['up'])
+        self.assertEqual(1400, links['veth-a']['mtu'])
+        self.assertEqual(links['br-t']['index'], links['veth-a']['master'])
+        self.assertIsNone(self.iproute.link_lookup('veth-b'))
+        self.assertIsNotNone(netlink_lib.get_iproute(self.ns2).link_lookup('veth-b'))
+
+        self.iproute.link_del('veth-a')
+        self.assertIsNone(self.iproute.link_lookup('veth-a'))
+        self.assertRaises(netlink_lib.NetlinkError, self.iproute.link_del, 'veth-a')
+
+    def test_addresses_and_routes(self):
+        self.iproute.link_add('veth-a', 'veth', peer='veth-b')
+        self.iproute.link_set('veth-a', up=True)
+        self.iproute.addr_add('veth-a', '10.1.0.1/24')
+        self.assertEqual([('10.1.0.1', 24)], [(a['address'], a['prefixlen'])
+                                              for a in self.iproute.addrs('veth-a')])
+        self.assertRaises(netlink_lib.NetlinkError,
+                          self.iproute.addr_add, 'veth-a', '10.1.0.1/24')
+
+        self.iproute.route_replace('5.5.5.0/24', dev='veth-a', scope='link')
+        self.iproute.route_replace('default', gateway='10.1.0.254', dev='veth-a', metric=5)
+        routes = dict((r['dst'], r) for r in self.iproute.routes(dev='veth-a'))
+        self.assertEqual(netlink_lib.RT_SCOPES['link'], routes['5.5.5.0/24']['scope'])
+        self.assertIsNone(routes['5.5.5.0/24']['prefsrc'])
+        self.assertEqual('10.1.0.254', routes['default']['gateway'])
+        self.assertEqual(5, routes['default']['metric'])
+        # the route of the address' own subnet carries a prefsrc
+        self.assertEqual('10.1.0.1', routes['10.1.0.0/24']['prefsrc'])
+
+        self.iproute.route_del('5.5.5.0/24', dev='veth-a')
+        self.assertNotIn('5.5.5.0/24', [r['dst'] for r in self.iproute.routes()])
+        self.iproute.addr_flush('veth-a')
+        self.assertEqual([], self.iproute.addrs('veth-a'))
+
+    def test_onlink_routes_match_the_command_backend(self):
+        self.iproute.link_add('veth-a', 'veth', peer='veth-b')
+        self.iproute.link_set('veth-a', up=True)
+        self.iproute.addr_add('veth-a', '10.1.0.1/24')
+        self.patch(ip_lib, 'IP_LIB_BACKEND', 'netlink')
+        device = ip_lib.IPDevice('veth-a', namespace=self.ns1)
+        device.route.add_onlink_route('5.5.5.0/24', 'veth-a')
+        device.route.add_onlink_route('6.6.6.0/24', 'veth-a')
+        netlink_routes = device.route.list_onlink_routes()
+        self.patch(ip_lib, 'IP_LIB_BACKEND', 'command')
+        self.assertEqual(['5.5.5.0/24', '6.6.6.0/24'], sorted(netlink_routes))
+        self.assertEqual(sorted(netlink_routes), sorted(device.route.list_onlink_routes()))
@@ -0,0 +1,362 @@
+# encoding=utf-8
+
+import json
+
+import ovs_lib
+import ovsdb_client
+from tests import base
+
+
+# run_vsctl的替身: 记录参数, 返回self.output
+class OVSTestCase(base.TestCase):
+    output = ''
+
+    def setUp(self):
+        super(OVSTestCase, self).setUp()
+        self.vsctl_calls = []
+        self.ovs = ovs_lib.BaseOVS('br-test', ovsdb_interface='vsctl')
+        self.patch(self.ovs, 'run_vsctl', self._run_vsctl)
+
+    def _run_vsctl(self, args):
+        self.vsctl_calls.append(args)
+        return self.output
+
+
+class AddPortTest(OVSTestCase):
+    def test_tag_is_set_in_the_same_transaction(self):
+        self.ovs.add_port('qvo-1', 10)
+        self.assertEqual([['--', '--may-exist', 'add-port', 'br-test', 'qvo-1',
+                           '--', 'set', 'port', 'qvo-1', 'tag=10']], self.vsctl_calls)
+
+    def test_no_tag(self):
+        self.ovs.add_port('qvo-1')
+        self.ovs.add_port('qvo-2', 0)
+        self.assertEqual([['--', '--may-exist', 'add-port', 'br-test', 'qvo-1'],
+                          ['--', '--may-exist', 'add-port', 'br-test', 'qvo-2']],
+                         self.vsctl_calls)
+
+    def test_transaction(self):
+        with self.ovs.transaction() as txn:
+            txn.add_port('qvo-1', tag=10)
+            txn.add_port_internal('l3-1', vlan='20')
+            txn.del_port('qvo-2')
+        self.assertEqual([[
+            '--', '--may-exist', 'add-port', 'br-test', 'qvo-1',
+            '--', 'set', 'port', 'qvo-1', 'tag=10',
+            '--', '--may-exist', 'add-port', 'br-test', 'l3-1',
+            '--', 'set', 'port', 'l3-1', 'tag=20',
+            '--', 'set', 'interface', 'l3-1', 'type=internal',
+            '--', '--if-exists', 'del-port', 'br-test', 'qvo-2',
+        ]], self.vsctl_calls)
+
+
+# OVSDB_INTERFACE='native'时的查询, 连到OVSDBStubServer
+class NativeOVSTest(base.OVSDBTestCase):
+    def setUp(self):
+        super(NativeOVSTest, self).setUp()
+        client = ovsdb_client.OVSDBClient(self.ovsdb_path, timeout=5)
+        self.addCleanup(client.close)
+        self.patch(ovs_lib, 'get_ovsdb_client', lambda: client)
+        self.patch(ovs_lib, 'OVSDB_MONITOR', False)
+        self.ovs = ovs_lib.BaseOVS('br0', ovsdb_interface='native')
+        self.patch(self.ovs, 'run_vsctl', self._run_vsctl)
+        port = self.server.add_row('Port', name='qvo-1', tag=[])
+        self.server.add_row('Bridge', name='br0', ports=[port])
+        self.server.add_row('Interface', name='qvo-1', ofport=5,
+                            external_ids={'iface-id': 'abc', 'attached-mac': 'fa:16:3e:00:00:01'})
+        self.server.add_row('Interface', name='qvo-2', ofport=[])
+
+    def _run_vsctl(self, args):
+        raise AssertionError('ovs-vsctl called with {}'.format(args))
+
+    def test_get_port_ofport(self):
+        self.assertEqual('5', self.ovs.get_port_ofport('qvo-1'))
+        self.assertEqual(ovs_lib.INVALID_OFPORT, self.ovs.get_port_ofport('qvo-2'))
+        self.assertEqual(ovs_lib.INVALID_OFPORT, self.ovs.get_port_ofport('qvo-3'))
+
+    def test_port_exists(self):
+        self.assertTrue(self.ovs.port_exists('qvo-1'))
+        self.assertFalse(self.ovs.port_exists('qvo-2'))
+
+    def test_bridge_exists(self):
+        self.assertTrue(self.ovs.bridge_exists('br0'))
+        self.assertFalse(self.ovs.bridge_exists('br1'))
+
+    def test_db_get_map(self):
+        self.assertEqual({'iface-id': 'abc', 'attached-mac': 'fa:16:3e:00:00:01'},
+                         self.ovs.db_get_map('Interface', 'qvo-1', 'external_ids'))
+        self.assertEqual({}, self.ovs.db_get_map('Interface', 'qvo-3', 'external_ids'))
+
+    def test_get_all_port_stats(self):
+        self.server.add_row('Interface', name='qvo-4', ofport=7,
+                            statistics={'rx_packets': 9}, admin_state='up')
+        self.assertEqual({'qvo-1': {'statistics': {}, 'ofport': 5,
+                                    'admin_state': None, 'link_state': None}},
+                         self.ovs.get_all_port_stats(ttl=0))
+        stats = self.ovs.get_all_port_stats(ttl=0, all_bridges=True)
+        self.assertEqual(['qvo-1', 'qvo-2', 'qvo-4'], sorted(stats))
+        self.assertEqual({'rx_packets': 9}, stats['qvo-4']['statistics'])
+
+
+def flow_fields(line):
+    return sorted(line.split(','))
+
+
+class BulkFlowsTest(base.TestCase):
+    def setUp(self):
+        super(BulkFlowsTest, self).setUp()
+        self.patch(ovs_lib.LogExceptionHelp, 'logException',
+                   staticmethod(lambda msg: None))
+        self.ovs = ovs_lib.BaseOVS('br-test', cookie=0x10)
+
+    def test_add_flows_in_one_process(self):
+        executor = self.fake_executor(base.command_result())
+        failed = self.ovs.add_flows([{'priority': 10, 'in_port': 1, 'actions': 'drop'},
+                                     'priority=5,actions=normal'], bundle=True)
+        self.assertEqual([], failed)
+        self.assertEqual(1, len(executor.calls))
+        cmd, stdin = executor.calls[0]
+        self.assertEqual(['ovs-ofctl', '--bundle', 'add-flows', 'br-test', '-'], cmd)
+        lines = stdin.splitlines()
+        self.assertEqual(flow_fields('hard_timeout=0,idle_timeout=0,priority=10,'
+                                     'cookie=0x10,in_port=1,actions=drop'),
+                         flow_fields(lines[0]))
+        self.assertEqual('priority=5,actions=normal', lines[1])
+
+    def test_remove_flows_is_strict(self):
+        executor = self.fake_executor(base.command_result())
+        self.ovs.remove_flows([{'table': 0, 'actions': 'drop'}])
+        self.assertEqual((['ovs-ofctl', '--strict', 'del-flows', 'br-test', '-'],
+                          'table=0\n'), executor.calls[0])
+
+    def test_errors_are_attributed_to_their_flows(self):
+        stderr = 'ovs-ofctl: -:2: unknown keyword foo\n'
+        self.fake_executor(base.command_result(1, stderr=stderr))
+        flows = [{'in_port': 1, 'actions': 'drop'}, 'foo=1,actions=drop',
+                 {'in_port': 2}]
+        failed = self.ovs.add_flows(flows)
+        self.assertEqual([({'in_port': 2}, 'no actions'),
+                          ('foo=1,actions=drop', 'unknown keyword foo')], failed)
+
+    def test_unattributed_failure_fails_every_flow(self):
+        stderr = 'ovs-ofctl: br-test is not a bridge or a socket'
+        self.fake_executor(base.command_result(1, stderr=stderr))
+        failed = self.ovs.add_flows(['actions=drop', 'actions=normal'])
+        self.assertEqual([('actions=drop', stderr), ('actions=normal', stderr)], failed)
+
+    def test_nothing_to_send(self):
+        executor = self.fake_executor()
+        self.assertEqual([], self.ovs.add_flows([]))
+        self.assertEqual([], executor.calls)
+
+
+class FlowKeyTest(base.TestCase):
+    def test_protocol_fields_become_the_shortcut(self):
+        dumped = ovs_lib._flow_key({'table': '0', 'priority': '10', 'proto': 'tcp',
+                                    'tp_dst': '80', 'actions': 'drop'})
+        self.assertEqual(dumped, ovs_lib._flow_key(
+            {'table': 0, 'priority': 10, 'dl_type': '0x0800', 'nw_proto': 6,
+             'tp_dst': 80, 'actions': 'normal'}))
+        self.assertEqual(dumped, ovs_lib._flow_key(
+            {'table': 0, 'priority': 10, 'proto': 'ip', 'nw_proto': '6', 'tp_dst': 80}))
+
+    def test_ip_protocol_without_shortcut(self):
+        self.assertEqual(ovs_lib._flow_key({'proto': 'ip', 'nw_proto': '47'}),
+                         ovs_lib._flow_key({'dl_type': '0x800', 'nw_proto': '47'}))
+
+    def test_defaults_and_stat_fields(self):
+        self.assertEqual(ovs_lib._flow_key({'table': '0', 'priority': '32768', 'proto': 'arp',
+                                            'n_packets': '3', 'cookie': '0x10'}),
+                         ovs_lib._flow_key({'dl_type': 0x0806}))
+
+    def test_port_names_become_ofports(self):
+        ofports = {'qvo-1': '5', 'qvo-2': ovs_lib.INVALID_OFPORT}
+        self.assertEqual(ovs_lib._flow_key({'in_port': '5'}),
+                         ovs_lib._flow_key({'in_port': 'qvo-1'}, ofports))
+        self.assertEqual(('0', '32768', frozenset([('in_port', 'qvo-2')])),
+                         ovs_lib._flow_key({'in_port': 'qvo-2'}, ofports))
+
+
+class SyncFlowsTest(base.TestCase):
+    dumped = (' cookie=0x10, duration=1.2s, table=0, n_packets=0, n_bytes=0, '
+              'priority=10,tcp,in_port=5,tp_dst=80 actions=drop\n'
+              ' cookie=0x10, duration=1.2s, table=0, n_packets=0, n_bytes=0, '
+              'priority=20,arp actions=NORMAL\n'
+              ' cookie=0x10, duration=1.2s, table=0, n_packets=0, n_bytes=0, '
+              'priority=30,ip actions=drop\n')
+
+    def setUp(self):
+        super(SyncFlowsTest, self).setUp()
+        self.patch(ovs_lib.LogExceptionHelp, 'logException',
+                   staticmethod(lambda msg: None))
+        self.ovs = ovs_lib.BaseOVS('br-test', cookie=0x10)
+        self.patch(self.ovs, 'get_port_ofports',
+                   lambda names: dict((name, '5') for name in names))
+
+    def test_only_the_difference_is_sent(self):
+        executor = self.fake_executor(base.command_result(stdout=self.dumped),
+                                      base.command_result(), base.command_result(),
+                                      base.command_result())
+        result = self.ovs.sync_flows([
+            # the same flow, written with a port name and dl_type/nw_proto
+            {'priority': 10, 'dl_type': '0x0800', 'nw_proto': 6, 'in_port': 'qvo-1',
+             'tp_dst': 80, 'actions': 'drop'},
+            {'priority': 20, 'proto': 'arp', 'actions': 'drop'},
+            {'priority': 40, 'proto': 'udp', 'actions': 'normal'},
+        ])
+        self.assertEqual({'add': 1, 'mod': 1, 'del': 1, 'failed': []}, result)
+        self.assertEqual(['ovs-ofctl', 'dump-flows', 'br-test', 'cookie=0x10/-1'],
+                         executor.calls[0][0])
+        (del_cmd, deleted), (add_cmd, added), (mod_cmd, modified) = executor.calls[1:]
+        self.assertEqual(['ovs-ofctl', '--strict', 'del-flows', 'br-test', '-'], del_cmd)
+        self.assertEqual('table=0,priority=30,cookie=0x10/-1,ip\n', deleted)
+        self.assertEqual(['ovs-ofctl', 'add-flows', 'br-test', '-'], add_cmd)
+        self.assertEqual(flow_fields('hard_timeout=0,idle_timeout=0,priority=40,'
+                                     'cookie=0x10,udp,actions=normal'),
+                         flow_fields(added.strip()))
+        self.assertEqual(['ovs-ofctl', '--strict', 'mod-flows', 'br-test', '-'], mod_cmd)
+        self.assertEqual(flow_fields('priority=20,arp,cookie=0x10/-1,actions=drop'),
+                         flow_fields(modified.strip()))
+
+    def test_in_sync_sends_nothing(self):
+        executor = self.fake_executor(base.command_result(stdout=self.dumped))
+        result = self.ovs.sync_flows([
+            {'priority': 10, 'proto': 'tcp', 'in_port': 5, 'tp_dst': 80, 'actions': 'drop'},
+            {'priority': 20, 'proto': 'arp', 'actions': 'normal'},
+            {'priority': 30, 'proto': 'ip', 'actions': 'drop'},
+        ])
+        self.assertEqual({'add': 0, 'mod': 0, 'del': 0, 'failed': []}, result)
+        self.assertEqual(1, len(executor.calls))
+
+    def test_refused_without_a_cookie(self):
+        executor = self.fake_executor()
+        self.ovs.cookie = None
+        self.assertFalse(self.ovs.sync_flows([{'actions': 'drop'}]))
+        self.assertEqual([], executor.calls)
+
+    def test_dump_failure(self):
+        self.fake_executor(base.command_result(1, stderr='not a bridge'))
+        self.assertFalse(self.ovs.sync_flows([]))
+
+
+class ParseFlowTest(base.TestCase):
+    line = (' cookie=0x4e4c, duration=12.345s, table=1, n_packets=7, n_bytes=686, '
+            'idle_age=3, priority=100,ip,in_port=2,nw_src=10.0.0.1 '
+            'actions=mod_vlan_vid:10,output:3\n')
+
+    def test_parse_flow_record(self):
+        self.assertEqual(ovs_lib.FlowRecord(0x4e4c, 1, 100, 'ip,in_port=2,nw_src=10.0.0.1',
+                                            'mod_vlan_vid:10,output:3', 7, 686, 3),
+                         ovs_lib.parse_flow_record(self.line))
+
+    def test_parse_flow_record_defaults(self):
+        record = ovs_lib.parse_flow_record(' duration=1s, n_packets=0, actions=drop')
+        self.assertEqual(ovs_lib.FlowRecord(0, 0, 32768, '', 'drop', 0, 0, None), record)
+
+    def test_parse_flow(self):
+        self.assertEqual({'cookie': '0x4e4c', 'table': '1', 'priority': '100',
+                          'proto': 'ip', 'in_port': '2', 'nw_src': '10.0.0.1',
+                          'actions': 'mod_vlan_vid:10,output:3'},
+                         ovs_lib.parse_flow(self.line))
+
+    def test_not_a_flow(self):
+        for line in ('NXST_FLOW reply (xid=0x4):', '', 'cookie=0x1, table=0, '
+                     'priority=1,reg_actions=1'):
+            self.assertIsNone(ovs_lib.parse_flow_record(line))
+            self.assertIsNone(ovs_lib.parse_flow(line))
+
+    def test_iter_flows(self):
+        other = self.line.replace('in_port=2', 'in_port=4')
+        executor = self.fake_executor(base.command_result(
+            stdout='NXST_FLOW reply (xid=0x4):\n' + self.line + other))
+        ovs = ovs_lib.BaseOVS('br-test')
+        records = list(ovs.iter_flows(table=1, cookie=0x4e4c, mask=0xffff,
+                                      match_prefix='ip,in_port=4'))
+        self.assertEqual(['ovs-ofctl', 'dump-flows', 'br-test', 'table=1,cookie=0x4e4c/0xffff'],
+                         executor.calls[0][0])
+        self.assertEqual(['ip,in_port=4,nw_src=10.0.0.1'], [r.match for r in records])
+
+    def test_iter_flows_failure(self):
+        self.fake_executor(base.command_result(1, stderr='not a bridge'))
+        ovs = ovs_lib.BaseOVS('br-test')
+        self.assertRaises(RuntimeError, list, ovs.iter_flows())
+        self.fake_executor(base.command_result(1, stderr='not a bridge'))
+        self.assertFalse(ovs.count_flows())
+
+
+class PortStatsTest(OVSTestCase):
+    output = (0, json.dumps({
+        'headings': ['name', 'statistics', 'ofport', 'admin_state', 'link_state'],
+        'data': [
+            ['qvo-1', ['map', [['rx_packets', 5], ['tx_packets', 7]]], 3, 'up', 'up'],
+            ['qvo-2', ['map', []], ['set', []], ['set', []], ['set', []]],
+            ['eth0', ['map', [['rx_packets', 1]]], 1, 'up', 'down'],
+        ]}) + '\nqvo-1\nqvo-2\n')
+
+    def setUp(self):
+        super(PortStatsTest, self).setUp()
+        ovs_lib._port_stats_cache.clear()
+        self.addCleanup(ovs_lib._port_stats_cache.clear)
+
+    def test_one_call_for_the_bridge(self):
+        stats = self.ovs.get_all_port_stats(ttl=0)
+        self.assertEqual([['--format=json', '--columns=name,statistics,ofport,admin_state,link_state',
+                           'list', 'Interface', '--', 'list-ports', 'br-test']],
+                         self.vsctl_calls)
+        self.assertEqual({
+            'qvo-1': {'statistics': {'rx_packets': 5, 'tx_packets': 7}, 'ofport': 3,
+                      'admin_state': 'up', 'link_state': 'up'},
+            'qvo-2': {'statistics': {}, 'ofport': -1, 'admin_state': None, 'link_state': None},
+        }, stats)
+
+    def test_all_bridges(self):
+        stats = self.ovs.get_all_port_stats(ttl=0, all_bridges=True)
+        self.assertEqual(['eth0', 'qvo-1', 'qvo-2'], sorted(stats))
+        self.assertNotIn('list-ports', self.vsctl_calls[0])
+
+    def test_cached_for_ttl(self):
+        first = self.ovs.get_all_port_stats(ttl=60)
+        self.assertIs(first, ovs_lib.BaseOVS('br-test').get_all_port_stats(ttl=60))
+        self.assertEqual(1, len(self.vsctl_calls))
+        self.ovs.get_all_port_stats(ttl=0)
+        self.assertEqual(2, len(self.vsctl_calls))
+
+    def test_failure(self):
+        self.output = (1, '')
+        self.assertIsNone(self.ovs.get_all_port_stats(ttl=60))
+        self.assertEqual({}, ovs_lib._port_stats_cache)
+
+
+# OVSDB_MONITOR开启时的查询, 从连到OVSDBStubServer的OVSDBCache读取
+class MonitorCacheOVSTest(base.OVSDBTestCase):
+    def setUp(self):
+        super(MonitorCacheOVSTest, self).setUp()
+        self.cache = ovsdb_client.OVSDBCache(self.ovsdb_path, retry_interval=0.01)
+        self.addCleanup(self.cache.stop)
+        self.patch(ovs_lib, 'OVSDB_MONITOR', True)
+        self.patch(ovs_lib, 'get_ovsdb_cache', lambda: self.cache)
+        self.vsctl_calls = []
+        self.ovs = ovs_lib.BaseOVS('br0')
+        self.patch(self.ovs, 'run_vsctl', self._run_vsctl)
+        port = self.server.add_row('Port', name='qvo-1')
+        internal = self.server.add_row('Port', name='br0')
+        self.server.add_row('Bridge', name='br0', ports=[port, internal])
+
+    def _run_vsctl(self, args):
+        self.vsctl_calls.append(args)
+        return 0, 'br0\n'
+
+    def test_lookups_from_the_cache(self):
+        self.cache.start()
+        self.wait_for(lambda: self.cache.synced)
+        self.assertTrue(self.ovs.bridge_exists('br0'))
+        self.assertFalse(self.ovs.bridge_exists('br1'))
+        self.assertTrue(self.ovs.port_exists('qvo-1'))
+        self.assertFalse(self.ovs.port_exists('qvo-2'))
+        self.assertEqual('br0', self.ovs.get_bridge_name_for_port_name('qvo-1'))
+        self.assertEqual(['qvo-1'], self.ovs.get_port_name_list())
+        self.assertEqual([], self.vsctl_calls)
+
+    def test_falls_back_to_vsctl_until_synced(self):
+        self.assertTrue(self.ovs.bridge_exists('br0'))
+        self.assertEqual([['br-exists', 'br0']], self.vsctl_calls)
@@ -0,0 +1,95 @@
+# encoding=utf-8
+
+from ovsdb_client import OVSDBClient, OVSDBCache, OVSDBError
+from tests import base
+
+
+class OVSDBClientTest(base.OVSDBTestCase):
+    def setUp(self):
+        super(OVSDBClientTest, self).setUp()
+        self.client = OVSDBClient(self.ovsdb_path, timeout=5)
+        self.addCleanup(self.client.close)
+
+    def test_select(self):
+        self.server.add_row('Interface', name='qvo-1', ofport=5)
+        self.server.add_row('Interface', name='qvo-2', ofport=6)
+        rows = self.client.select('Interface', [['name', '==', 'qvo-2']],
+                                  ['name', 'ofport'])
+        self.assertEqual([{'name': 'qvo-2', 'ofport': 6}], rows)
+        self.assertEqual(2, len(self.client.select('Interface', [])))
+
+    def test_get_columns_in_one_transaction(self):
+        self.server.add_row('Interface', name='qvo-1', ofport=5,
+                            external_ids={'iface-id': 'abc'})
+        self.assertEqual({'qvo-1': 5},
+                         self.client.get_columns('Interface', ['qvo-1', 'qvo-x'], 'ofport'))
+        self.assertEqual({'iface-id': 'abc'},
+                         self.client.get_column('Interface', 'qvo-1', 'external_ids'))
+        self.assertIsNone(self.client.get_column('Interface', 'qvo-x', 'ofport'))
+
+    def test_record_exists_and_update(self):
+        self.server.add_row('Port', name='qvo-1', tag=[])
+        self.assertTrue(self.client.record_exists('Port', 'qvo-1'))
+        self.assertFalse(self.client.record_exists('Port', 'qvo-2'))
+        self.assertEqual(1, self.client.update('Port', 'qvo-1', {'tag': 10}))
+        self.assertEqual(10, self.client.get_column('Port', 'qvo-1', 'tag'))
+
+    def test_pipelined_requests(self):
+        self.assertEqual([['a'], ['Open_vSwitch'], ['b']],
+                         self.client.requests([('echo', ['a']), ('list_dbs', []),
+                                               ('echo', ['b'])]))
+
+    def test_errors(self):
+        self.assertRaises(OVSDBError, self.client.request, 'no_such_method', [])
+        self.assertRaises(OVSDBError, self.client.transact,
+                          {'op': 'mutate', 'table': 'Port', 'where': []})
+        self.server.stop()
+        self.client.close()
+        self.assertRaises(OVSDBError, self.client.request, 'echo', [])
+
+
+class OVSDBCacheTest(base.OVSDBTestCase):
+    def setUp(self):
+        super(OVSDBCacheTest, self).setUp()
+        self.port = self.server.add_row('Port', name='qvo-1', interfaces=[])
+        self.internal = self.server.add_row('Port', name='br0', interfaces=[])
+        self.bridge = self.server.add_row('Bridge', name='br0',
+                                          ports=[self.port, self.internal])
+        self.cache = OVSDBCache(self.ovsdb_path, retry_interval=0.01)
+        self.addCleanup(self.cache.stop)
+
+    def test_not_synced_answers_none(self):
+        self.assertIsNone(self.cache.bridge_exists('br0'))
+        self.assertIsNone(self.cache.port_bridge('qvo-1'))
+
+    def test_lookups(self):
+        self.cache.start()
+        self.wait_for(lambda: self.cache.synced)
+        self.assertEqual(['br0'], self.cache.bridges())
+        self.assertTrue(self.cache.bridge_exists('br0'))
+        self.assertFalse(self.cache.bridge_exists('br1'))
+        self.assertTrue(self.cache.port_exists('qvo-1'))
+        self.assertEqual('br0', self.cache.port_bridge('qvo-1'))
+        self.assertFalse(self.cache.port_bridge('qvo-2'))
+        self.assertEqual(['qvo-1'], self.cache.bridge_ports('br0'))
+
+    def test_updates(self):
+        self.cache.start()
+        self.wait_for(lambda: self.cache.synced)
+        port = self.server.add_row('Port', name='qvo-2', interfaces=[])
+        self.server.update_row('Bridge', self.bridge,
+                               ports=[self.port, self.internal, port])
+        self.wait_for(lambda: self.cache.port_bridge('qvo-2') == 'br0')
+        self.server.delete_row('Port', self.port)
+        self.wait_for(lambda: not self.cache.port_exists('qvo-1'))
+        self.assertEqual(['qvo-2'], self.cache.bridge_ports('br0'))
+
+    def test_resync_after_the_connection_drops(self):
+        self.cache.start()
+        self.wait_for(lambda: self.cache.synced)
+        for handler in list(self.server.handlers):
+            handler.kill()
+        self.wait_for(lambda: not self.cache.synced)
+        self.server.add_row('Bridge', name='br1', ports=[])
+        self.wait_for(lambda: self.cache.synced)
+        self.assertEqual(['br0', 'br1'], self.cache.bridges())
@@ -0,0 +1,177 @@
+# encoding=utf-8
+
+import reconciler
+from config import *
+from encapsulation import get_vm_port_names
+from iptables_firewall import IptablesFirewallDriver
+from tests import base
+
+PORT_UID = '0123456789abcdef0123'
+NET_UID = 'abcdef0123456789abcd'
+L3_UID = '9876543210fedcba9876'
+
+
+# 端口各部分都存在的实际状态, ovs端口的tag为tag
+def port_state(port_uid, tag):
+    names = get_vm_port_names(port_uid)
+    return {
+        'devices': set([names['bridge'], names['bridge_port'], names['ovs_port']]),
+        'masters': {names['bridge_port']: names['bridge']},
+        'namespaces': set(),
+        'ovs_ports': {names['ovs_port']: tag},
+        'ipsets': None,
+        'chains': None,
+    }
+
+
+class ReconcilerTestCase(base.TestCase):
+    def setUp(self):
+        super(ReconcilerTestCase, self).setUp()
+        self.patch(reconciler.LogExceptionHelp, 'logException',
+                   staticmethod(lambda msg: None))
+
+
+class PortDiffTest(ReconcilerTestCase):
+    def test_port_in_place(self):
+        plan = reconciler.diff({'ports': {PORT_UID: {'vm_vlan': 10}}},
+                               port_state(PORT_UID, 10))
+        self.assertEqual([], plan['ports_create'])
+
+    def test_wrong_tag_creates_the_port_again(self):
+        plan = reconciler.diff({'ports': {PORT_UID: {'vm_vlan': '10'}}},
+                               port_state(PORT_UID, 20))
+        self.assertEqual([{'vm_vlan': '10', 'port_uid': PORT_UID}], plan['ports_create'])
+        self.assertNotIn('ports_retag', plan)
+
+    def test_missing_parts(self):
+        names = get_vm_port_names(PORT_UID)
+        desired = {'ports': {PORT_UID: {'vm_vlan': 10}}}
+        for broken in ('device', 'master', 'chains', 'ipset'):
+            state = port_state(PORT_UID, 10)
+            state['chains'] = set(IptablesFirewallDriver(PORT_UID).port_chain_names())
+            state['ipsets'] = {names['ipset']: set()}
+            self.assertEqual([], reconciler.diff(desired, state)['ports_create'])
+            if broken == 'device':
+                state['devices'].remove(names['bridge_port'])
+            elif broken == 'master':
+                state['masters'][names['bridge_port']] = 'qbr-other'
+            elif broken == 'chains':
+                state['chains'].pop()
+            else:
+                state['ipsets'] = {}
+            self.assertEqual(1, len(reconciler.diff(desired, state)['ports_create']), broken)
+
+    def test_port_without_security_group(self):
+        names = get_vm_port_names(PORT_UID)
+        state = port_state(PORT_UID, None)
+        desired = {'ports': {PORT_UID: {'use_sg': False}}}
+        self.assertEqual(1, len(reconciler.diff(desired, state)['ports_create']))
+        state['ovs_ports'][names['vm_port']] = None
+        self.assertEqual([], reconciler.diff(desired, state)['ports_create'])
+
+    def test_prune(self):
+        state = port_state(PORT_UID, 10)
+        state['ovs_ports']['qvo-stale00001'] = 5
+        state['devices'].add('qbr-stale00002')
+        plan = reconciler.diff({'ports': {PORT_UID: {'vm_vlan': 10}}}, state)
+        self.assertEqual([], plan['ports_remove'])
+        plan = reconciler.diff({'ports': {PORT_UID: {'vm_vlan': 10}}}, state, prune=True)
+        self.assertEqual(['stale00001', 'stale00002'], plan['ports_remove'])
+
+    def test_unreadable_ovs_changes_no_ports(self):
+        state = port_state(PORT_UID, 10)
+        state['ovs_ports'] = None
+        plan = reconciler.diff({'ports': {PORT_UID: {'vm_vlan': 10}}}, state, prune=True)
+        self.assertEqual([], plan['ports_create'])
+        self.assertEqual([], plan['ports_remove'])
+
+
+class IpsetDiffTest(ReconcilerTestCase):
+    def test_only_the_sets_that_differ(self):
+        other = 'fedcba9876543210fedc'
+        state = port_state(PORT_UID, 10)
+        state['ipsets'] = {get_vm_port_names(PORT_UID)['ipset']: set(['10.0.0.1']),
+                           get_vm_port_names(other)['ipset']: set(['10.0.0.2'])}
+        plan = reconciler.diff({'ipsets': {PORT_UID: ['10.0.0.1/32'],
+                                           other: ['10.0.0.3', '10.0.1.0/24']}}, state)
+        self.assertEqual({get_vm_port_names(other)['ipset']: ['10.0.0.3', '10.0.1.0/24']},
+                         plan['ipsets'])
+
+    def test_unreadable_ipsets(self):
+        state = port_state(PORT_UID, 10)
+        plan = reconciler.diff({'ipsets': {PORT_UID: ['10.0.0.1']}}, state)
+        self.assertEqual({}, plan['ipsets'])
+
+
+class DhcpDiffTest(ReconcilerTestCase):
+    net = {'ip': '10.0.0.2', 'mask': '24', 'mac': 'fa:16:3e:00:00:01', 'vlan': 10,
+           'hosts': [('10.0.0.5', 'fa:16:3e:00:00:05')]}
+
+    def setUp(self):
+        super(DhcpDiffTest, self).setUp()
+        self.running = True
+        self.hosts = set([('10.0.0.5', 'fa:16:3e:00:00:05')])
+        self.patch(reconciler.Dnsmasq_base, 'is_running', lambda obj: self.running)
+        self.patch(reconciler.Dnsmasq_base, 'read_host_info', lambda obj: self.hosts)
+        self.state = port_state(PORT_UID, 10)
+        self.state['devices'].clear()
+        self.state['ovs_ports'].clear()
+        self.state['namespaces'].add(NS_DHCP_PREFIX + NET_UID[:UID_PREFIX_BIT])
+        self.state['ovs_ports'][NS_DHCP_INTERFACE_PREFIX + NET_UID[:UID_PREFIX_BIT]] = 10
+
+    def _plan(self, prune=False):
+        return reconciler.diff({'dhcp': {NET_UID: self.net}}, self.state, prune)
+
+    def test_in_place(self):
+        self.assertTrue(reconciler.plan_is_empty(self._plan(prune=True)))
+
+    def test_missing_namespace_or_port(self):
+        self.state['ovs_ports'].clear()
+        self.assertEqual([(NET_UID, self.net)], self._plan()['dhcp_create'])
+        # ovs could not be read, the namespace is there
+        self.state['ovs_ports'] = None
+        self.assertEqual([], self._plan()['dhcp_create'])
+
+    def test_not_running_and_hosts(self):
+        self.running = False
+        self.hosts = set()
+        plan = self._plan()
+        self.assertEqual([(NET_UID, self.net)], plan['dhcp_spawn'])
+        self.assertEqual([(NET_UID, self.net, [('10.0.0.5', 'fa:16:3e:00:00:05')])],
+                         plan['dhcp_hosts'])
+
+    def test_prune(self):
+        self.state['namespaces'].add(NS_DHCP_PREFIX + 'stale00001')
+        self.assertEqual(['stale00001'], self._plan(prune=True)['dhcp_remove'])
+        self.assertEqual([], self._plan()['dhcp_remove'])
+
+
+class L3DiffTest(ReconcilerTestCase):
+    router = {'net_uid': NET_UID, 'routes': [('5.5.5.0/24', 'l3-port'),
+                                             ('6.6.6.0/24', 'l3-port')]}
+
+    def setUp(self):
+        super(L3DiffTest, self).setUp()
+        self.namespace = L3_NAMESPACE_PREFIX + L3_UID[:UID_PREFIX_BIT]
+        self.state = port_state(PORT_UID, 10)
+        self.state['namespaces'].add(self.namespace)
+        self.state['ovs_ports'][L3_VM_PORT_PREFIX + NET_UID[:UID_PREFIX_BIT]] = 10
+        self.state['ovs_ports'][L3_STU_PORT_PREFIX + L3_UID[:UID_PREFIX_BIT]] = 20
+        self.routes = {self.namespace: set([('5.5.5.0/24', 'l3-port'),
+                                            ('7.7.7.0/24', 'l3-port')])}
+        self.patch(reconciler, '_snapshot_routes',
+                   lambda namespaces: dict((ns, self.routes[ns]) for ns in namespaces))
+
+    def test_routes(self):
+        plan = reconciler.diff({'l3': {L3_UID: self.router}}, self.state)
+        self.assertEqual([], plan['l3_create'])
+        self.assertEqual({self.namespace: [('6.6.6.0/24', 'l3-port')]}, plan['routes_add'])
+        self.assertEqual({}, plan['routes_del'])
+        plan = reconciler.diff({'l3': {L3_UID: self.router}}, self.state, prune=True)
+        self.assertEqual({self.namespace: [('7.7.7.0/24', 'l3-port')]}, plan['routes_del'])
+
+    def test_missing_router(self):
+        self.state['namespaces'].clear()
+        plan = reconciler.diff({'l3': {L3_UID: self.router}}, self.state)
+        self.assertEqual([(L3_UID, self.router)], plan['l3_create'])
+        self.assertEqual({self.namespace: sorted(self.router['routes'])}, plan['routes_add'])
@@ -0,0 +1,136 @@
+# encoding=utf-8
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from distutils import spawn
+
+import eventlet
+
+import utils
+from utils import CommandExecutor, GreenThreadMixin
+from tests import base
+
+# netns_worker.py的替身, 不进入命名空间, 按WORKER_MODE回应
+FAKE_WORKER = '''
+import json, sys
+mode = %r
+if mode == 'no-start':
+    print(json.dumps({'error': 'no such namespace'}))
+    sys.exit(1)
+print(json.dumps({'ready': True}))
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ''):
+    if mode == 'die':
+        sys.exit(1)
+    request = json.loads(line)
+    print(json.dumps({'returncode': 0, 'stdout': ' '.join(request['cmd']),
+                      'stderr': '', 'timed_out': False}))
+    sys.stdout.flush()
+'''
+
+
+class Ports(GreenThreadMixin):
+    def __init__(self):
+        self.added = []
+
+    def add_port(self, name, tag=None):
+        eventlet.sleep(0.05)
+        self.added.append(name)
+        return name, tag
+
+
+class CommandExecutorTest(unittest.TestCase):
+    def test_run(self):
+        result = CommandExecutor().run(['cat'], process_input='abc')
+        self.assertTrue(result.succeeded)
+        self.assertEqual(result.stdout, 'abc')
+
+    def test_exit_code_and_stderr(self):
+        result = CommandExecutor().run('echo oops >&2; exit 3', shell=True)
+        self.assertFalse(result.succeeded)
+        self.assertEqual((result.returncode, result.stderr), (3, 'oops\n'))
+
+    def test_timeout(self):
+        result = CommandExecutor().run(['sleep', '5'], timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.succeeded)
+        self.assertLess(result.duration, 2)
+
+    def test_concurrency_limit(self):
+        executor = CommandExecutor(concurrency=2, timeout=0)
+        start = time.time()
+        results = executor.run_all([['sleep', '0.2']] * 4)
+        elapsed = time.time() - start
+        self.assertTrue(all(r.succeeded for r in results))
+        self.assertGreater(elapsed, 0.35)
+        self.assertLess(elapsed, 0.75)
+
+    def test_execute(self):
+        self.assertEqual(utils.execute(['echo', 'hi']), (0, 'hi'))
+        self.assertIsNone(utils.execute(['false']))
+
+    def test_exec_cmd_raises(self):
+        self.assertEqual(utils.exec_cmd(['echo', 'hi']), 'hi\n')
+        self.assertRaises(RuntimeError, utils.exec_cmd, ['false'])
+
+
+class GreenThreadMixinTest(unittest.TestCase):
+    def test_spawn_method(self):
+        ports = Ports()
+        start = time.time()
+        threads = [ports.spawn.add_port('p%d' % i, tag=i) for i in range(5)]
+        self.assertEqual([t.wait() for t in threads], [('p%d' % i, i) for i in range(5)])
+        self.assertLess(time.time() - start, 0.2)
+
+    def test_not_a_method(self):
+        ports = Ports()
+        self.assertRaises(AttributeError, getattr, ports.spawn, 'added')
+        self.assertRaises(AttributeError, getattr, ports.spawn, 'no_such_method')
+
+
+class NetnsWorkerFallbackTest(base.TestCase):
+    cmd = ['ip', 'netns', 'exec', 'nltest-no-such-ns', 'echo', 'hi']
+
+    def setUp(self):
+        super(NetnsWorkerFallbackTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(utils, 'NETNS_USE_WORKERS', True)
+        self.patch(utils.LogExceptionHelp, 'logException', staticmethod(lambda msg: None))
+        self.addCleanup(utils.forget_netns_worker, self.cmd[3])
+
+    def _worker(self, mode):
+        script = os.path.join(self.tmpdir, 'worker_%s.py' % mode)
+        with open(script, 'w') as f:
+            f.write(FAKE_WORKER % mode)
+        self.patch(utils, 'NETNS_WORKER_SCRIPT', script)
+        utils.forget_netns_worker(self.cmd[3])
+
+    def test_run_in_worker(self):
+        self._worker('ok')
+        result = CommandExecutor().run(self.cmd)
+        self.assertTrue(result.succeeded)
+        self.assertEqual('echo hi', result.stdout)
+
+    def test_worker_died_after_the_command_was_sent(self):
+        self._worker('die')
+        result = CommandExecutor().run(self.cmd)
+        self.assertFalse(result.succeeded)
+        self.assertEqual(-1, result.returncode)
+        self.assertIn('after the command was sent', result.stderr)
+
+    def test_worker_failed_to_start_falls_back(self):
+        if not spawn.find_executable('ip'):
+            self.skipTest('needs ip')
+        self._worker('no-start')
+        result = CommandExecutor().run(self.cmd)
+        self.assertFalse(result.succeeded)
+        self.assertNotIn('netns worker', result.stderr)
+        self.assertIn('nltest-no-such-ns', result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
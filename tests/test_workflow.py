@@ -0,0 +1,96 @@
+# encoding=utf-8
+
+import time
+
+import eventlet
+
+import workflow
+from workflow import Workflow, WorkflowError, no_failures
+from tests import base
+
+
+class WorkflowTest(base.TestCase):
+    def setUp(self):
+        super(WorkflowTest, self).setUp()
+        self.patch(workflow.LogExceptionHelp, 'logException',
+                   staticmethod(lambda msg: None))
+        self.calls = []
+
+    # 记录调用顺序, 睡眠delay秒后返回result
+    def _step(self, name, delay=0, result=True):
+        def step():
+            self.calls.append(name)
+            eventlet.sleep(delay)
+            return result
+        step.__name__ = name
+        return step
+
+    def _diamond(self, **kwargs):
+        wf = Workflow('test', dry_run=False)
+        wf.add('a', self._step('a', **kwargs.get('a', {})))
+        wf.add('b', self._step('b', **kwargs.get('b', {})), requires=['a'], check=bool)
+        wf.add('c', self._step('c', **kwargs.get('c', {})), requires=['a'])
+        wf.add('d', self._step('d'), requires=['b', 'c'])
+        return wf
+
+    def test_levels(self):
+        wf = self._diamond()
+        self.assertEqual([['a'], ['b', 'c'], ['d']],
+                         [[s.name for s in level] for level in wf.levels()])
+        self.assertIn('  2. b: b() after a', wf.plan())
+
+    def test_bad_dependencies(self):
+        wf = Workflow('test', dry_run=False)
+        wf.add('a', self._step('a'), requires=['b'])
+        self.assertRaises(WorkflowError, wf.levels)
+        wf.add('b', self._step('b'), requires=['a'])
+        self.assertRaises(WorkflowError, wf.run)
+        self.assertRaises(WorkflowError, wf.add, 'a', self._step('a'))
+        self.assertEqual([], self.calls)
+
+    def test_independent_steps_overlap(self):
+        wf = self._diamond(b={'delay': 0.2}, c={'delay': 0.2})
+        start = time.time()
+        self.assertTrue(wf.run())
+        self.assertLess(time.time() - start, 0.35)
+        self.assertEqual('a', self.calls[0])
+        self.assertEqual('d', self.calls[-1])
+        self.assertTrue(wf.done)
+
+    def test_critical_path(self):
+        wf = self._diamond(b={'delay': 0.01}, c={'delay': 0.2})
+        wf.run()
+        self.assertEqual(['a', 'c', 'd'], wf.critical_path())
+        self.assertTrue(wf.report().startswith('test took'))
+        self.assertIn('a -> c -> d', wf.report())
+
+    def test_failed_check_skips_dependents(self):
+        wf = self._diamond(b={'result': False})
+        self.assertFalse(wf.run())
+        self.assertEqual(['done', 'failed', 'done', 'skipped'],
+                         [s.state for s in wf.steps])
+        self.assertNotIn('d', self.calls)
+        self.assertIn('returned False', str(wf['b'].error))
+
+    def test_exception_skips_dependents(self):
+        wf = Workflow('test', dry_run=False)
+        wf.add('a', lambda: 1 / 0)
+        wf.add('b', self._step('b'), requires=['a'])
+        wf.add('c', self._step('c'), requires=['b'])
+        wf.add('d', self._step('d'))
+        self.assertFalse(wf.run())
+        self.assertEqual(['failed', 'skipped', 'skipped', 'done'],
+                         [s.state for s in wf.steps])
+        self.assertIsInstance(wf['a'].error, ZeroDivisionError)
+        self.assertEqual(['d'], self.calls)
+
+    def test_no_failures(self):
+        self.assertTrue(no_failures([]))
+        self.assertTrue(no_failures(None))
+        self.assertFalse(no_failures([('ns', 'link show', 'error')]))
+
+    def test_dry_run(self):
+        wf = self._diamond()
+        wf.dry_run = True
+        self.assertTrue(wf.run())
+        self.assertEqual([], self.calls)
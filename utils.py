@@ -1,18 +1,342 @@
 # encoding=utf-8
 
-import commands
 from LogException import *
+from config import *
+import json
+import re
 import subprocess
 import signal
 import shlex
+import sys
+import time
+import eventlet
+from eventlet import greenpool
 from eventlet import greenthread
+from eventlet import semaphore
+from eventlet.green import subprocess as green_subprocess
 
+NETNS_EXEC_RE = re.compile(r'^\s*ip\s+netns\s+exec\s+(\S+)\s+(.*)$', re.S)
+NETNS_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'netns_worker.py')
+# output crosses the worker pipe as JSON without losing bytes
+NETNS_WORKER_ENCODING = 'latin-1'
 
-def execute(cmd, return_stdout=True):
+
+class CommandResult(object):
+    """The outcome of one command run by CommandExecutor."""
+
+    def __init__(self, cmd, returncode, stdout, stderr, duration,
+                 timed_out=False):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return ("CommandResult(cmd=%(cmd)r, returncode=%(returncode)s, "
+                "duration=%(duration).3f, timed_out=%(timed_out)s)") % self.__dict__
+
+
+class CommandExecutor(object):
+    """Runs commands as green subprocesses.
+
+    At most `concurrency` commands run at the same time, the others wait
+    for a free slot. spawn() and spawn_call() return a GreenThread, its
+    wait() gives the result.
+    """
+
+    def __init__(self, concurrency=EXECUTOR_CONCURRENCY,
+                 timeout=EXECUTOR_TIMEOUT):
+        self.timeout = timeout
+        self.semaphore = semaphore.Semaphore(concurrency)
+        self.pool = greenpool.GreenPool(EXECUTOR_POOL_SIZE)
+
+    # run a command and wait for it, return a CommandResult
+    # timeout: seconds, None uses the executor's, 0 waits forever
+    def run(self, cmd, process_input=None, timeout=None, shell=False,
+            merge_stderr=False, addl_env=None):
+        timeout = (self.timeout if timeout is None else timeout)
+        env = None
+        if addl_env:
+            env = os.environ.copy()
+            env.update(addl_env)
+        with self.semaphore:
+            namespace, ns_cmd = (split_netns_cmd(cmd) if NETNS_USE_WORKERS
+                                 else (None, cmd))
+            if namespace:
+                try:
+                    return get_netns_worker(namespace).run(
+                        ns_cmd, process_input, timeout, shell, merge_stderr, addl_env)
+                except NetnsWorkerError as e:
+                    # the worker never got the command, fall back to ip netns exec
+                    LogExceptionHelp.logException(str(e))
+            start = time.time()
+            obj = green_subprocess.Popen(
+                cmd, shell=shell, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=(subprocess.STDOUT if merge_stderr else subprocess.PIPE),
+                preexec_fn=_subprocess_setup, close_fds=True, env=env)
+            timed_out = False
+            timer = eventlet.Timeout(timeout or None)
+            try:
+                _stdout, _stderr = obj.communicate(process_input)
+            except eventlet.Timeout as t:
+                if t is not timer:
+                    raise
+                timed_out = True
+                obj.kill()
+                obj.wait()
+                _stdout, _stderr = '', ''
+            finally:
+                timer.cancel()
+            return CommandResult(cmd, obj.returncode, _stdout or '',
+                                 _stderr or '', time.time() - start, timed_out)
+
+    # run a command and yield its stdout line by line while it runs, so
+    # large outputs are never held in memory. A slot is held until the
+    # generator is exhausted or closed; a failed exit raises RuntimeError.
+    def iter_lines(self, cmd, shell=False, addl_env=None):
+        env = None
+        if addl_env:
+            env = os.environ.copy()
+            env.update(addl_env)
+        with self.semaphore:
+            obj = green_subprocess.Popen(
+                cmd, shell=shell, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, preexec_fn=_subprocess_setup,
+                close_fds=True, env=env)
+            finished = False
+            try:
+                for line in iter(obj.stdout.readline, ''):
+                    yield line
+                finished = True
+            finally:
+                if not finished:
+                    obj.kill()
+                _stderr = obj.stderr.read()
+                obj.wait()
+            if obj.returncode:
+                msg = "Runing command [{}] error. msg: [{}]".format(cmd, _stderr.strip())
+                LogExceptionHelp.logException(msg)
+                raise RuntimeError(msg)
+
+    # run a command on a green thread
+    def spawn(self, cmd, **kwargs):
+        return self.pool.spawn(self.run, cmd, **kwargs)
+
+    # run any function on a green thread, e.g. a library call
+    def spawn_call(self, func, *args, **kwargs):
+        return self.pool.spawn(func, *args, **kwargs)
+
+    # run several commands at once, return their results in order
+    def run_all(self, cmds, **kwargs):
+        return [t.wait() for t in [self.spawn(cmd, **kwargs) for cmd in cmds]]
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = CommandExecutor()
+    return _executor
+
+
+# 'ip netns exec <ns> cmd...' -> (ns, cmd...), other commands -> (None, cmd)
+def split_netns_cmd(cmd):
+    if isinstance(cmd, basestring):
+        match = NETNS_EXEC_RE.match(cmd)
+        if match:
+            return match.group(1), match.group(2)
+        return None, cmd
+    cmd = list(cmd)
+    if len(cmd) > 4 and cmd[:3] == ['ip', 'netns', 'exec']:
+        return cmd[3], cmd[4:]
+    # e.g. ['ip netns exec ns', 'ipset', ...] joined by execute()
+    if cmd:
+        match = NETNS_EXEC_RE.match(str(cmd[0]) + ' ')
+        if match and len(cmd) > 1:
+            return match.group(1), ([match.group(2)] if match.group(2).strip() else []) + cmd[1:]
+    return None, cmd
+
+
+class NetnsWorkerError(Exception):
+    pass
+
+
+class NetnsWorker(object):
+    """A netns_worker.py process pinned to one network namespace.
+
+    Commands sent to it run inside the namespace without the extra
+    'ip netns exec' process. One command runs at a time; the process is
+    started on first use and stopped by the reaper once idle.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.process = None
+        self.lock = semaphore.Semaphore()
+        self.last_used = time.time()
+
+    def start(self):
+        self.process = green_subprocess.Popen(
+            [sys.executable, NETNS_WORKER_SCRIPT, self.namespace],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            preexec_fn=_subprocess_setup, close_fds=True)
+        reply = self._read()
+        if not reply.get('ready'):
+            self.stop()
+            raise NetnsWorkerError("netns worker for {} failed to start: {}".format(
+                self.namespace, reply.get('error')))
+
+    def stop(self):
+        if self.process:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+        self.process = None
+
+    def _read(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise NetnsWorkerError("netns worker for {} exited".format(self.namespace))
+        return json.loads(line)
+
+    # run a command in the namespace, return a CommandResult
+    # raise NetnsWorkerError only when the command was not sent; once it is
+    # sent it may have run, so a lost reply is returned as a failed result
+    def run(self, cmd, process_input=None, timeout=None, shell=False,
+            merge_stderr=False, addl_env=None):
+        if not isinstance(cmd, basestring):
+            cmd = map(str, cmd)
+        if process_input is not None:
+            process_input = process_input.decode(NETNS_WORKER_ENCODING)
+        request = {'cmd': cmd, 'input': process_input, 'shell': shell,
+                   'merge_stderr': merge_stderr, 'env': addl_env,
+                   'timeout': EXECUTOR_TIMEOUT if timeout is None else timeout}
+        with self.lock:
+            self.last_used = time.time()
+            start = time.time()
+            try:
+                if self.process is None:
+                    self.start()
+                self.process.stdin.write(json.dumps(request) + '\n')
+                self.process.stdin.flush()
+            except (IOError, OSError, ValueError) as e:
+                self.stop()
+                raise NetnsWorkerError("netns worker for {} failed: {}".format(
+                    self.namespace, e))
+            except NetnsWorkerError:
+                self.stop()
+                raise
+            try:
+                reply = self._read()
+            except (IOError, OSError, ValueError, NetnsWorkerError) as e:
+                self.stop()
+                msg = "netns worker for {} failed after the command was sent: {}".format(
+                    self.namespace, e)
+                LogExceptionHelp.logException(msg)
+                return CommandResult(cmd, -1, '', msg, time.time() - start)
+            self.last_used = time.time()
+        return CommandResult(cmd, reply['returncode'],
+                             reply['stdout'].encode(NETNS_WORKER_ENCODING),
+                             reply['stderr'].encode(NETNS_WORKER_ENCODING),
+                             time.time() - start, reply['timed_out'])
+
+    # stop the process unless a command is running, return True if stopped
+    def close(self, idle_only=False):
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if idle_only and time.time() - self.last_used <= NETNS_WORKER_IDLE:
+                return False
+            self.stop()
+            return True
+        finally:
+            self.lock.release()
+
+
+_netns_workers = {}
+_netns_reaper = None
+
+
+def get_netns_worker(namespace):
+    global _netns_reaper
+    worker = _netns_workers.get(namespace)
+    if worker is None:
+        worker = _netns_workers[namespace] = NetnsWorker(namespace)
+    if _netns_reaper is None:
+        _netns_reaper = eventlet.spawn(_reap_netns_workers)
+    return worker
+
+
+# stop the worker of a namespace, it holds the namespace open
+def forget_netns_worker(namespace):
+    worker = _netns_workers.pop(namespace, None)
+    if worker:
+        with worker.lock:
+            worker.stop()
+
+
+def _reap_netns_workers():
+    while True:
+        eventlet.sleep(max(NETNS_WORKER_IDLE / 2.0, 1))
+        for namespace, worker in _netns_workers.items():
+            if _netns_workers.get(namespace) is worker and worker.close(idle_only=True):
+                del _netns_workers[namespace]
+
+
+class GreenThreadMixin(object):
+    """Adds obj.spawn.<method>(...), which runs the method on the executor.
+
+    ovs.spawn.add_port(name) returns a GreenThread, wait() on it gives what
+    ovs.add_port(name) returns, so calls on different ports overlap.
+    """
+
+    @property
+    def spawn(self):
+        return _GreenCalls(self)
+
+
+class _GreenCalls(object):
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getattr__(self, name):
+        method = getattr(self._obj, name)
+        if not callable(method):
+            raise AttributeError("{} is not a method of {}".format(
+                name, type(self._obj).__name__))
+
+        def spawn(*args, **kwargs):
+            return get_executor().spawn_call(method, *args, **kwargs)
+        spawn.__name__ = name
+        return spawn
+
+
+# timeout: seconds before the command is killed, None uses EXECUTOR_TIMEOUT
+def execute(cmd, return_stdout=True, timeout=None):
     if cmd:
         print "Runing command: {}".format(cmd)
         exec_cmd = '  '.join(cmd)
-        ret = commands.getstatusoutput(exec_cmd)
+        result = get_executor().run(exec_cmd, shell=True, merge_stderr=True,
+                                    timeout=timeout)
+        output = result.stdout
+        # like commands.getstatusoutput
+        if output.endswith('\n'):
+            output = output[:-1]
+        if result.timed_out:
+            output = "timed out after {:.1f}s".format(result.duration)
+        ret = ((result.returncode if not result.timed_out else -1), output)
         if ret[0]:
             msg = "Runing command [{}] error. msg: [{}]".format(exec_cmd, ret[1])
             LogExceptionHelp.logException(msg)
@@ -61,28 +385,32 @@ def create_process(cmd, root_helper=None, addl_env=None):
 
 def exec_cmd(cmd, root_helper=None, process_input=None, addl_env=None,
              check_exit_code=True, return_stderr=False, log_fail_as_error=True,
-             extra_ok_codes=None):
+             extra_ok_codes=None, timeout=None):
     try:
-        obj, cmd = create_process(cmd, root_helper=root_helper,
-                                  addl_env=addl_env)
-        _stdout, _stderr = (process_input and
-                            obj.communicate(process_input) or
-                            obj.communicate())
-        obj.stdin.close()
+        if root_helper:
+            cmd = shlex.split(root_helper) + cmd
+        cmd = map(str, cmd)
+        print("Running command: {}".format(cmd))
+        result = get_executor().run(cmd, process_input=process_input,
+                                    addl_env=addl_env, timeout=timeout)
+        _stdout, _stderr = result.stdout, result.stderr
+        if result.timed_out:
+            _stderr = "timed out after {:.1f}s".format(result.duration)
+        returncode = (result.returncode if not result.timed_out else -1)
         msg = ("\nCommand: %(cmd)s\nExit code: %(code)s\nStdout: %(stdout)r\n"
-               "Stderr: %(stderr)r") % {'cmd': cmd, 'code': obj.returncode,
+               "Stderr: %(stderr)r") % {'cmd': cmd, 'code': returncode,
                                         'stdout': _stdout, 'stderr': _stderr}
 
         extra_ok_codes = extra_ok_codes or []
-        if obj.returncode and obj.returncode in extra_ok_codes:
-            obj.returncode = None
+        if returncode and returncode in extra_ok_codes:
+            returncode = None
 
-        if obj.returncode and log_fail_as_error:
+        if returncode and log_fail_as_error:
             LogExceptionHelp.logException(msg)
         else:
             LogExceptionHelp.logException(msg)
 
-        if obj.returncode and check_exit_code:
+        if returncode and check_exit_code:
             raise RuntimeError(msg)
     finally:
         # NOTE(termie): this appears to be necessary to let the subprocess
@@ -0,0 +1,192 @@
+# encoding=utf-8
+
+import time
+from eventlet import queue
+import utils
+from LogException import *
+from config import *
+
+
+class WorkflowError(Exception):
+    pass
+
+
+# 返回失败列表的步骤(如IpBatch.flush)的check: 列表为空才算成功
+def no_failures(result):
+    return not result
+
+
+# 工作流中的一步, requires为必须先完成的步骤名
+# check: 用返回值判断是否成功, 返回False时该步骤记为失败, 如check=bool
+class Step(object):
+    def __init__(self, name, func, args=(), kwargs=None, requires=(), check=None):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.requires = list(requires)
+        self.check = check
+        # 'pending', 'done', 'failed' or 'skipped'
+        self.state = 'pending'
+        self.result = None
+        self.error = None
+        # wall time in seconds, None until the step has run
+        self.elapsed = None
+
+    def describe(self):
+        func = getattr(self.func, '__name__', repr(self.func))
+        owner = getattr(self.func, '__self__', None)
+        if owner is not None:
+            func = '{}.{}'.format(type(owner).__name__, func)
+        args = ', '.join([repr(a) for a in self.args] +
+                         ['{}={!r}'.format(k, v) for k, v in sorted(self.kwargs.items())])
+        return '{}({})'.format(func, args)
+
+
+# 按依赖关系执行的一组步骤, 互不依赖的步骤在executor上同时执行
+# 一个步骤抛出异常或check不通过时, 依赖它的步骤不再执行
+# wf = Workflow('create_vm_port')
+# wf.add('bridge', linux_bridge_obj.create_br)
+# wf.add('veth', ip_batch.flush, requires=['bridge'], check=no_failures)
+# wf.add('bridge_port', linux_bridge_obj.add_port, (port,), requires=['veth'])
+# print(wf.plan())      # 只列出执行计划, 不执行
+# wf.run()
+# print(wf.report())    # 每一步的耗时和关键路径
+class Workflow(object):
+    """Steps with declared dependencies, run as a DAG.
+
+    run() starts every step whose requirements are done, so independent
+    branches overlap on the executor. Each step's wall time is recorded;
+    report() lists them with the critical path. With dry_run the plan is
+    printed and nothing is executed.
+    """
+
+    def __init__(self, name, dry_run=None):
+        self.name = name
+        self.dry_run = WORKFLOW_DRY_RUN if dry_run is None else dry_run
+        self.steps = []
+        self._steps = {}
+        self.elapsed = None
+
+    def add(self, name, func, args=(), kwargs=None, requires=(), check=None):
+        if name in self._steps:
+            raise WorkflowError("{}: duplicate step {}".format(self.name, name))
+        step = Step(name, func, args, kwargs, requires, check)
+        self.steps.append(step)
+        self._steps[name] = step
+        return step
+
+    def __getitem__(self, name):
+        return self._steps[name]
+
+    # 按依赖分层, 同一层的步骤互不依赖
+    def levels(self):
+        for step in self.steps:
+            for required in step.requires:
+                if required not in self._steps:
+                    raise WorkflowError("{}: step {} requires unknown step {}".format(
+                        self.name, step.name, required))
+        levels = []
+        placed = set()
+        remaining = list(self.steps)
+        while remaining:
+            level = [s for s in remaining if all(r in placed for r in s.requires)]
+            if not level:
+                raise WorkflowError("{}: dependency cycle among {}".format(
+                    self.name, [s.name for s in remaining]))
+            levels.append(level)
+            placed.update(s.name for s in level)
+            remaining = [s for s in remaining if s.name not in placed]
+        return levels
+
+    # 执行计划, 每行一个步骤, 前面的数字为所在的层
+    def plan(self):
+        lines = ['{} plan:'.format(self.name)]
+        for number, level in enumerate(self.levels(), 1):
+            for step in level:
+                after = (' after {}'.format(', '.join(step.requires))
+                         if step.requires else '')
+                lines.append('  {}. {}: {}{}'.format(number, step.name,
+                                                    step.describe(), after))
+        return '\n'.join(lines)
+
+    def _run_step(self, step, done):
+        start = time.time()
+        try:
+            step.result = step.func(*step.args, **step.kwargs)
+            if step.check and not step.check(step.result):
+                raise WorkflowError("returned {!r}".format(step.result))
+            step.state = 'done'
+        except Exception as e:
+            step.state = 'failed'
+            step.error = e
+            msg = "{} step {} error. msg: {}".format(self.name, step.name, e)
+            print(msg)
+            LogExceptionHelp.logException(msg)
+        finally:
+            step.elapsed = time.time() - start
+            done.put(step)
+
+    # 所有步骤都已成功完成
+    @property
+    def done(self):
+        return all(step.state == 'done' for step in self.steps)
+
+    # return True if every step is done
+    def run(self):
+        self.levels()
+        if self.dry_run:
+            print(self.plan())
+            return True
+        start = time.time()
+        executor = utils.get_executor()
+        done = queue.Queue()
+        running = 0
+        pending = list(self.steps)
+        while pending or running:
+            for step in list(pending):
+                states = [self._steps[r].state for r in step.requires]
+                if any(s in ('failed', 'skipped') for s in states):
+                    step.state = 'skipped'
+                elif all(s == 'done' for s in states):
+                    executor.spawn_call(self._run_step, step, done)
+                    running += 1
+                else:
+                    continue
+                pending.remove(step)
+            # with nothing running, the next pass settles the steps a failure skipped
+            if running:
+                done.get()
+                running -= 1
+        self.elapsed = time.time() - start
+        if WORKFLOW_TIMING_LOG:
+            LogExceptionHelp.logMsg(self.report())
+        return self.done
+
+    # 耗时最长的依赖链
+    def critical_path(self):
+        finish = {}
+        previous = {}
+        for level in self.levels():
+            for step in level:
+                before = max(step.requires, key=lambda r: finish[r]) if step.requires else None
+                finish[step.name] = (finish[before] if before else 0) + (step.elapsed or 0)
+                previous[step.name] = before
+        if not finish:
+            return []
+        name = max(finish, key=lambda n: finish[n])
+        path = []
+        while name:
+            path.append(name)
+            name = previous[name]
+        return path[::-1]
+
+    # 每一步的状态和耗时, 按耗时从大到小
+    def report(self):
+        lines = ['{} took {:.3f}s, critical path: {}'.format(
+            self.name, self.elapsed or 0, ' -> '.join(self.critical_path()))]
+        for step in sorted(self.steps, key=lambda s: -(s.elapsed or 0)):
+            elapsed = '{:.3f}s'.format(step.elapsed) if step.elapsed is not None else '-'
+            error = ' ({})'.format(step.error) if step.error else ''
+            lines.append('  {:<20} {:<8} {}{}'.format(step.name, step.state, elapsed, error))
+        return '\n'.join(lines)